@@ -0,0 +1,26 @@
+"""Picks what the dog's code talks to: the real MicroPython `machine` and
+`network` modules on the Pico, or the simulated ones in `sim` anywhere else.
+Code should use `backend.machine` and `backend.network` (looked up when they're
+needed, not imported by name) so the backend can be switched.
+"""
+
+try:
+    import machine
+    import network
+    SIMULATED = False
+except ImportError:
+    # not on the pico, so pretend
+    import sim as machine
+    import sim as network
+    SIMULATED = True
+
+
+def use_simulator():
+    """Switch to the simulated backend (even on the Pico, for testing gaits
+    without moving anything). Only affects hardware created after this.
+    """
+    global machine, network, SIMULATED
+    import sim
+    machine = sim
+    network = sim
+    SIMULATED = True
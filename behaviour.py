@@ -0,0 +1,165 @@
+"""Reactive behaviours for the robot dog. An ObstacleAvoider runs at a fixed
+rate on the event loop, looks at the latest distances the sensor samplers
+have worked out (it never waits on a sensor itself) and steers the walk by
+scaling and steering the gait (on top of the stride and turn it was given),
+which the MotionWorker picks up on its next tick.
+"""
+
+from hardware import (TimingStats, ticks_ms, ticks_us, ticks_diff,
+                      async_sleep_ms, next_due)
+
+
+class ObstacleAvoider(object):
+    """Slows the walk as an obstacle gets closer, stops when it's too close,
+    then turns on the spot until the way is clear again. Only changes the
+    gait while the worker is walking.
+    """
+    CLEAR = 'clear'
+    SLOW = 'slow'
+    STOP = 'stop'
+    TURN = 'turn'
+
+    def __init__(self, worker, sensors, rate_hz: int = 20,
+                 slow_distance: float = 8, stop_distance: float = 4,
+                 stop_ms: int = 300, turn: float = 2):
+        """Create an obstacle avoider (it doesn't start until run is called).
+        :param worker: the motion.MotionWorker doing the walking (its
+        engine's gait is the one slowed and steered)
+        :param sensors: the sensors to watch, left to right (anything with a
+        `distance` that's kept up to date, such as sensors being read by a
+        hardware.DistSampler or SensorArray)
+        :param rate_hz: the number of times a second to check the distances
+        :param slow_distance: the distance to start slowing down at
+        :param stop_distance: the distance to stop and turn at
+        :param stop_ms: how long to stand still before turning
+        :param turn: the gait steer to use while turning on the spot
+        """
+        self.worker = worker
+        self.gait = worker.engine.gait
+        self.sensors = sensors
+        self.period_ms = 1000 // rate_hz
+        self.slow_distance = slow_distance
+        self.stop_distance = stop_distance
+        self.stop_ms = stop_ms
+        self.turn = turn
+
+        self.state = ObstacleAvoider.CLEAR
+        self._stopped_at = 0
+        self.running = False
+        # how long each check takes, and how late it starts
+        self.iteration_us = TimingStats()
+        self.late_us = TimingStats()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Clear the timing counters"""
+        self.iteration_us.reset()
+        self.late_us.reset()
+        # when the state last changed, in microseconds (see ticks_us)
+        self.changed_us = None
+
+    def stats(self):
+        """Get the avoider's state and counters
+        :return: a dict with the state, the nearest distance, and the number
+        of iterations with the last/max/mean time each took and the most one
+        started late, in microseconds
+        """
+        iteration_us = self.iteration_us
+        return {
+            'state': self.state,
+            'nearest': self.nearest(),
+            'iterations': iteration_us.count,
+            'iteration_us_last': iteration_us.last,
+            'iteration_us_max': iteration_us.max,
+            'iteration_us_mean': iteration_us.mean(),
+            'late_us_max': self.late_us.max,
+        }
+
+    def nearest(self):
+        """The closest distance any sensor sees (None if nothing's in range)"""
+        nearest = None
+        for sensor in self.sensors:
+            distance = sensor.distance
+            if distance is not None and (nearest is None
+                                         or distance < nearest):
+                nearest = distance
+        return nearest
+
+    def _turn_direction(self) -> int:
+        # away from the nearer side (right if there's only one sensor)
+        left = self.sensors[0].distance
+        right = self.sensors[-1].distance
+        if left is None or (right is not None and right < left):
+            return -1
+        return 1
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            self.changed_us = ticks_us()
+
+    def _clear(self):
+        # walk however the gait asks again (only the avoider's speed and
+        # steer are changed, so nothing set meanwhile is lost)
+        self.gait.speed = 1.0
+        self.gait.steer = 0
+        self._set_state(ObstacleAvoider.CLEAR)
+
+    def step(self):
+        """Look at the distances and slow or steer the gait to suit. The
+        avoider's task does this every period_ms."""
+        if self.worker.state != self.worker.WALKING:
+            if self.state != ObstacleAvoider.CLEAR:
+                # someone else took over
+                self._clear()
+            return
+
+        nearest = self.nearest()
+        if self.state in (ObstacleAvoider.STOP, ObstacleAvoider.TURN):
+            # keep going until there's room to walk properly (not just past
+            # the stop distance, or it would stop again straight away)
+            if nearest is None or nearest >= self.slow_distance:
+                self._clear()
+            elif self.state == ObstacleAvoider.STOP and \
+                    ticks_diff(ticks_ms(), self._stopped_at) >= self.stop_ms:
+                self.gait.steer = self.turn * self._turn_direction()
+                self._set_state(ObstacleAvoider.TURN)
+            return
+
+        if nearest is None or nearest >= self.slow_distance:
+            self._clear()
+        elif nearest > self.stop_distance:
+            # slower the closer it gets
+            self.gait.speed = ((nearest - self.stop_distance)
+                               / (self.slow_distance - self.stop_distance))
+            self._set_state(ObstacleAvoider.SLOW)
+        else:
+            self.gait.speed = 0
+            self.gait.steer = 0
+            self._stopped_at = ticks_ms()
+            self._set_state(ObstacleAvoider.STOP)
+
+    async def run(self):
+        """Avoid obstacles until stop is called (or the task is cancelled),
+        leaving the gait walking as asked afterwards."""
+        self.running = True
+        due = ticks_ms()
+        try:
+            while self.running:
+                start = ticks_us()
+                late = ticks_diff(ticks_ms(), due) * 1000
+                self.step()
+                self.iteration_us.record(ticks_diff(ticks_us(), start))
+                self.late_us.record(late)
+
+                due, wait = next_due(due, self.period_ms)
+                await async_sleep_ms(wait)
+        finally:
+            self.gait.speed = 1.0
+            self.gait.steer = 0
+            self.state = ObstacleAvoider.CLEAR
+            self.running = False
+
+    def stop(self):
+        """Stop avoiding obstacles after the current check"""
+        self.running = False
@@ -0,0 +1,1567 @@
+"""Benchmarks for the robot dog. Run these on the Pico from the REPL (for
+example `import bench; bench.ik_table()`) or with CPython on a desktop, where
+the simulated backend stands in for the hardware (`python bench.py` runs the
+whole suite).
+"""
+
+import _thread
+import asyncio
+import gc
+import io
+import math
+import socket
+import struct
+import sys
+import time
+
+import backend
+import behaviour
+import gait
+import hardware
+import microdot
+import motion
+import sim
+import telemetry
+from hardware import (IKTable, Interpolator, Leg, PWMOutput, Servo, densify,
+                      ticks_diff, ticks_us)
+
+def _sample_targets(leg: Leg, count: int):
+    """Get a spread of reachable targets in the area the gaits use."""
+    targets = []
+    for i in range(count):
+        # walk a spiral-ish path through the front of the workspace
+        x = 6 + 6 * ((i * 0.618) % 1)
+        y = -5 + 10 * ((i * 0.414) % 1)
+        if leg._solve_angles((x, y)) is not None:
+            targets.append((x, y))
+    return targets
+
+
+def ik_accuracy(steps=(1, 0.5, 0.25), count=2000):
+    """Report how far the interpolated table angles are from the exact ones
+    for a few grid sizes.
+    """
+    leg = Leg(Servo(0), 4, Servo(1), 8, Leg.Side.Right)
+    targets = _sample_targets(leg, count)
+
+    print('step  bytes   max err  mean err  fallbacks')
+    for step in steps:
+        table = IKTable(leg, step)
+        worst = 0
+        total = 0
+        hits = 0
+        for target in targets:
+            looked = table.lookup(*target)
+            if looked is None:
+                continue
+            exact = leg._solve_angles(target)
+            err = max(abs(looked[0] - exact[0]), abs(looked[1] - exact[1]))
+            worst = max(worst, err)
+            total += err
+            hits += 1
+        mean = total / hits if hits else math.nan
+        print(f'{step:<5} {table.memory():<7} {worst:<8.3f} {mean:<9.4f} '
+              f'{len(targets) - hits}')
+
+
+def ik_table(step=0.5, count=500):
+    """Time the ik table's lookup against solving exactly, without the servo
+    writes (which cost the same either way) getting in the way.
+    """
+    leg = Leg(Servo(0), 4, Servo(1), 8, Leg.Side.Right)
+    targets = _sample_targets(leg, count)
+    table = IKTable.get(leg, step)
+    solve = leg._solve_angles
+    lookup = table.lookup
+
+    start = ticks_us()
+    for target in targets:
+        solve(target)
+    exact_us = ticks_diff(ticks_us(), start)
+
+    start = ticks_us()
+    misses = 0
+    for x, y in targets:
+        if lookup(x, y) is None:
+            misses += 1
+    table_us = ticks_diff(ticks_us(), start)
+
+    print(f'analytic: {exact_us / len(targets):.1f} us/solve')
+    print(f'table:    {table_us / len(targets):.1f} us/lookup '
+          f'({misses} of {len(targets)} fall back to solving)')
+
+
+def trajectory(steps=100, repeat=5):
+    """Measure batch solve throughput for a densified step cycle, with each
+    backend that's available here.
+    """
+    import main
+
+    leg = Leg(Servo(0), 4, Servo(1), 8, Leg.Side.Left)
+    points = densify(main.STEP_POSITIONS, steps)
+
+    backends = [('array', False)]
+    if hardware.numpy is not None:
+        backends.append(('numpy', True))
+
+    for name, use_numpy in backends:
+        start = ticks_us()
+        for _ in range(repeat):
+            traj = leg.solve_trajectory(points, use_numpy=use_numpy)
+        elapsed = ticks_diff(ticks_us(), start)
+        rate = len(points) * repeat * 1_000_000 / elapsed
+        print(f'{name}: {len(points)} points ({traj.reachable} reachable), '
+              f'{rate:.0f} solves/s')
+
+    # the one-at-a-time path for comparison
+    start = ticks_us()
+    for _ in range(repeat):
+        for point in points:
+            leg._solve_angles(point)
+    elapsed = ticks_diff(ticks_us(), start)
+    rate = len(points) * repeat * 1_000_000 / elapsed
+    print(f'single: {rate:.0f} solves/s')
+
+
+def _request(port: int, path: str, method: str = 'GET') -> bytes:
+    """Make a one-off blocking HTTP request to the local server and return the
+    raw response. Blocking sockets are used so the client can run on its own
+    thread and isn't held up by whatever is blocking the server's event loop.
+    """
+    sock = socket.socket()
+    sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+    sock.send(f'{method} {path} HTTP/1.0\r\n\r\n'.encode())
+    res = b''
+    while True:
+        chunk = sock.recv(1024)
+        if not chunk:
+            break
+        res += chunk
+    sock.close()
+    return res
+
+
+def _ping_client(port: int, pings: int, results: list):
+    """Start a motion, then time pings while it plays (for running on its own
+    thread). Appends (mean_us, worst_us) to results when done.
+    """
+    _thread.start_new_thread(_request, (port, '/dance'))
+    time.sleep(0.1)
+    worst = 0
+    total = 0
+    for _ in range(pings):
+        start = ticks_us()
+        _request(port, '/ping')
+        elapsed = ticks_diff(ticks_us(), start)
+        worst = max(worst, elapsed)
+        total += elapsed
+    results.append((total / pings, worst))
+
+
+async def _motion_latency(blocking: bool, port: int, pings: int):
+    legs = [Leg(Servo(i*2), 4, Servo(i*2 + 1), 8, i % 2) for i in range(4)]
+    servos = [servo for leg in legs for servo in (leg.servo1, leg.servo2)]
+
+    def choreography(sleep):
+        # a couple of seconds of steady movement, like a short dance
+        for i in range(10):
+            for leg in legs:
+                leg.move_to_fast((9, 4) if i % 2 else (10.5, -1))
+            sleep(0.2)
+
+    plan = motion.compile_plan(choreography, servos)
+    scheduler = motion.MotionScheduler(servos)
+    app = microdot.Microdot()
+
+    @app.route('/ping')
+    async def ping(req):
+        return 'pong'
+
+    @app.route('/dance')
+    async def dance(req):
+        if blocking:
+            # what a sync handler does when it runs on the event loop
+            motion.play(plan, servos)
+        else:
+            scheduler.start('dance', plan)
+        return '', 202
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    results = []
+    _thread.start_new_thread(_ping_client, (port, pings, results))
+    while not results:
+        await asyncio.sleep(0.05)
+    # let the motion finish before shutting down
+    while scheduler.current is not None:
+        await asyncio.sleep(0.05)
+
+    app.shutdown()
+    await server
+    return results[0]
+
+
+def motion_latency(port=5080, pings=20):
+    """Measure request latency while a motion is playing, with the motion
+    blocking the event loop (how the routes used to work) and with it running
+    on the MotionScheduler.
+    """
+    for name, blocking in (('blocking', True), ('scheduler', False)):
+        mean, worst = asyncio.run(_motion_latency(blocking, port, pings))
+        print(f'{name}: mean {mean / 1000:.1f} ms, '
+              f'worst {worst / 1000:.1f} ms')
+
+
+def interpolation(rates=(50, 100, 200), duration=0.5):
+    """Measure the cost of a control tick moving all 8 servos, for each
+    profile and a few control rates.
+    """
+    servos = [Servo(i) for i in range(8)]
+    for rate in rates:
+        for profile in Interpolator.PROFILES:
+            interpolator = Interpolator(rate)
+            moves = [(servo, 45 if servo.current_angle < 0 else -45)
+                     for servo in servos]
+            interpolator.move(moves, duration, profile)
+            stats = interpolator.stats()
+            print(f'{rate} Hz {profile}: {stats["ticks"]} ticks, '
+                  f'mean {stats["mean_us"]:.1f} us, max {stats["max_us"]} us')
+
+
+def _walk_plan(servos):
+    """Compile a walk cycle like main's, for the given 8 servos."""
+    import main
+
+    legs = [Leg(servos[i*2], 4, servos[i*2 + 1], 8, i % 2) for i in range(4)]
+
+    def choreography(sleep):
+        for leg in legs:
+            for position in main.STEP_POSITIONS:
+                leg.move_to_fast(position)
+                sleep(0.02)
+            sleep(0.05)
+
+    return motion.compile_plan(choreography, servos)
+
+
+def plan_jitter(cycles=3):
+    """Replay a walk cycle and measure how late each duty write was compared
+    to the plan (needs the simulated backend, which timestamps the writes).
+    """
+    if not backend.SIMULATED:
+        print('plan_jitter needs the simulated backend')
+        return
+
+    servos = [Servo(i) for i in range(8)]
+    plan = _walk_plan(servos)
+    sim.reset()
+    runs = [0]
+
+    def repeat():
+        runs[0] += 1
+        return runs[0] < cycles
+
+    start = ticks_us()
+    motion.play(plan, servos, repeat=repeat)
+
+    log = sim.writes()
+    worst = 0
+    total = 0
+    for i, (t_us, pin, duty) in enumerate(log):
+        entry = i % len(plan)
+        cycle = i // len(plan)
+        due = (cycle*plan.duration_ms + plan.data[entry*3]) * 1000
+        late = ticks_diff(t_us, start) - due
+        worst = max(worst, late)
+        total += late
+    print(f'{len(log)} writes, mean {total / len(log) / 1000:.2f} ms late, '
+          f'worst {worst / 1000:.2f} ms')
+
+
+def _read_response(sock, buffered: bytes):
+    """Read one response with a Content-Length from a kept alive connection.
+    :return: (response, anything read past the end of it)
+    """
+    while b'\r\n\r\n' not in buffered:
+        buffered += sock.recv(1024)
+    head, body = buffered.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, value = line.split(b':', 1)
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while len(body) < length:
+        body += sock.recv(1024)
+    return head + b'\r\n\r\n' + body[:length], body[length:]
+
+
+def _throughput_client(port: int, count: int, keep_alive: bool,
+                       results: list):
+    start = ticks_us()
+    if keep_alive:
+        sock = None
+        for _ in range(count):
+            if sock is None:
+                sock = socket.socket()
+                sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+                buffered = b''
+            sock.send(b'GET /ping HTTP/1.1\r\nHost: dog\r\n\r\n')
+            res, buffered = _read_response(sock, buffered)
+            if b'Connection: close' in res:
+                # the server's request limit for the connection was reached
+                sock.close()
+                sock = None
+        if sock is not None:
+            sock.close()
+    else:
+        for _ in range(count):
+            _request(port, '/ping')
+    results.append(ticks_diff(ticks_us(), start))
+
+
+async def _http_throughput(port: int, count: int, keep_alive: bool):
+    app = microdot.Microdot()
+
+    @app.route('/ping')
+    async def ping(req):
+        return 'pong'
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    results = []
+    _thread.start_new_thread(_throughput_client,
+                             (port, count, keep_alive, results))
+    while not results:
+        await asyncio.sleep(0.05)
+
+    app.shutdown()
+    await server
+    return results[0]
+
+
+def http_throughput(port=5081, count=200):
+    """Measure sequential requests per second against a trivial route, with a
+    new connection per request and with one kept alive connection.
+    """
+    for name, keep_alive in (('new connections', False),
+                             ('keep-alive', True)):
+        elapsed = asyncio.run(_http_throughput(port, count, keep_alive))
+        print(f'{name}: {count} requests, '
+              f'{count * 1_000_000 / elapsed:.0f} req/s')
+
+
+def _linear_find_route(app, req):
+    """How Microdot.find_route used to work: try every route in turn."""
+    f = 404
+    for route_methods, route_pattern, route_handler in app.url_map:
+        req.url_args = route_pattern.match(req.path)
+        if req.url_args is not None:
+            if req.method in route_methods:
+                f = route_handler
+                break
+            else:
+                f = 405
+    return f
+
+
+def routing(counts=(10, 100, 500), lookups=2000):
+    """Measure the cost of finding a request's route as more routes are
+    registered, with the router and with a linear scan of the URL map.
+    """
+    for count in counts:
+        app = microdot.Microdot()
+        for i in range(count):
+            app.route(f'/route{i}')(lambda req: '')
+            if i % 10 == 0:
+                app.route(f'/items{i}/<int:id>')(lambda req, id: '')
+        # the routes the control page uses are registered last, the worst
+        # case for a linear scan
+        app.route('/sit')(lambda req: '')
+        app.route('/jobs/<int:job_id>')(lambda req, job_id: '')
+        requests = [microdot.Request(app, None, 'GET', path, '1.1',
+                                     microdot.NoCaseDict())
+                    for path in ('/sit', '/jobs/3', '/missing')]
+        app.router()
+
+        for name, find in (('router', app.find_route),
+                           ('linear', lambda req: _linear_find_route(app,
+                                                                     req))):
+            start = ticks_us()
+            for i in range(lookups):
+                find(requests[i % len(requests)])
+            elapsed = ticks_diff(ticks_us(), start)
+            print(f'{len(app.url_map)} routes, {name}: '
+                  f'{elapsed / lookups:.1f} us per lookup')
+
+
+# what a phone's browser sends for a button on the control page
+BROWSER_REQUEST = (
+    b'GET /sit HTTP/1.1\r\n'
+    b'Host: 192.168.4.1\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Upgrade-Insecure-Requests: 1\r\n'
+    b'User-Agent: Mozilla/5.0 (Linux; Android 14; Pixel 7) '
+    b'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Mobile Safari/537.36'
+    b'\r\n'
+    b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,'
+    b'image/avif,image/webp,*/*;q=0.8\r\n'
+    b'Referer: http://192.168.4.1/\r\n'
+    b'Accept-Encoding: gzip, deflate\r\n'
+    b'Accept-Language: en-GB,en;q=0.9\r\n'
+    b'\r\n')
+
+
+def _allocated():
+    """How much has been allocated: bytes on MicroPython (with the GC off),
+    or the number of live blocks on CPython (which frees most garbage
+    straight away, so this only counts what's kept).
+    """
+    try:
+        return gc.mem_alloc()
+    except AttributeError:
+        return sys.getallocatedblocks()
+
+
+async def _parse(count: int, buffered: bool):
+    app = microdot.Microdot()
+    reader = microdot.AsyncBytesIO(BROWSER_REQUEST * count)
+    if buffered:
+        reader = microdot.ConnectionReader(reader)
+    requests = []
+    gc.collect()
+    gc.disable()
+    allocated = _allocated()
+    start = ticks_us()
+    for _ in range(count):
+        requests.append(await microdot.Request.create(app, reader, None,
+                                                      None))
+    elapsed = ticks_diff(ticks_us(), start)
+    allocated = _allocated() - allocated
+    gc.enable()
+    return elapsed, allocated
+
+
+def request_parsing(count=500):
+    """Measure the time and allocations to parse a browser's request head,
+    reading it a line at a time and through a reused ConnectionReader
+    buffer.
+    """
+    unit = 'bytes' if hasattr(gc, 'mem_alloc') else 'blocks kept'
+    for name, buffered in (('lines', False), ('buffer', True)):
+        elapsed, allocated = asyncio.run(_parse(count, buffered))
+        print(f'{name}: {elapsed / count:.1f} us, '
+              f'{allocated / count:.1f} {unit} per request')
+
+
+def _first_byte(port: int, request: bytes):
+    """Send a request on a new connection and read the whole response.
+    :return: (microseconds until the first byte came back, bytes received)
+    """
+    sock = socket.socket()
+    sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+    start = ticks_us()
+    sock.send(request)
+    received = len(sock.recv(4096))
+    first = ticks_diff(ticks_us(), start)
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        received += len(chunk)
+    sock.close()
+    return first, received
+
+
+def _page_client(port: int, count: int, etag: str, results: list):
+    base = (b'HTTP/1.0\r\nAccept-Encoding: gzip, deflate\r\n')
+    for name, request in (
+            ('Response', b'GET /before ' + base + b'\r\n'),
+            ('StaticResponse', b'GET /after ' + base + b'\r\n'),
+            ('StaticResponse, 304', b'GET /after ' + base +
+             b'If-None-Match: ' + etag.encode() + b'\r\n\r\n')):
+        total = 0
+        for _ in range(count):
+            first, received = _first_byte(port, request)
+            total += first
+        results.append((name, total / count, received))
+
+
+async def _static_page(port: int, count: int):
+    with open('index.html') as f:
+        page = f.read()
+    static = microdot.StaticResponse(page, max_age=3600,
+                                     headers={'Content-Type': 'text/html'})
+    app = microdot.Microdot()
+
+    @app.route('/before')
+    def before(req):
+        return microdot.Response(body=page,
+                                 headers={'Content-Type': 'text/html'})
+
+    @app.route('/after')
+    def after(req):
+        return static
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    results = []
+    _thread.start_new_thread(_page_client, (port, count, static.etag,
+                                            results))
+    while len(results) < 3:
+        await asyncio.sleep(0.05)
+
+    app.shutdown()
+    await server
+    return results
+
+
+def static_page(port=5083, count=100):
+    """Measure the bytes sent and the time to first byte for the control
+    page, built as a Response per request and served from a StaticResponse
+    (compressed, and revalidated with its ETag).
+    """
+    for name, first, received in asyncio.run(_static_page(port, count)):
+        print(f'{name}: {received} bytes, first byte after '
+              f'{first / 1000:.2f} ms')
+
+
+class _CountingStream(object):
+    """Counts the writes made to a stream (each one a send on the socket).
+    Only has the writer's transport (so responses can sendfile to it) if
+    asked to."""
+    def __init__(self, writer, transport: bool = False):
+        self.writer = writer
+        self.writes = 0
+        self.transport = writer.transport if transport else None
+
+    async def awrite(self, data):
+        self.writes += 1
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+async def _write_per_line(res, stream):
+    """How Response.write used to send a response: a write for the status
+    line, every header, the blank line and the body."""
+    res.complete()
+    await stream.awrite('HTTP/1.0 {} {}\r\n'.format(
+        res.status_code, res.reason or 'OK').encode())
+    for header, value in res.headers.items():
+        await stream.awrite('{}: {}\r\n'.format(header, value).encode())
+    await stream.awrite(b'\r\n')
+    if res.body:
+        await stream.awrite(res.body)
+
+
+async def _discard_server():
+    """Start a server that reads and throws away everything sent to it, and
+    connect to it.
+    :return: (server, writer for the connection)
+    """
+    async def discard(reader, writer):
+        while await reader.read(65536):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(discard, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    return server, writer
+
+
+async def _close_discard_server(server, writer):
+    writer.close()
+    await writer.wait_closed()
+    # let the server see the connection close
+    await asyncio.sleep(0.05)
+    server.close()
+    await server.wait_closed()
+
+
+async def _response_writes(count: int):
+    server, writer = await _discard_server()
+    responses = (
+        # a button press's redirect, and a status poll
+        lambda: microdot.Response(status_code=303, reason='API Endpoint',
+                                  headers={'Location': '/'}),
+        lambda: microdot.Response({'state': 'walking', 'queued': 0,
+                                   'latency_mean_us': 1152.4}),
+    )
+    results = []
+    for name, write in (('per line', _write_per_line),
+                        ('single write', lambda res, stream:
+                         res.write(stream))):
+        stream = _CountingStream(writer)
+        start = ticks_us()
+        for i in range(count):
+            await write(responses[i % len(responses)](), stream)
+        results.append((name, ticks_diff(ticks_us(), start),
+                        stream.writes))
+    await _close_discard_server(server, writer)
+    return results
+
+
+def response_writes(count=1000):
+    """Measure the writes (socket sends) and time it takes to send small
+    responses, a write per line against one write for the whole response.
+    """
+    for name, elapsed, writes in asyncio.run(_response_writes(count)):
+        print(f'{name}: {writes / count:.1f} writes, '
+              f'{elapsed / count:.1f} us per response')
+
+
+class _ReadOnly(object):
+    """A file that can only be read a chunk at a time, the way
+    Response.body_iter reads files."""
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n):
+        return self.f.read(n)
+
+    def close(self):
+        self.f.close()
+
+
+async def _file_transfer(filename: str, count: int):
+    server, writer = await _discard_server()
+    results = []
+    for name in ('read per chunk', 'readinto buffer', 'sendfile'):
+        stream = _CountingStream(writer, transport=name == 'sendfile')
+        start = ticks_us()
+        for _ in range(count):
+            res = microdot.Response.send_file(filename)
+            if name == 'read per chunk':
+                res.body = _ReadOnly(res.body)
+            await res.write(stream)
+        results.append((name, ticks_diff(ticks_us(), start)))
+    await _close_discard_server(server, writer)
+    return results
+
+
+def file_transfer(filename='sensor-holder.FCStd', count=50):
+    """Measure sending a file with Response.send_file, reading it a chunk at
+    a time, through the shared readinto buffer, and with sendfile (CPython
+    only)."""
+    res = microdot.Response.send_file(filename)
+    size = res.file_size
+    res.body.close()
+    for name, elapsed in asyncio.run(_file_transfer(filename, count)):
+        print(f'{name}: {elapsed / count / 1000:.2f} ms per file, '
+              f'{size * count / elapsed:.1f} MB/s')
+
+
+class _DefaultExecutorApp(microdot.Microdot):
+    """How sync handlers used to run: every one on asyncio's default thread
+    pool, with no limit on how many wait for a thread."""
+    async def run_handler(self, handler, *args, **kwargs):
+        return await microdot.invoke_handler(handler, *args, **kwargs)
+
+
+def _load_client(port: int, path: str, count: int, statuses: list):
+    for _ in range(count):
+        statuses.append(_request(port, path).split(b' ', 2)[1])
+
+
+async def _handler_load(app, port: int, path: str, clients: int,
+                        count: int):
+    # threading is only here to count threads: micropython hasn't got it
+    import threading
+    peak = [0]
+
+    @app.route('/cheap')
+    def cheap(req):
+        peak[0] = max(peak[0], threading.active_count())
+        return 'ok'
+
+    @app.route('/slow')
+    def slow(req):
+        # like a handler that waits on the hardware
+        peak[0] = max(peak[0], threading.active_count())
+        time.sleep(0.02)
+        return 'ok'
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    statuses = []
+    start = ticks_us()
+    for _ in range(clients):
+        _thread.start_new_thread(_load_client,
+                                 (port, path, count, statuses))
+    while len(statuses) < clients * count:
+        await asyncio.sleep(0.01)
+    elapsed = ticks_diff(ticks_us(), start)
+
+    app.shutdown()
+    await server
+    return elapsed, statuses.count(b'503'), peak[0]
+
+
+def handler_load(port=5084, clients=32, count=5):
+    """Load test sync handlers: a burst of clients on a slow (blocking) and
+    a cheap route, with asyncio's default thread pool (how it used to
+    work), the bounded pool, and cheap handlers run inline (CPython only).
+    The thread count includes the main thread."""
+    def bounded():
+        app = microdot.Microdot()
+        app.max_threads = 4
+        app.max_queued_handlers = 8
+        return app
+
+    def inline():
+        app = microdot.Microdot()
+        app.sync_handlers = 'inline'
+        return app
+
+    total = clients * count
+    for path in ('/slow', '/cheap'):
+        for name, make_app in (('default pool', _DefaultExecutorApp),
+                               ('bounded pool', bounded),
+                               ('inline', inline)):
+            if path == '/slow' and name == 'inline':
+                # blocking the event loop isn't a fair comparison
+                continue
+            elapsed, rejected, threads = asyncio.run(
+                _handler_load(make_app(), port, path, clients, count))
+            print(f'{path} {name}: {total * 1_000_000 / elapsed:.0f} req/s, '
+                  f'{rejected} rejected, up to {threads} threads')
+
+
+def _stalled_clients(port: int, stalled: int, results: list):
+    """Tie up the server with clients that stop part way through a request
+    head, and check a normal request is shed while they hold it, then served
+    once they've timed out."""
+    socks = []
+    for _ in range(stalled):
+        sock = socket.socket()
+        sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+        sock.send(b'GET /ping HTTP/1.1\r\nHost: dog\r\n')
+        socks.append(sock)
+    time.sleep(0.1)
+    start = ticks_us()
+    results.append(_request(port, '/ping').split(b' ', 2)[1])
+    results.append(ticks_diff(ticks_us(), start))
+    time.sleep(0.7)
+    results.append(_request(port, '/ping').split(b' ', 2)[1])
+    for sock in socks:
+        sock.close()
+
+
+async def _connection_limits(port: int, limit: int, stalled: int):
+    app = microdot.Microdot()
+    app.max_connections = limit
+    app.head_timeout = 0.5
+
+    @app.route('/ping')
+    async def ping(req):
+        return 'pong'
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    results = []
+    _thread.start_new_thread(_stalled_clients, (port, stalled, results))
+    while len(results) < 3:
+        await asyncio.sleep(0.05)
+    stats = app.server_stats()
+
+    app.shutdown()
+    await server
+    return results, stats
+
+
+def connection_limits(port=5085, limit=4, stalled=6):
+    """Stall more clients than the connection limit allows, and show the
+    server shedding a request while they hold it and recovering once their
+    head timeout passes."""
+    (busy, busy_us, recovered), stats = asyncio.run(
+        _connection_limits(port, limit, stalled))
+    print(f'while stalled: {busy.decode()} in {busy_us / 1000:.1f} ms, '
+          f'after timeouts: {recovered.decode()}')
+    print(f'rejected {stats["connections_rejected"]}, '
+          f'timed out {stats["connections_timed_out"]}')
+
+
+async def _metrics_load(port: int, count: int, metrics: bool):
+    app = microdot.Microdot()
+    if metrics:
+        app.enable_metrics()
+
+    @app.route('/ping')
+    async def ping(req):
+        return 'pong'
+
+    @app.route('/slow')
+    async def slow(req):
+        # like a command that waits on the hardware
+        await asyncio.sleep(0.005)
+        return 'done'
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    results = []
+    _thread.start_new_thread(_throughput_client,
+                             (port, count, True, results))
+    while not results:
+        await asyncio.sleep(0.05)
+    for _ in range(10):
+        await asyncio.get_running_loop().run_in_executor(
+            None, _request, port, '/slow')
+    summary = app.metrics.to_dict() if metrics else None
+
+    app.shutdown()
+    await server
+    return results[0], summary
+
+
+def request_metrics(port=5086, count=500):
+    """Measure what recording metrics costs per request (over keep-alive,
+    where it's the biggest share), and how many allocations recording takes,
+    then show the metrics finding the slow route."""
+    for metrics in (False, True):
+        elapsed, summary = asyncio.run(_metrics_load(port, count, metrics))
+        print(f'metrics {"on" if metrics else "off"}: '
+              f'{count * 1_000_000 / elapsed:.0f} req/s')
+
+    recorder = microdot.Metrics(microdot.Microdot())
+    gc.collect()
+    gc.disable()
+    allocated = _allocated()
+    for i in range(1000):
+        recorder.record(None, 200, i, i * 3, i * 7)
+    allocated = _allocated() - allocated
+    gc.enable()
+    print(f'recording 1000 requests: {allocated} allocated')
+
+    for route in summary['routes']:
+        counts = route['handler']['buckets']
+        slowest = max(i for i, n in enumerate(counts) if n)
+        bound = (summary['buckets_us'][slowest]
+                 if slowest < len(summary['buckets_us']) else 'more')
+        print(f'{route["route"]}: {route["requests"]} requests, handler mean '
+              f'{route["handler"]["sum_us"] / route["requests"]:.0f} us, '
+              f'slowest up to {bound} us')
+
+
+def _sse_client(port: int, seconds: float, events: list):
+    sock = socket.socket()
+    sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+    sock.send(b'GET /telemetry HTTP/1.1\r\n\r\n')
+    sock.settimeout(0.1)
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        try:
+            data = sock.recv(4096)
+        except OSError:
+            continue
+        if not data:
+            break
+        count += data.count(b'\ndata: ')
+    sock.close()
+    events.append(count)
+
+
+def _polling_client(port: int, seconds: float, rate_hz: int, events: list):
+    # what each page would have to do without the stream
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        _request(port, '/state')
+        count += 1
+        time.sleep(1 / rate_hz)
+    events.append(count)
+
+
+async def _control_loop(engine, seconds: float, lateness: list):
+    # like GaitEngine.run_async, but noting how late each tick starts (the
+    # plans the scheduler plays share the event loop with the server too)
+    targets = engine.targets()
+    start = ticks_us()
+    period_us = engine.period_ms * 1000
+    for count in range(int(seconds * engine.rate_hz)):
+        due = count * period_us
+        lateness.append(max(ticks_diff(ticks_us(), start) - due, 0))
+        engine.tick(next(targets)[1])
+        wait = due + period_us - ticks_diff(ticks_us(), start)
+        await asyncio.sleep(max(wait, 0) / 1_000_000)
+
+
+async def _telemetry_jitter(port: int, clients: int, polling: bool,
+                            rate_hz: int, seconds: float):
+    legs = [Leg(Servo(i*2), 4, Servo(i*2 + 1), 8, i % 2) for i in range(4)]
+    engine = gait.GaitEngine(legs, gait.Gait('trot'))
+    servos = [servo for leg in legs for servo in (leg.servo1, leg.servo2)]
+    live = telemetry.Telemetry({
+        'angles': lambda: [round(servo.current_angle, 1)
+                           for servo in servos],
+        'walk': lambda: {'phase': round(engine.phase, 3)},
+        'loop': lambda: {'tick_us': engine.tick_us.last,
+                         'tick_max_us': engine.tick_us.max},
+    }, rate_hz=rate_hz, max_clients=clients)
+
+    app = microdot.Microdot()
+
+    @app.route('/telemetry')
+    async def stream(req):
+        return microdot.Response(live.subscribe(), headers={
+            'Content-Type': 'text/event-stream', 'Connection': 'close'})
+
+    @app.route('/state')
+    async def state(req):
+        return live.sample()
+
+    server = asyncio.create_task(app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    events = []
+    for _ in range(clients):
+        if polling:
+            _thread.start_new_thread(_polling_client,
+                                     (port, seconds, rate_hz, events))
+        else:
+            _thread.start_new_thread(_sse_client, (port, seconds, events))
+    lateness = []
+    await _control_loop(engine, seconds, lateness)
+    while len(events) < clients:
+        await asyncio.sleep(0.05)
+
+    live.stop()
+    app.shutdown()
+    await server
+    return lateness, sum(events), live.stats()
+
+
+def telemetry_jitter(port=5087, clients=(1, 4), rate_hz=20, seconds=3):
+    """Measure how late a 50 Hz control loop on the event loop starts its
+    ticks while telemetry streams to some clients, compared to no clients and
+    to the same clients polling for the state at the same rate."""
+    runs = [(0, False)]
+    for count in clients:
+        runs += [(count, False), (count, True)]
+    for count, polling in runs:
+        lateness, events, stats = asyncio.run(_telemetry_jitter(
+            port, count, polling, rate_hz, seconds))
+        lateness.sort()
+        name = (f'{count} polling' if polling
+                else f'{count} streaming' if count else 'no clients')
+        line = (f'{name}: tick late mean '
+                f'{sum(lateness) / len(lateness):.0f} us, p99 '
+                f'{lateness[len(lateness) * 99 // 100]} us, max '
+                f'{lateness[-1]} us, {events} updates')
+        if count and not polling:
+            line += (f', {stats["samples"]} samples at '
+                     f'{stats["sample_us_mean"]:.0f} us')
+        print(line)
+
+
+def _ws_connect(port: int, path: str):
+    """Open a websocket to the local server (blocking)."""
+    sock = socket.socket()
+    sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+    sock.send(f'GET {path} HTTP/1.1\r\nUpgrade: websocket\r\n'
+              'Connection: Upgrade\r\n'
+              'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+              'Sec-WebSocket-Version: 13\r\n\r\n'.encode())
+    head = b''
+    while b'\r\n\r\n' not in head:
+        head += sock.recv(1024)
+    assert head.startswith(b'HTTP/1.1 101'), head
+    return sock
+
+
+def _ws_frame(payload: bytes) -> bytes:
+    # a masked binary frame, as a browser sends (a zero mask keeps it simple)
+    return bytes((0x82, 0x80 | len(payload))) + bytes(4) + payload
+
+
+def _writes() -> int:
+    return sum(sim.write_counts.values())
+
+
+def _wait_for_write(before: int, timeout_us: int = 1_000_000):
+    start = ticks_us()
+    while _writes() == before and ticks_diff(ticks_us(), start) < timeout_us:
+        time.sleep(0.0001)
+
+
+def _joystick_client(port: int, count: int, websocket: bool, results: list):
+    # end to end: from sending a leg target to the PWM write it causes
+    latencies = []
+    sock = _ws_connect(port, '/joystick') if websocket else None
+    for i in range(count):
+        x, y = 9 + (i % 10) / 10, (i % 7) / 10
+        before = _writes()
+        start = ticks_us()
+        if websocket:
+            sock.send(_ws_frame(b'L' + struct.pack('<Bhh', 1, int(x * 100),
+                                                   int(y * 100))))
+        else:
+            _form_post(port, '/set-leg', f'leg=1&x={x}&y={y}')
+        _wait_for_write(before)
+        latencies.append(ticks_diff(ticks_us(), start))
+        # a tick apart, so none of them are coalesced
+        time.sleep(0.025)
+
+    # then as fast as possible, for the sustained rate (until the worker has
+    # taken every command, one way or the other)
+    import main
+
+    worker = main.worker
+    taken = worker.latency_us.count + worker.coalesced + worker.rejected
+    start = ticks_us()
+    for i in range(count * 5):
+        x, y = 9 + (i % 10) / 10, (i % 7) / 10
+        if websocket:
+            sock.send(_ws_frame(b'L' + struct.pack('<Bhh', i % 4, int(x * 100),
+                                                   int(y * 100))))
+        else:
+            _form_post(port, '/set-leg', f'leg={i % 4}&x={x}&y={y}')
+            # and the browser follows the redirect back to the page
+            _request(port, '/')
+    while worker.latency_us.count + worker.coalesced + worker.rejected < \
+            taken + count * 5:
+        time.sleep(0.0001)
+    elapsed = ticks_diff(ticks_us(), start)
+    if websocket:
+        sock.close()
+    results.append((latencies, count * 5 * 1_000_000 / elapsed))
+
+
+def _form_post(port: int, path: str, form: str):
+    sock = socket.socket()
+    sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+    sock.send(f'POST {path} HTTP/1.0\r\n'
+              'Content-Type: application/x-www-form-urlencoded\r\n'
+              f'Content-Length: {len(form)}\r\n\r\n{form}'.encode())
+    while sock.recv(1024):
+        pass
+    sock.close()
+
+
+async def _joystick(port: int, count: int, websocket: bool):
+    import main
+
+    main.worker.start()
+    main.worker.reset_stats()
+    main.worker.rejected = 0
+    main.worker.coalesced = 0
+    server = asyncio.create_task(main.app.start_server(port=port))
+    await asyncio.sleep(0.2)
+
+    results = []
+    _thread.start_new_thread(_joystick_client,
+                             (port, count, websocket, results))
+    while not results:
+        await asyncio.sleep(0.05)
+    stats = main.worker.stats()
+
+    main.app.shutdown()
+    await server
+    main.worker.shutdown()
+    await asyncio.sleep(0.05)
+    return results[0] + (stats,)
+
+
+def joystick(port=5088, count=50):
+    """Measure the time from a leg command to its servo write, and how many
+    commands a second can be sent, through the websocket joystick and the
+    form POST (needs the simulated backend, which counts the writes)."""
+    if not backend.SIMULATED:
+        print('joystick needs the simulated backend')
+        return
+
+    # the form route prints every request
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        runs = [(name, asyncio.run(_joystick(port, count, websocket)))
+                for name, websocket in (('form', False), ('websocket', True))]
+    finally:
+        sys.stdout = stdout
+    for name, (latencies, rate, stats) in runs:
+        latencies.sort()
+        print(f'{name}: mean {sum(latencies) / len(latencies) / 1000:.2f} ms, '
+              f'p90 {latencies[len(latencies) * 9 // 10] / 1000:.2f} ms to '
+              f'the servo write, {rate:.0f} commands/s sustained, '
+              f'{stats["rejected"]} dropped, {stats["coalesced"]} coalesced')
+
+
+def _binary_post(port: int, path: str, body: bytes) -> bytes:
+    sock = socket.socket()
+    sock.connect(socket.getaddrinfo('127.0.0.1', port)[0][-1])
+    sock.send(f'POST {path} HTTP/1.0\r\n'
+              'Content-Type: application/octet-stream\r\n'
+              f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    res = b''
+    while True:
+        chunk = sock.recv(1024)
+        if not chunk:
+            break
+        res += chunk
+    sock.close()
+    return res
+
+
+def _pose_client(port: int, count: int, binary: bool, results: list):
+    # four leg poses, with the time from the first leg's write to the last
+    # one's (how far from moving together the legs were)
+    spreads = []
+    for i in range(count):
+        x, y = 9 + (i % 10) / 10, (i % 7) / 10
+        sim.reset()
+        if binary:
+            _binary_post(port, '/set-leg', b''.join(
+                struct.pack(motion.POSE_RECORD, 0, leg, int(x * 100),
+                            int(y * 100)) for leg in range(4)))
+        else:
+            for leg in range(4):
+                _form_post(port, '/set-leg', f'leg={leg}&x={x}&y={y}')
+        # wait for all eight servos to be written
+        waited = ticks_us()
+        while len(sim.write_counts) < 8 and \
+                ticks_diff(ticks_us(), waited) < 100_000:
+            time.sleep(0.0001)
+        times = [t_us for t_us, pin, duty in sim.writes()]
+        spreads.append(max(times) - min(times) if times else 0)
+
+    # then as fast as possible, for the rate the commands are taken at (the
+    # worker only moves the legs once a tick, whichever way they come)
+    start = ticks_us()
+    for i in range(count):
+        if binary:
+            _binary_post(port, '/set-leg', b''.join(
+                struct.pack(motion.POSE_RECORD, 0, leg, 950, 120)
+                for leg in range(4)))
+        else:
+            for leg in range(4):
+                _form_post(port, '/set-leg', f'leg={leg}&x=9.5&y=1.2')
+    elapsed = ticks_diff(ticks_us(), start)
+    results.append((spreads, count * 4 * 1_000_000 / elapsed))
+
+
+async def _pose_batches(port: int, count: int, binary: bool):
+    import main
+
+    main.worker.start()
+    server = asyncio.create_task(main.app.start_server(port=port))
+    await asyncio.sleep(0.2)
+    results = []
+    _thread.start_new_thread(_pose_client, (port, count, binary, results))
+    while not results:
+        await asyncio.sleep(0.05)
+    main.app.shutdown()
+    await server
+    main.worker.shutdown()
+    await asyncio.sleep(0.05)
+    return results[0]
+
+
+def pose_batches(port=5089, count=50, parses=2000):
+    """Compare moving all four legs with one binary /set-leg batch and with
+    four form posts: the cost of parsing the commands, leg commands per
+    second, and how far apart the legs' first and last servo writes are
+    (needs the simulated backend)."""
+    if not backend.SIMULATED:
+        print('pose_batches needs the simulated backend')
+        return
+
+    batch = b''.join(struct.pack(motion.POSE_RECORD, 0, leg, 950, 120)
+                     for leg in range(4))
+    forms = [f'leg={leg}&x=9.5&y=1.2' for leg in range(4)]
+    req = microdot.Request(None, None, 'GET', '/', '1.1',
+                           microdot.NoCaseDict())
+    unit = 'bytes' if hasattr(gc, 'mem_alloc') else 'blocks kept'
+    for name, parse in (
+            ('form', lambda: [(int(form['leg']),
+                               (float(form['x']), float(form['y'])))
+                              for form in map(req._parse_urlencoded, forms)]),
+            ('binary', lambda: motion.unpack_poses(batch, 4))):
+        parsed = []
+        gc.collect()
+        gc.disable()
+        allocated = _allocated()
+        start = ticks_us()
+        for _ in range(parses):
+            parsed.append(parse())
+        elapsed = ticks_diff(ticks_us(), start)
+        allocated = _allocated() - allocated
+        gc.enable()
+        print(f'{name} parse: {elapsed / parses:.1f} us, '
+              f'{allocated / parses:.1f} {unit} per four leg pose')
+
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        runs = [(name, asyncio.run(_pose_batches(port, count, binary)))
+                for name, binary in (('form', False), ('binary', True))]
+    finally:
+        sys.stdout = stdout
+    for name, (spreads, rate) in runs:
+        spreads.sort()
+        print(f'{name}: {rate:.0f} leg commands/s, legs written '
+              f'{sum(spreads) / len(spreads) / 1000:.2f} ms apart on average '
+              f'(worst {spreads[-1] / 1000:.2f} ms)')
+
+
+async def _sensor_loop(sensor, sampler, seconds: float, engine):
+    # a 50 Hz control loop sharing the event loop with the sensor
+    lateness = []
+    task = None
+    if sampler is not None:
+        task = asyncio.create_task(sampler.run())
+    else:
+        async def blocking_reads():
+            # what reading the sensor on the event loop does
+            while True:
+                sensor.read()
+                await asyncio.sleep(0)
+        task = asyncio.create_task(blocking_reads())
+    await _control_loop(engine, seconds, lateness)
+    if sampler is not None:
+        sampler.stop()
+    task.cancel()
+    await asyncio.sleep(0.05)
+    return lateness
+
+
+def _filter_error(sensor, sampler, distance: float, steps: int) -> float:
+    # the rms error of the sampler's distance, reading as fast as it can
+    total = 0
+    for _ in range(steps):
+        sampler.step()
+        if sampler.distance is None:
+            # as wrong as can be
+            total += distance * distance
+        else:
+            total += (sampler.distance - distance) ** 2
+    return math.sqrt(total / steps)
+
+
+def dist_sampling(distance=4, noise=100, seconds=2, steps=500):
+    """Compare reading a (simulated) distance sensor with the blocking
+    DistSensor.read and with a DistSampler: distances per second and the
+    longest gap between ticks of a 50 Hz control loop on the same event loop,
+    then how close each of the sampler's filters gets to the true distance
+    through noisy readings.
+    """
+    if not backend.SIMULATED:
+        print('dist_sampling needs the simulated backend')
+        return
+
+    sim.set_obstacle(26, 15, distance, noise=noise)
+    legs = [Leg(Servo(i*2), 4, Servo(i*2 + 1), 8, i % 2) for i in range(4)]
+    engine = gait.GaitEngine(legs, gait.Gait('trot'))
+    sensor = hardware.DistSensor(26, 15)
+    period_us = engine.period_ms * 1000
+
+    for name, sampler in (('blocking read', None),
+                          ('sampler', hardware.DistSampler(sensor))):
+        start = ticks_us()
+        if sampler is None:
+            readings = [0]
+            read = sensor.read
+
+            def counting_read():
+                readings[0] += 1
+                return read()
+            sensor.read = counting_read
+            # every tick waits for a read, so don't wait for as many
+            lateness = asyncio.run(_sensor_loop(sensor, None, seconds / 10,
+                                                engine))
+            del sensor.read
+            count = readings[0]
+        else:
+            lateness = asyncio.run(_sensor_loop(sensor, sampler, seconds,
+                                                engine))
+            # the first reading only primes the pipeline
+            count = sampler.count - 1
+        elapsed = ticks_diff(ticks_us(), start)
+        gap = max(period_us + lateness[i] - lateness[i - 1]
+                  for i in range(1, len(lateness)))
+        print(f'{name}: {count * 1_000_000 / elapsed:.1f} distances/s, '
+              f'longest gap between control ticks {gap / 1000:.1f} ms')
+
+    print(f'rms error at {distance} with noise {noise}:')
+    for name, sampler in [
+            ('unfiltered', hardware.DistSampler(sensor, filter='mean',
+                                                window=1))] + [
+            (name, hardware.DistSampler(sensor, filter=name))
+            for name in hardware.DistSampler.FILTERS]:
+        sensor.led.on()
+        error = _filter_error(sensor, sampler, distance, steps)
+        print(f'  {name}: {error:.2f}')
+    sensor.led.off()
+    del sim.sensors[26]
+
+
+async def _run_samplers(samplers, seconds: float):
+    tasks = [asyncio.create_task(sampler.run()) for sampler in samplers]
+    await asyncio.sleep(seconds)
+    for sampler in samplers:
+        sampler.stop()
+    await asyncio.gather(*tasks)
+
+
+def sensor_array(counts=(1, 2, 4, 8), seconds=1, reads=2000):
+    """Compare reading several (simulated) distance sensors one blocking
+    read at a time, with a DistSampler each, and with one SensorArray scan:
+    distances per second across all the sensors, and what a burst of reads
+    costs next to the time a bare ADC read takes.
+    """
+    if not backend.SIMULATED:
+        print('sensor_array needs the simulated backend')
+        return
+
+    for i in range(max(counts)):
+        sim.set_obstacle(26 + i, 15 + i, 3 + i, noise=50)
+    sensors = [hardware.DistSensor(26 + i, 15 + i) for i in range(max(counts))]
+
+    read = sensors[0].ldr.read_u16
+    start = ticks_us()
+    for _ in range(reads):
+        read()
+    read_us = ticks_diff(ticks_us(), start) / reads
+    print(f'one ADC read: {read_us:.2f} us')
+
+    for count in counts:
+        group = sensors[:count]
+        # blocking reads, one after another (a single round is enough)
+        start = ticks_us()
+        for sensor in group:
+            sensor.read()
+        blocking = count * 1_000_000 / ticks_diff(ticks_us(), start)
+
+        samplers = [hardware.DistSampler(sensor) for sensor in group]
+        asyncio.run(_run_samplers(samplers, seconds))
+        separate = sum(sampler.count - 1 for sampler in samplers) / seconds
+        wakeups = sum(sampler.late_us.count for sampler in samplers) / seconds
+
+        array = hardware.SensorArray(group)
+        asyncio.run(_run_samplers([array], seconds))
+        scanned = count * (array.count - 1) / seconds
+        stats = array.stats()
+        print(f'{count} sensors: {blocking:.1f} distances/s blocking, '
+              f'{separate:.0f} with a sampler each ({wakeups:.0f} wakeups/s), '
+              f'{scanned:.0f} scanned together '
+              f'({array.late_us.count / seconds:.0f} wakeups/s, '
+              f'{stats["burst_us_last"]} us bursts of '
+              f'{count * array.oversample} reads)')
+    for i in range(max(counts)):
+        del sim.sensors[26 + i]
+
+
+async def _obstacle_reaction(trials: int, distance: float):
+    legs = [Leg(Servo(i*2), 4, Servo(i*2 + 1), 8, i % 2) for i in range(4)]
+    engine = gait.GaitEngine(legs, gait.Gait('trot'))
+    worker = motion.MotionWorker(engine)
+    sensors = [hardware.DistSensor(26 + i, 15 + i) for i in range(2)]
+    for i in range(2):
+        sim.set_obstacle(26 + i, 15 + i, None)
+    array = hardware.SensorArray(sensors)
+    avoider = behaviour.ObstacleAvoider(worker, sensors)
+
+    # note when the sensors first see the obstacle, and when each gait tick
+    # starts (the targets for a tick are worked out just before it)
+    detected = [None]
+    step = array.step
+
+    def noting_step():
+        step()
+        nearest = avoider.nearest()
+        if detected[0] is None and nearest is not None and \
+                nearest <= avoider.stop_distance:
+            detected[0] = ticks_us()
+    array.step = noting_step
+    ticks = []
+    tick = engine.tick
+
+    def noting_tick(targets):
+        ticks.append(ticks_us())
+        tick(targets)
+    engine.tick = noting_tick
+
+    worker.start()
+    worker.submit(motion.MotionWorker.WALK)
+    tasks = [asyncio.create_task(array.run()),
+             asyncio.create_task(avoider.run())]
+    results = []
+    for _ in range(trials):
+        await asyncio.sleep(0.3)
+        detected[0] = None
+        appeared = ticks_us()
+        sim.set_obstacle(27, 16, distance, noise=50)
+        while avoider.state != behaviour.ObstacleAvoider.STOP:
+            await asyncio.sleep(0.001)
+        changed = avoider.changed_us
+        while not ticks or ticks_diff(ticks[-1], changed) < 0:
+            await asyncio.sleep(0.001)
+        moved = next(t for t in ticks if ticks_diff(t, changed) >= 0)
+        while avoider.state != behaviour.ObstacleAvoider.TURN:
+            await asyncio.sleep(0.001)
+        turning = avoider.changed_us
+        results.append((ticks_diff(detected[0], appeared),
+                        ticks_diff(changed, detected[0]),
+                        ticks_diff(moved, changed),
+                        ticks_diff(moved, appeared),
+                        ticks_diff(turning, appeared), engine.gait.steer))
+        sim.set_obstacle(27, 16, None)
+        while avoider.state != behaviour.ObstacleAvoider.CLEAR:
+            await asyncio.sleep(0.001)
+        del ticks[:]
+
+    for task in tasks:
+        task.cancel()
+    worker.shutdown()
+    await asyncio.sleep(0.05)
+    for i in range(2):
+        del sim.sensors[26 + i]
+    return results, avoider.stats(), array.stats()
+
+
+def obstacle_reaction(trials=5, distance=3):
+    """Walk (simulated) into an obstacle in front of the right sensor and
+    time the reaction: from the obstacle appearing to the sensors seeing it,
+    to the avoider stopping the walk, to the first gait tick with the new
+    stride, and to starting to turn away."""
+    if not backend.SIMULATED:
+        print('obstacle_reaction needs the simulated backend')
+        return
+
+    results, stats, sensors = asyncio.run(_obstacle_reaction(trials,
+                                                             distance))
+    for i, name in enumerate(('sensed', 'decided', 'servos changed')):
+        times = [result[i] for result in results]
+        print(f'{name}: mean {sum(times) / len(times) / 1000:.1f} ms, '
+              f'max {max(times) / 1000:.1f} ms')
+    totals = [result[3] for result in results]
+    print(f'obstacle to servos changed: mean '
+          f'{sum(totals) / len(totals) / 1000:.1f} ms, max '
+          f'{max(totals) / 1000:.1f} ms; turning (gait steer '
+          f'{results[0][5]}) after {results[0][4] / 1000:.0f} ms')
+    print(f'avoider: {stats["iterations"]} iterations, mean '
+          f'{stats["iteration_us_mean"]:.0f} us, max '
+          f'{stats["iteration_us_max"]} us, up to '
+          f'{stats["late_us_max"] / 1000:.0f} ms late; sensor readings up to '
+          f'{sensors["late_max_us"] / 1000:.1f} ms late')
+
+
+def _count_writes(plan, output: PWMOutput, cycles: int, batch: bool):
+    """Push a plan's writes through an output as fast as possible (no waiting)
+    and count what reaches the PWMs."""
+    for _ in range(cycles):
+        last_t = -1
+        for t_ms, index, duty in plan.entries():
+            if batch and t_ms != last_t:
+                output.flush()
+                output.begin()
+                last_t = t_ms
+            output.write(index, duty)
+        output.flush()
+    return output.writes
+
+
+def pwm_writes(cycles=5):
+    """Count the PWM writes main's walk and dance make with and without the
+    coalescing output layer."""
+    import main
+
+    for name in ('walk', 'dance'):
+        plan = main.PLANS[name]
+        counts = []
+        for coalesce in (False, True):
+            output = PWMOutput(coalesce=coalesce)
+            for i in range(8):
+                pwm = backend.machine.PWM(backend.machine.Pin(i))
+                pwm.freq(50)
+                output.channel(pwm)
+            counts.append(_count_writes(plan, output, cycles, coalesce))
+        print(f'{name} x{cycles}: {counts[0]} writes before, '
+              f'{counts[1]} after')
+
+
+def gait_budget(ticks=500, budget=0.5):
+    """Measure what a gait engine tick costs (ik for all four legs plus the
+    servo writes), with and without ik tables, and the fastest gait period
+    that fits in the CPU budget.
+    """
+    for use_table in (False, True):
+        legs = [Leg(Servo(i*2), 4, Servo(i*2 + 1), 8, i % 2) for i in range(4)]
+        if use_table:
+            for leg in legs:
+                leg.use_ik_table()
+        engine = gait.GaitEngine(legs, gait.Gait('trot'))
+        targets = gait.foot_targets(engine.gait, engine.rate_hz)
+        for _ in range(ticks):
+            engine.tick(next(targets)[1])
+        stats = engine.stats()
+        print(f'{"table" if use_table else "analytic"}: mean '
+              f'{stats["mean_us"]:.1f} us, max {stats["max_us"]} us per tick, '
+              f'{stats["unreachable"]} unreachable, min period '
+              f'{engine.min_period(budget):.3f} s at {budget:.0%} cpu')
+
+
+def _spawned_pose(leg, target, submitted, latencies):
+    leg.move_to_fast(target)
+    latencies.append(ticks_diff(ticks_us(), submitted))
+
+
+def worker_latency(commands=50):
+    """Measure the time from a command to its first PWM write, for the
+    long-lived MotionWorker and for starting a thread per command (how
+    walking used to be started)."""
+    legs = [Leg(Servo(i*2), 4, Servo(i*2 + 1), 8, i % 2) for i in range(4)]
+    engine = gait.GaitEngine(legs, gait.Gait('trot'))
+    worker = motion.MotionWorker(engine)
+    worker.start()
+    # walks start from idle, where the thread is woken straight away; poses
+    # come in while walking, where it checks between ticks
+    by_state = {motion.MotionWorker.IDLE: [], motion.MotionWorker.WALKING: []}
+    for i in range(commands):
+        state = worker.state
+        if i % 2:
+            worker.submit(motion.MotionWorker.WALK)
+        else:
+            worker.submit(motion.MotionWorker.POSE, i % 4, (10, i % 3))
+        time.sleep(0.03)
+        by_state[state].append(worker.latency_us.last)
+    worker.submit(motion.MotionWorker.STOP)
+    worker.shutdown()
+    stats = worker.stats()
+    print(f'worker: mean {stats["latency_mean_us"]:.0f} us, '
+          f'max {stats["latency_max_us"]} us')
+    for state, latencies in by_state.items():
+        print(f'  from {state}: mean {sum(latencies) / len(latencies):.0f} '
+              f'us, max {max(latencies)} us')
+
+    latencies = []
+    for i in range(commands):
+        _thread.start_new_thread(
+            _spawned_pose, (legs[i % 4], (10, i % 3), ticks_us(), latencies))
+        time.sleep(0.03)
+    print(f'thread per command: mean {sum(latencies) / len(latencies):.0f} '
+          f'us, max {max(latencies)} us')
+
+
+def suite():
+    """Run every benchmark"""
+    for bench in (ik_accuracy, ik_table, trajectory, interpolation,
+                  gait_budget, plan_jitter, pwm_writes, worker_latency,
+                  motion_latency, routing, request_parsing,
+                  response_writes, file_transfer, http_throughput,
+                  static_page, handler_load, connection_limits,
+                  request_metrics, telemetry_jitter, joystick,
+                  pose_batches, dist_sampling, sensor_array,
+                  obstacle_reaction):
+        print(f'--- {bench.__name__}')
+        bench()
+
+
+if __name__ == '__main__':
+    suite()
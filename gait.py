@@ -0,0 +1,294 @@
+"""Parametric gaits for the robot dog. A Gait describes how every foot moves
+through one cycle (stance on the ground pushing back, then swing lifted and
+forward), and foot_targets streams the foot positions for all legs tick by
+tick, which GaitEngine turns into servo moves.
+"""
+
+import math
+
+from hardware import (Leg, TimingStats, servo_output, ticks_ms, ticks_us,
+                      ticks_add, ticks_diff, sleep_ms, async_sleep_ms)
+
+# the fewest control ticks a cycle can be split into and still look smooth
+MIN_TICKS_PER_CYCLE = 20
+
+
+class Gait(object):
+    """The shape and timing of a gait. Positions are in the same (x, y) leg
+    coordinates Leg.move_to_fast takes: x is how far the foot is from the hip
+    (so lifting a foot makes x smaller) and y is fore/aft.
+    """
+    # duty factor and per-leg phase offsets (in main.legs order: back right,
+    # front right, front left, back left) for the built in gaits
+    PRESETS = {
+        # back left, front left, back right, front right, with sometimes two
+        # feet up
+        'walk': (0.6, (0.5, 0.75, 0.25, 0)),
+        # diagonal pairs together
+        'trot': (0.5, (0, 0.5, 0, 0.5)),
+        # the walk's order, but never more than one foot up
+        'crawl': (0.85, (0.5, 0.75, 0.25, 0)),
+    }
+
+    def __init__(self, kind: str = 'walk', period: float = 2.0,
+                 stride: float = 3, height: float = 2.3,
+                 ground: float = 10.5, center: float = 1.5,
+                 turn: float = 0):
+        """Create a gait from one of the presets.
+        :param kind: the preset to start from (see PRESETS)
+        :param period: the time in seconds for one full cycle
+        :param stride: how far each foot moves fore/aft per cycle
+        :param height: how far each foot lifts while swinging forward
+        :param ground: the x of a foot on the ground
+        :param center: the y in the middle of the stride
+        :param turn: how much further the left feet move than the stride each
+        cycle (and the right feet less), so positive turns right; with no
+        stride the dog turns on the spot
+        """
+        self.kind = kind
+        self.duty_factor, self.phases = self.PRESETS[kind]
+        self.period = period
+        self.stride = stride
+        self.height = height
+        self.ground = ground
+        self.center = center
+        self.turn = turn
+        # set by behaviours (see behaviour.ObstacleAvoider) on top of what's
+        # been asked for, so they never overwrite it: the stride is scaled by
+        # speed, and a steer other than 0 is used instead of the turn
+        self.speed = 1.0
+        self.steer = 0
+        # the joystick's share of the speed, from -1 (full speed backwards)
+        # to 1, kept apart from the behaviours' so neither undoes the other
+        self.throttle = 1.0
+        # the shortest period update accepts (a GaitEngine raises it to what
+        # its control rate can manage)
+        self.min_period = 0
+
+    def update(self, params: dict):
+        """Change the gait's parameters (for example from a web request).
+        Picking a `kind` resets the duty factor and phases to its preset.
+        Nothing changes if any of the parameters are bad.
+        :param params: a dict with any of the constructor's parameters, plus
+        duty_factor and phases
+        """
+        new = self.to_dict()
+        if 'kind' in params:
+            if params['kind'] not in self.PRESETS:
+                raise ValueError('unknown gait')
+            new['kind'] = params['kind']
+            new['duty_factor'], new['phases'] = self.PRESETS[new['kind']]
+
+        for name in ('period', 'stride', 'height', 'ground', 'center',
+                     'duty_factor', 'turn'):
+            if name in params:
+                new[name] = float(params[name])
+        if 'phases' in params:
+            phases = params['phases']
+            if isinstance(phases, str):
+                # from a form, as "0,0.5,0,0.5"
+                phases = phases.split(',')
+            new['phases'] = tuple(float(phase) for phase in phases)
+
+        if len(new['phases']) != len(self.phases):
+            raise ValueError('need a phase for every leg')
+        # nan and inf get past the range checks below, then break the tick
+        for name in ('period', 'stride', 'height', 'ground', 'center',
+                     'duty_factor', 'turn'):
+            if not math.isfinite(new[name]):
+                raise ValueError('{} must be a number'.format(name))
+        for phase in new['phases']:
+            if not math.isfinite(phase):
+                raise ValueError('phases must be numbers')
+        if new['period'] <= 0:
+            raise ValueError('period must be positive')
+        if new['period'] < self.min_period:
+            raise ValueError('period must be at least {} s'.format(
+                self.min_period))
+        if not 0 < new['duty_factor'] < 1:
+            raise ValueError('duty factor must be between 0 and 1')
+
+        for name, value in new.items():
+            setattr(self, name, value)
+        self.phases = tuple(self.phases)
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'period': self.period,
+            'duty_factor': self.duty_factor,
+            'phases': list(self.phases),
+            'stride': self.stride,
+            'height': self.height,
+            'ground': self.ground,
+            'center': self.center,
+            'turn': self.turn,
+        }
+
+    def current_stride(self) -> float:
+        """The stride being walked (the gait's, scaled by speed and
+        throttle)"""
+        return self.stride * self.speed * self.throttle
+
+    def current_turn(self) -> float:
+        """The turn being made (the steer, if there is one)"""
+        return self.steer or self.turn
+
+    def foot(self, phase: float, stride: float = None) -> tuple[float, float]:
+        """Get where a foot should be at a point in its cycle.
+        :param phase: how far through the cycle the foot is (0 to 1, starting
+        when it touches down)
+        :param stride: the foot's stride, if not the current one (see
+        side_stride)
+        :return: the (x, y) target for the foot
+        """
+        if stride is None:
+            stride = self.current_stride()
+        phase %= 1
+        half = stride / 2
+        if phase < self.duty_factor:
+            # on the ground, pushing back
+            t = phase / self.duty_factor
+            return self.ground, self.center + half - stride*t
+        # in the air, coming forward
+        t = (phase - self.duty_factor) / (1 - self.duty_factor)
+        return (self.ground - self.height*math.sin(math.pi*t),
+                self.center - half + stride*t)
+
+    def side_stride(self, side: int) -> float:
+        """Get the stride for the feet on one side, allowing for the turn.
+        :param side: the side (see hardware.Leg.Side)
+        """
+        if side == Leg.Side.Left:
+            return self.current_stride() + self.current_turn()
+        return self.current_stride() - self.current_turn()
+
+
+def foot_targets(gait: Gait, rate_hz: int = 50, sides=None):
+    """Stream the foot targets for every leg, one tick at a time, forever.
+    Changes to the gait take effect on the next tick.
+    :param gait: the gait to follow
+    :param rate_hz: the number of ticks per second
+    :param sides: the side of each leg (see hardware.Leg.Side), for turning;
+    without them the gait goes straight
+    :return: a generator of (phase, targets) where targets has one (x, y) per
+    leg
+    """
+    phase = 0.0
+    while True:
+        if sides is None or not gait.current_turn():
+            targets = tuple(gait.foot(phase + offset)
+                            for offset in gait.phases)
+        else:
+            targets = tuple(gait.foot(phase + offset, gait.side_stride(side))
+                            for offset, side in zip(gait.phases, sides))
+        yield phase, targets
+        phase = (phase + 1 / (gait.period * rate_hz)) % 1
+
+
+class GaitEngine(object):
+    """Drives legs along a gait at a fixed control rate, keeping count of how
+    long each tick (ik plus servo writes) takes, to know how fast the gait
+    can be made to go.
+    """
+    def __init__(self, legs, gait: Gait, rate_hz: int = 50, output=None):
+        """Create a gait engine.
+        :param legs: the legs to move, in the order the gait's phases are for
+        :param gait: the gait to follow
+        :param rate_hz: the number of control ticks per second
+        :param output: the hardware.PWMOutput to flush once per tick
+        (servo_output if not given)
+        """
+        self.legs = legs
+        self.gait = gait
+        self.rate_hz = rate_hz
+        self.period_ms = 1000 // rate_hz
+        self.output = output or servo_output
+        # how far through the cycle the gait is
+        self.phase = 0.0
+        # a cycle needs enough ticks to look smooth, whatever the gait asks
+        gait.min_period = MIN_TICKS_PER_CYCLE / rate_hz
+        self.tick_us = TimingStats()
+        self.unreachable = 0
+
+    def reset_stats(self):
+        """Clear the tick timing counters"""
+        self.tick_us.reset()
+        self.unreachable = 0
+
+    def stats(self):
+        """Get the tick timing counters
+        :return: a dict with the tick count, last/max/mean tick cost in
+        microseconds, and how many foot targets couldn't be reached
+        """
+        tick_us = self.tick_us
+        return {
+            'ticks': tick_us.count,
+            'last_us': tick_us.last,
+            'max_us': tick_us.max,
+            'mean_us': tick_us.mean(),
+            'unreachable': self.unreachable,
+        }
+
+    def min_period(self, budget: float = 0.5,
+                   ticks_per_cycle: int = MIN_TICKS_PER_CYCLE):
+        """Get the shortest gait period that fits both the measured tick cost
+        and the engine's control rate.
+        :param budget: the fraction of CPU time the gait may use
+        :param ticks_per_cycle: the fewest ticks a cycle can be split into and
+        still look smooth
+        :return: the period in seconds (or None if nothing's been measured)
+        """
+        if not self.tick_us.count:
+            return None
+        mean_us = max(self.tick_us.mean(), 1)
+        # the fastest control rate that stays within budget
+        max_rate_hz = budget * 1_000_000 / mean_us
+        # however cheap the ticks, they only come at the engine's rate
+        return ticks_per_cycle / min(max_rate_hz, self.rate_hz)
+
+    def targets(self):
+        """Start streaming foot targets for the engine's gait and rate (see
+        foot_targets)"""
+        return foot_targets(self.gait, self.rate_hz,
+                            [leg.side for leg in self.legs])
+
+    def tick(self, targets):
+        """Move every leg to its target for this tick"""
+        start = ticks_us()
+        self.output.begin()
+        for leg, target in zip(self.legs, targets):
+            if not leg.move_to_fast(target):
+                self.unreachable += 1
+        self.output.flush()
+        self.tick_us.record(ticks_diff(ticks_us(), start))
+
+    def run(self, keep_going=None):
+        """Walk, blocking.
+        :param keep_going: a function called every tick; the gait stops once
+        it returns False (runs forever if not given)
+        """
+        start = ticks_ms()
+        count = 0
+        for phase, targets in self.targets():
+            self.phase = phase
+            self.tick(targets)
+            count += 1
+            if keep_going is not None and not keep_going():
+                break
+            wait = ticks_diff(ticks_add(start, count * self.period_ms),
+                              ticks_ms())
+            if wait > 0:
+                sleep_ms(wait)
+
+    async def run_async(self):
+        """Walk without blocking the event loop, until cancelled."""
+        start = ticks_ms()
+        count = 0
+        for phase, targets in self.targets():
+            self.phase = phase
+            self.tick(targets)
+            count += 1
+            wait = ticks_diff(ticks_add(start, count * self.period_ms),
+                              ticks_ms())
+            await async_sleep_ms(max(wait, 0))
@@ -1,16 +1,310 @@
 """Hardware abstractions for a robot dog"""
 
-import machine
+import asyncio
+import backend
+import json
 import math
 import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # no numpy on the pico, so batches get solved in a plain loop
+    numpy = None
+
+try:
+    from time import ticks_ms, ticks_us, ticks_add, ticks_diff, sleep_ms
+except ImportError:
+    # CPython doesn't have the MicroPython tick functions
+    def ticks_ms():
+        return time.perf_counter_ns() // 1_000_000
+
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(end, start):
+        return end - start
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+try:
+    async_sleep_ms = asyncio.sleep_ms
+except AttributeError:
+    # CPython's asyncio only sleeps in seconds
+    def async_sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+try:
+    from sys import print_exception
+except ImportError:
+    # CPython prints tracebacks with the traceback module
+    import traceback
+
+    def print_exception(exc):
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+
+def next_due(due: int, period_ms: int) -> tuple[int, int]:
+    """Work out when a loop that runs at a fixed rate should go next.
+    :param due: when the loop was last due (see ticks_ms)
+    :param period_ms: the time between runs
+    :return: when the next run is due, and how many milliseconds to wait
+    until then (if the loop has fallen behind that's now, rather than a burst
+    of runs to catch up)
+    """
+    due = ticks_add(due, period_ms)
+    wait = ticks_diff(due, ticks_ms())
+    if wait < 0:
+        return ticks_ms(), 0
+    return due, wait
+
+
+class TimingStats(object):
+    """Running counters for something timed over and over (a control tick, a
+    command's latency), in microseconds, for the loops' stats.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear the counters"""
+        self.count = 0
+        self.last = 0
+        self.max = 0
+        self.total = 0
+
+    def record(self, us: int):
+        """Count one more timing"""
+        self.count += 1
+        self.last = us
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def mean(self) -> float:
+        """The mean of the timings so far (0 if there aren't any)"""
+        return self.total / self.count if self.count else 0
+
+
+class PWMOutput(object):
+    """Sits between servos and the PWM peripherals, remembering the last duty
+    written to each channel so writes that wouldn't change anything are
+    skipped. Duties are rounded to what the hardware can actually produce, and
+    between begin() and flush() writes are held so each channel gets at most
+    one write per control tick.
+    """
+    def __init__(self, resolution_ns: int = 305, coalesce: bool = True):
+        """Create an output layer.
+        :param resolution_ns: the duty step the PWM can actually make (at 50Hz
+        the pico's 16 bit counter steps every 20ms / 65536 = 305ns)
+        :param coalesce: whether to skip repeated duties at all (turning it off
+        is only useful for comparison)
+        """
+        self.resolution_ns = resolution_ns
+        self.coalesce = coalesce
+        self.pwms = []
+        # the last duty written to each channel (-1 for never)
+        self.last = array('i')
+        # the duty waiting to be written to each channel (-1 for none)
+        self.pending = array('i')
+        self.batching = False
+
+        # counters, for seeing how much is being saved
+        self.writes = 0
+        self.skipped = 0
+
+    def channel(self, pwm):
+        """Add a PWM peripheral to the output.
+        :param pwm: the PWM (it should already have its frequency set)
+        :return: a channel that can be used in place of the PWM
+        """
+        self.pwms.append(pwm)
+        self.last.append(-1)
+        self.pending.append(-1)
+        return _PWMChannel(self, len(self.pwms) - 1)
+
+    def write(self, index: int, duty: int):
+        """Write a duty to a channel (or hold it, if batching)"""
+        res = self.resolution_ns
+        duty = (duty + res//2) // res * res
+        if self.batching:
+            self.pending[index] = duty
+        else:
+            self._commit(index, duty)
+
+    def _commit(self, index: int, duty: int):
+        if self.coalesce and self.last[index] == duty:
+            self.skipped += 1
+            return
+        self.pwms[index].duty_ns(duty)
+        self.last[index] = duty
+        self.writes += 1
+
+    def begin(self):
+        """Start holding writes until the next flush"""
+        self.batching = True
+
+    def flush(self):
+        """Write out every held duty and stop holding writes"""
+        pending = self.pending
+        for i in range(len(pending)):
+            if pending[i] >= 0:
+                self._commit(i, pending[i])
+                pending[i] = -1
+        self.batching = False
+
+    def reset_stats(self):
+        """Clear the write counters"""
+        self.writes = 0
+        self.skipped = 0
+
+
+class _PWMChannel(object):
+    """One channel of a PWMOutput, which looks like a machine.PWM to servos"""
+    def __init__(self, output: PWMOutput, index: int):
+        self.output = output
+        self.index = index
+
+    def freq(self, *args):
+        return self.output.pwms[self.index].freq(*args)
+
+    def duty_ns(self, value=None):
+        if value is None:
+            return self.output.pwms[self.index].duty_ns()
+        self.output.write(self.index, value)
+
+
+class Calibration(object):
+    """How a particular servo's angle maps to PWM duty: a piecewise-linear
+    curve through measured (angle, duty) points, with angle limits. It is
+    compiled into an integer table indexed by tenths of a degree, so looking
+    up a duty is just an index.
+    """
+    # table entries per degree
+    STEPS = 10
+    # the table stores duties in units of this many nanoseconds, so they fit
+    # in 16 bits (up to ~3.3ms, well past what servos take)
+    UNIT_NS = 50
+
+    # compiled calibrations, keyed by (points, min_angle, max_angle)
+    _cache = {}
+
+    def __init__(self, points, min_angle: float = -90, max_angle: float = 90):
+        """Compile a calibration.
+        :param points: (angle in degrees, duty in nanoseconds) pairs, at least
+        two, which the curve goes through (and carries on past, in a straight
+        line, at the ends)
+        :param min_angle: the lowest angle the servo may be sent to
+        :param max_angle: the highest angle the servo may be sent to
+        """
+        points = sorted((float(a), float(d)) for a, d in points)
+        if len(points) < 2:
+            raise ValueError('calibration needs at least two points')
+        if min_angle >= max_angle:
+            raise ValueError('calibration limits are backwards')
+        self.points = points
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+        self.first = int(round(min_angle * self.STEPS))
+        count = int(round(max_angle * self.STEPS)) - self.first + 1
+
+        self.table = array('H', bytes(2 * count))
+        segment = 0
+        for i in range(count):
+            angle = (self.first + i) / self.STEPS
+            # move on to the segment this angle is in (or keep using the
+            # last one, past the end)
+            while (segment < len(points) - 2 and
+                   angle > points[segment + 1][0]):
+                segment += 1
+            a0, d0 = points[segment]
+            a1, d1 = points[segment + 1]
+            duty = d0 + (d1 - d0) * (angle - a0) / (a1 - a0)
+            units = int(duty / self.UNIT_NS + 0.5)
+            if not 0 <= units <= 0xffff:
+                raise ValueError('calibrated duty out of range')
+            self.table[i] = units
+
+    @classmethod
+    def get(cls, points, min_angle: float = -90, max_angle: float = 90):
+        """Get a compiled calibration, sharing tables between servos that have
+        the same calibration."""
+        key = (tuple(tuple(point) for point in points), min_angle, max_angle)
+        calibration = cls._cache.get(key)
+        if calibration is None:
+            calibration = cls(points, min_angle, max_angle)
+            cls._cache[key] = calibration
+        return calibration
+
+    def clamp(self, angle: float) -> float:
+        """Limit an angle to what the servo may be sent to"""
+        if angle < self.min_angle:
+            return self.min_angle
+        if angle > self.max_angle:
+            return self.max_angle
+        return angle
+
+    def duty_for(self, angle: float) -> int:
+        """Get the duty (in nanoseconds) for an angle, clamped to the limits"""
+        # offset before rounding, so int() only ever truncates positives
+        i = int(angle*self.STEPS - self.first + 0.5)
+        if i < 0:
+            i = 0
+        elif i >= len(self.table):
+            i = len(self.table) - 1
+        return self.table[i] * self.UNIT_NS
+
+
+def load_calibrations(filename: str = 'calibration.json') -> dict:
+    """Load servo calibrations from a JSON file, which maps pin numbers to
+    {"points": [[angle, duty_ns], ...], "min": angle, "max": angle}.
+    :param filename: the file to load
+    :return: a dict of pin number to Calibration (empty if there's no file).
+    A bad file or profile is reported and left out, so those servos get the
+    default line rather than the dog not booting.
+    """
+    try:
+        with open(filename) as f:
+            profiles = json.load(f)
+    except OSError:
+        return {}
+    except ValueError as e:
+        print('{}: not valid JSON ({}), using default calibrations'.format(
+            filename, e))
+        return {}
+    if not isinstance(profiles, dict):
+        print('{}: not a map of pins, using default calibrations'.format(
+            filename))
+        return {}
+
+    calibrations = {}
+    for pin, profile in profiles.items():
+        try:
+            calibrations[int(pin)] = Calibration.get(
+                profile['points'], profile.get('min', -90),
+                profile.get('max', 90))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print('{}: bad calibration for pin {} ({!r}), using the '
+                  'default'.format(filename, pin, e))
+    return calibrations
 
 
 class Servo(object):
     """A simple servo abstraction that makes it easier to conrol movements.
     Angles are in degrees."""
-    def __init__(self, pin: int):
+    def __init__(self, pin: int, output: PWMOutput = None,
+                 calibration: Calibration = None):
         """Initialize a servo object
         :param pin: The GPIO pin number that controls the pwm of the servo
+        :param output: The PWMOutput to write through (servo_output if not
+        given)
+        :param calibration: The servo's Calibration (if not given, a straight
+        line through the reference duties below is used)
         """
         # set the reference PWM duties for -90, 0, and 90 degrees
         self.PWM_MIN = 0.6 
@@ -20,8 +314,16 @@ class Servo(object):
         # get the conversion factor from degrees to pwm duty nanoseconds
         self.DEG_TO_MS = (self.PWM_MAX - self.PWM_MIN) / 180
 
-        self.pwm = machine.PWM(machine.Pin(pin))
-        self.pwm.freq(50)  # set pwm frequency that servo desires
+        if calibration is None:
+            calibration = Calibration.get(
+                ((-90, self.PWM_MIN * 1_000_000),
+                 (0, self.PWM_MID * 1_000_000),
+                 (90, self.PWM_MAX * 1_000_000)))
+        self.calibration = calibration
+
+        pwm = backend.machine.PWM(backend.machine.Pin(pin))
+        pwm.freq(50)  # set pwm frequency that servo desires
+        self.pwm = (output or servo_output).channel(pwm)
 
         self.current_angle = 0
 
@@ -31,38 +333,34 @@ class Servo(object):
         :param angle: angle in degrees for servo to go to
         :param time: time in seconds for motion to take
         """
-        steps = time_seconds * 10  # move every tenth of a second
-        # get the angular size of each step
-        step_size = (angle - self.current_angle) / steps
-        # step until reaching the desired angle
-
-        for _ in range(steps):
-            self.move_to_fast(self.current_angle + step_size)
-            time.sleep_ms(100)  # sleep for a tenth of a second
-
-        # ensure that we go to the correct angle
-        self.move_to_fast(angle)
+        Interpolator(10).move(((self, angle),), time_seconds, 'linear')
 
     def move_to_fast(self, angle: float):
         """Move to a given angle as quickly as possible
         :param angle: the angle in degrees for the servo to move to
         """
-        # update the current angle
-        self.current_angle = angle
-
-        # apply the conversion factor to get the desired duty in milliseconds
-        pwm_ms = self.PWM_MID + self.current_angle*self.DEG_TO_MS
-        pwm_ns = int(pwm_ms * 1_000_000)
+        # update the current angle (never past what the servo is allowed)
+        self.current_angle = self.calibration.clamp(angle)
 
         # set duty (in nanoseconds)
-        self.pwm.duty_ns(pwm_ns)
+        self.pwm.duty_ns(self.calibration.duty_for(angle))
+
+    def duty_for(self, angle: float) -> int:
+        """Get the PWM duty that puts the servo at a given angle
+        :param angle: the angle in degrees (clamped to the servo's limits)
+        :return: the duty in nanoseconds
+        """
+        return self.calibration.duty_for(angle)
+
+# the output that servos write through unless told otherwise
+servo_output = PWMOutput()
 
 class Leg(object):
     """A simple 2DoF leg"""
     class Side():
         #type side = int
-        Left: side = 1
-        Right: side = 0
+        Left: int = 1
+        Right: int = 0
     
     def __init__(self, servo1: Servo, len1: float, servo2: Servo, len2: float,
                  side):#: Side.side):
@@ -81,6 +379,9 @@ class Leg(object):
         
         self.side = side
 
+        # precomputed ik lookup (see use_ik_table), None means always solve
+        self.ik_table = None
+
     # https://osrobotics.org/osr/kinematics/inverse_kinematics.html
     def _inv_kinematics(self, des_x: float, des_y: float) -> list[tuple[float, float]]:
         """Calculates the inverse kinematics for a 2-DoF manipulator
@@ -126,46 +427,465 @@ class Leg(object):
 
         return res
 
-    def move_to_fast(self, target: tuple[float, float]) -> bool:
-        """Move to a given target (using ik) as quickly as possible. NOTE:
-        Apparently we can't reach close positions because the 2nd servo has to
-        rotate more and counteract the 1st.
+    def _solve_angles(self, target: tuple[float, float]):
+        """Solve for the servo angles (degrees, already offset for the servo
+        mounting) that put the foot at the target.
         :param target: the target for the leg to move to
-        :return: whether the target was reachable
+        :return: a (servo1, servo2) angle pair or None if unreachable
         """
         if self.side == Leg.Side.Left:
             target = (target[0], -target[1])
-            
+
         options = self._inv_kinematics(*target)
 
-        if len(options) == 0: return False
-        
+        if len(options) == 0: return None
+
         # pick an option based on which side the leg is on (so they ultimately
         # face the same way)
         option = self.side if len(options) == 2 else 0
         angle1 = math.degrees(options[option][0])
         angle2 = math.degrees(options[option][1])
-        
-        # might be trying to go in the wrong direction because of flip?
-        if self.side == Leg.Side.Left: angle2 = angle2
-        
+
         #offset = 90 if self.side == Leg.Side.Right else 0
         offset = 90 if self.side == Leg.Side.Left else -90
-    
-        
-        self.servo1.move_to_fast(angle1)
-        #self.servo2.move_to_fast(-angle2+offset)
-        self.servo2.move_to_fast(angle2+offset)
+
+        #return angle1, -angle2+offset
+        return angle1, angle2+offset
+
+    def use_ik_table(self, step: float = 0.5):
+        """Switch the leg to table mode, where targets are looked up in a
+        precomputed IKTable instead of being solved every move. Tables are
+        shared between legs with the same geometry and side.
+        :param step: the grid spacing of the table (smaller is more accurate
+        but takes more memory)
+        """
+        self.ik_table = IKTable.get(self, step)
+
+    def move_to_fast(self, target: tuple[float, float]) -> bool:
+        """Move to a given target (using ik) as quickly as possible. NOTE:
+        Apparently we can't reach close positions because the 2nd servo has to
+        rotate more and counteract the 1st.
+        :param target: the target for the leg to move to
+        :return: whether the target was reachable
+        """
+        angles = None
+        if self.ik_table is not None:
+            angles = self.ik_table.lookup(target[0], target[1])
+        if angles is None:
+            # not in the table (or no table), so solve it properly
+            angles = self._solve_angles(target)
+
+        if angles is None: return False
+
+        self.servo1.move_to_fast(angles[0])
+        self.servo2.move_to_fast(angles[1])
 
         return True
 
-    def move_to_timed(self, target: tuple[float, float]) -> bool:
-        """Move to a given target (using ik) over a given amount of time.
+    def solve_trajectory(self, points, use_numpy: bool = True):
+        """Solve a whole sequence of targets at once, so a motion can be worked
+        out ahead of time instead of inside the motion loop. Uses numpy when
+        it's available (and allowed), otherwise a loop over preallocated
+        arrays.
+        :param points: a sequence of (x, y) targets
+        :param use_numpy: whether numpy may be used
+        :return: a Trajectory with the angles and duties for every point
+        """
+        if numpy is not None and use_numpy:
+            return self._solve_trajectory_numpy(points)
+
+        count = len(points)
+        traj = Trajectory(count)
+        angles1, angles2 = traj.angles1, traj.angles2
+        duties1, duties2 = traj.duties1, traj.duties2
+
+        # everything that doesn't depend on the point, worked out once
+        len1, len2 = self.len1, self.len2
+        lensq = len1*len1 + len2*len2
+        denom = 2*len1*len2
+        flip = self.side == Leg.Side.Left
+        # the elbow solution move_to_fast picks for this side
+        sign = -1 if flip else 1
+        offset = 90 if flip else -90
+        to_deg = 180 / math.pi
+        duty1 = self.servo1.calibration.duty_for
+        duty2 = self.servo2.calibration.duty_for
+        nan = float('nan')
+        acos, atan2, cos, sin = math.acos, math.atan2, math.cos, math.sin
+
+        reachable = 0
+        for i in range(count):
+            x, y = points[i]
+            if flip:
+                y = -y
+            a2_cos = (x*x + y*y - lensq) / denom
+            if a2_cos > 1 or a2_cos < -1:
+                angles1[i] = nan
+                angles2[i] = nan
+                continue
+            a2 = sign * acos(a2_cos)
+            a1 = atan2(y, x) - atan2(len2*sin(a2), len1 + len2*cos(a2))
+            angle1 = a1 * to_deg
+            angle2 = a2 * to_deg + offset
+            angles1[i] = angle1
+            angles2[i] = angle2
+            duties1[i] = duty1(angle1)
+            duties2[i] = duty2(angle2)
+            reachable += 1
+
+        traj.reachable = reachable
+        return traj
+
+    def _solve_trajectory_numpy(self, points):
+        """The numpy version of solve_trajectory"""
+        pts = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        x = pts[:, 0]
+        y = -pts[:, 1] if self.side == Leg.Side.Left else pts[:, 1]
+
+        a2_cos = ((x*x + y*y - self.len1**2 - self.len2**2) /
+                  (2*self.len1*self.len2))
+        ok = numpy.abs(a2_cos) <= 1
+        sign = -1 if self.side == Leg.Side.Left else 1
+        a2 = sign * numpy.arccos(numpy.clip(a2_cos, -1, 1))
+        a1 = (numpy.arctan2(y, x) -
+              numpy.arctan2(self.len2*numpy.sin(a2),
+                            self.len1 + self.len2*numpy.cos(a2)))
+
+        offset = 90 if self.side == Leg.Side.Left else -90
+        angles1 = numpy.where(ok, numpy.degrees(a1), numpy.nan)
+        angles2 = numpy.where(ok, numpy.degrees(a2) + offset, numpy.nan)
+
+        def duties(servo, angles):
+            # index the compiled table the same way Calibration.duty_for does,
+            # so both backends agree
+            cal = servo.calibration
+            table = numpy.frombuffer(cal.table, dtype=numpy.uint16)
+            i = numpy.floor(numpy.nan_to_num(angles) * cal.STEPS - cal.first
+                            + 0.5)
+            i = numpy.clip(i, 0, len(table) - 1).astype(numpy.intp)
+            ns = table[i].astype(numpy.int32) * cal.UNIT_NS
+            return numpy.where(ok, ns, 0).astype(numpy.int32)
+
+        traj = Trajectory(0)
+        traj.angles1, traj.angles2 = angles1, angles2
+        traj.duties1 = duties(self.servo1, angles1)
+        traj.duties2 = duties(self.servo2, angles2)
+        traj.reachable = int(ok.sum())
+        return traj
+
+    def move_to_timed(self, target: tuple[float, float], duration: float,
+                      profile: str = 'min_jerk') -> bool:
+        """Move to a given target (using ik) over a given amount of time, with
+        both servos moving together.
         :param target: the target for the leg to move to
         :param duration: the duration of time over which for the leg to move
+        :param profile: the Interpolator profile to move with
         :return: whether the target was reachable
         """
-        raise NotImplemented
+        return Interpolator().move_legs(((self, target),), duration, profile)
+
+def profile_linear(s: float) -> float:
+    """Constant speed from start to end"""
+    return s
+
+def profile_trapezoid(s: float) -> float:
+    """Speed up for the first third, cruise, then slow down for the last
+    third"""
+    # with a third each for speeding up and slowing down, the cruise speed
+    # has to be 1.5x the average to cover the distance
+    if s < 1/3:
+        return 2.25 * s*s
+    if s > 2/3:
+        return 1 - 2.25 * (1 - s)*(1 - s)
+    return 1.5*s - 0.25
+
+def profile_min_jerk(s: float) -> float:
+    """The smoothest start and stop (zero speed and acceleration at both
+    ends)"""
+    return s*s*s * (10 - 15*s + 6*s*s)
+
+
+class Interpolator(object):
+    """Moves any number of servos together, so they all start and finish at
+    the same time, updating every servo once per control tick. Keeps count of
+    how long the ticks take, so the control rate can be traded off against CPU
+    time.
+    """
+    PROFILES = {
+        'linear': profile_linear,
+        'trapezoid': profile_trapezoid,
+        'min_jerk': profile_min_jerk,
+    }
+
+    def __init__(self, rate_hz: int = 50, output: PWMOutput = None):
+        """Create an interpolator.
+        :param rate_hz: the number of control ticks per second (the servos
+        only take a new duty every 20ms, so more than 50 is mostly smoothing)
+        :param output: the PWMOutput to flush once per tick (servo_output if
+        not given)
+        """
+        self.rate_hz = rate_hz
+        self.output = output or servo_output
+        self.period_ms = 1000 // rate_hz
+        self.tick_us = TimingStats()
+
+    def reset_stats(self):
+        """Clear the tick timing counters"""
+        self.tick_us.reset()
+
+    def stats(self):
+        """Get the tick timing counters
+        :return: a dict with the tick count and last/max/mean tick cost in
+        microseconds
+        """
+        tick_us = self.tick_us
+        return {
+            'ticks': tick_us.count,
+            'last_us': tick_us.last,
+            'max_us': tick_us.max,
+            'mean_us': tick_us.mean(),
+        }
+
+    def _prepare(self, moves):
+        """Work out the per-servo numbers needed every tick, so a tick is just
+        one multiply-add, a table lookup and a write per servo.
+        """
+        servos = [servo for servo, _ in moves]
+        pwms = [servo.pwm for servo in servos]
+        lookups = [servo.calibration.duty_for for servo in servos]
+        count = len(servos)
+        angle0 = array('f', bytes(4 * count))
+        angle_delta = array('f', bytes(4 * count))
+        for i, (servo, angle) in enumerate(moves):
+            angle0[i] = servo.current_angle
+            angle_delta[i] = servo.calibration.clamp(angle) - angle0[i]
+        return servos, pwms, lookups, angle0, angle_delta
+
+    def _tick(self, pwms, lookups, angle0, angle_delta, s: float):
+        """Write every servo's duty for a point s (0 to 1) along the move"""
+        start = ticks_us()
+        self.output.begin()
+        for i in range(len(pwms)):
+            pwms[i].duty_ns(lookups[i](angle0[i] + angle_delta[i]*s))
+        self.output.flush()
+        self.tick_us.record(ticks_diff(ticks_us(), start))
+
+    @staticmethod
+    def _finish(servos, angle0, angle_delta, s: float):
+        """Record where the servos ended up"""
+        for i in range(len(servos)):
+            servos[i].current_angle = angle0[i] + angle_delta[i]*s
+
+    def move(self, moves, duration: float, profile: str = 'min_jerk'):
+        """Move servos together, blocking until they're done.
+        :param moves: a sequence of (servo, angle) pairs
+        :param duration: the time in seconds for the move to take
+        :param profile: the name of the speed profile (see PROFILES)
+        """
+        shape = self.PROFILES[profile]
+        servos, pwms, lookups, angle0, angle_delta = self._prepare(moves)
+        steps = max(1, int(duration * self.rate_hz))
+
+        start = ticks_ms()
+        for step in range(1, steps + 1):
+            self._tick(pwms, lookups, angle0, angle_delta,
+                       shape(step / steps))
+            if step < steps:
+                deadline = ticks_add(start, step * self.period_ms)
+                wait = ticks_diff(deadline, ticks_ms())
+                if wait > 0:
+                    sleep_ms(wait)
+
+        self._finish(servos, angle0, angle_delta, 1)
+
+    async def move_async(self, moves, duration: float,
+                         profile: str = 'min_jerk'):
+        """Move servos together without blocking the event loop (see move). If
+        cancelled, the servos are left (and recorded) where they got to.
+        """
+        shape = self.PROFILES[profile]
+        servos, pwms, lookups, angle0, angle_delta = self._prepare(moves)
+        steps = max(1, int(duration * self.rate_hz))
+
+        s = 0
+        start = ticks_ms()
+        try:
+            for step in range(1, steps + 1):
+                s = shape(step / steps)
+                self._tick(pwms, lookups, angle0, angle_delta, s)
+                if step < steps:
+                    deadline = ticks_add(start, step * self.period_ms)
+                    await async_sleep_ms(
+                        max(ticks_diff(deadline, ticks_ms()), 0))
+        finally:
+            self._finish(servos, angle0, angle_delta, s)
+
+    def leg_moves(self, leg_targets):
+        """Turn leg targets into servo moves.
+        :param leg_targets: a sequence of (leg, target) pairs
+        :return: a list of (servo, angle) pairs, or None if any target is
+        unreachable
+        """
+        moves = []
+        for leg, target in leg_targets:
+            angles = leg._solve_angles(target)
+            if angles is None:
+                return None
+            moves.append((leg.servo1, angles[0]))
+            moves.append((leg.servo2, angles[1]))
+        return moves
+
+    def move_legs(self, leg_targets, duration: float,
+                  profile: str = 'min_jerk') -> bool:
+        """Move legs to their targets together, blocking until done. Nothing
+        moves if any of the targets is unreachable.
+        :param leg_targets: a sequence of (leg, target) pairs
+        :param duration: the time in seconds for the move to take
+        :param profile: the name of the speed profile (see PROFILES)
+        :return: whether all the targets were reachable
+        """
+        moves = self.leg_moves(leg_targets)
+        if moves is None:
+            return False
+        self.move(moves, duration, profile)
+        return True
+
+
+class Trajectory(object):
+    """The solved angles and duties for a sequence of leg targets. Each field
+    is indexed by point; unreachable points have nan angles and a duty of 0
+    (which should be skipped rather than written).
+    """
+    def __init__(self, count: int):
+        """Allocate space for a trajectory.
+        :param count: the number of points in the trajectory
+        """
+        self.angles1 = array('f', bytes(4 * count))
+        self.angles2 = array('f', bytes(4 * count))
+        self.duties1 = array('i', bytes(4 * count))
+        self.duties2 = array('i', bytes(4 * count))
+        # how many of the points could actually be reached
+        self.reachable = 0
+
+    def __len__(self):
+        return len(self.duties1)
+
+
+def densify(points, steps: int):
+    """Fill in straight-line waypoints between each pair of points, so a short
+    list of key positions can be turned into a smooth path.
+    :param points: the key (x, y) positions
+    :param steps: the number of waypoints per segment
+    :return: a list of (x, y) waypoints, ending on the last key position
+    """
+    res = []
+    for i in range(len(points) - 1):
+        x0, y0 = points[i]
+        x1, y1 = points[i+1]
+        for s in range(steps):
+            t = s / steps
+            res.append((x0 + (x1 - x0)*t, y0 + (y1 - y0)*t))
+    res.append(tuple(points[-1]))
+    return res
+
+
+class IKTable(object):
+    """A precomputed grid of servo angles for a leg, so moving doesn't have to
+    do any trig. Angles between grid points are bilinearly interpolated, and
+    targets outside the grid (or near the edge of reach) return None so the
+    caller can fall back to solving exactly.
+    """
+    # tables that have been built, keyed by (len1, len2, side, step)
+    _cache = {}
+
+    # if the corners of a cell disagree by more than this many degrees then
+    # interpolating across them is nonsense (the solution flips or wraps
+    # around), so don't
+    MAX_SPREAD = 30
+
+    def __init__(self, leg: Leg, step: float = 0.5):
+        """Build a table covering the whole reachable square of a leg.
+        :param leg: the leg to solve for (only its geometry and side are used)
+        :param step: the spacing between grid points
+        """
+        reach = leg.len1 + leg.len2
+        self.step = step
+        self.x0 = -reach
+        self.y0 = -reach
+        self.n = int(2*reach / step) + 1
+
+        nan = float('nan')
+        # servo1 and servo2 angles interleaved, row-major by y then x
+        self.angles = array('f', bytes(8 * self.n * self.n))
+        i = 0
+        for row in range(self.n):
+            y = self.y0 + row*step
+            for col in range(self.n):
+                x = self.x0 + col*step
+                angles = leg._solve_angles((x, y))
+                if angles is None:
+                    self.angles[i] = nan
+                    self.angles[i+1] = nan
+                else:
+                    self.angles[i] = angles[0]
+                    self.angles[i+1] = angles[1]
+                i += 2
+
+    @classmethod
+    def get(cls, leg: Leg, step: float = 0.5):
+        """Get the table for a leg, building it only if no leg with the same
+        geometry and side has needed it yet.
+        """
+        key = (leg.len1, leg.len2, leg.side, step)
+        table = cls._cache.get(key)
+        if table is None:
+            table = cls(leg, step)
+            cls._cache[key] = table
+        return table
+
+    def lookup(self, x: float, y: float):
+        """Look up the servo angles for a target.
+        :return: a (servo1, servo2) angle pair or None if the target can't be
+        interpolated from the table
+        """
+        fx = (x - self.x0) / self.step
+        fy = (y - self.y0) / self.step
+        if fx < 0 or fy < 0:
+            return None
+        col = int(fx)
+        row = int(fy)
+        n = self.n
+        if col >= n - 1 or row >= n - 1:
+            return None
+        tx = fx - col
+        ty = fy - row
+
+        angles = self.angles
+        i = (row*n + col) * 2
+        j = i + 2*n
+        # servo1 at the four corners of the cell
+        a, b, c, d = angles[i], angles[i+2], angles[j], angles[j+2]
+        # servo2 at the four corners of the cell
+        e, f, g, h = angles[i+1], angles[i+3], angles[j+1], angles[j+3]
+
+        # nan spreads through the sum, so this catches unreachable corners
+        total = a + b + c + d + e + f + g + h
+        if total != total:
+            return None
+        if (max(a, b, c, d) - min(a, b, c, d) > self.MAX_SPREAD or
+                max(e, f, g, h) - min(e, f, g, h) > self.MAX_SPREAD):
+            return None
+
+        top = a + (b - a)*tx
+        angle1 = top + (c + (d - c)*tx - top)*ty
+        top = e + (f - e)*tx
+        angle2 = top + (g + (h - g)*tx - top)*ty
+
+        return angle1, angle2
+
+    def memory(self) -> int:
+        """The number of bytes the table's angles take up"""
+        return len(self.angles) * 4
 
 class DistSensor(object):
     # measured luminosity of the LED
@@ -181,13 +901,16 @@ class DistSensor(object):
         """
 
         # get the ldr ADC pin
-        self.ldr = machine.ADC(ldr_pin)
+        self.ldr = backend.machine.ADC(ldr_pin)
         # get the led
-        self.led = machine.Pin(led_pin, machine.Pin.OUT)
+        self.led = backend.machine.Pin(led_pin, backend.machine.Pin.OUT)
+        # the last distance read (for anything that can't wait for a reading)
+        self.distance = None
 
     def read(self):
         """Read the sensor, returning the distance detected (very roughly, in
-        a unit about as long as an inch, for some reason).
+        a unit about as long as an inch, for some reason). This blocks for
+        200ms, so anything that has to keep running should use a DistSampler.
         """
         # the length of time to allow the led and ldr to adjust
         SLEEP_TIME = 100
@@ -195,18 +918,26 @@ class DistSensor(object):
         # get the ldr reading for when the led is on
         self.led.on()
         # sleep for a bit to let led and ldr adjust
-        time.sleep_ms(SLEEP_TIME)
+        sleep_ms(SLEEP_TIME)
         on = self.ldr.read_u16();
 
         # get the LDR reading for when the LED is off
         self.led.off()
         # sleep for a bit to let LED and LDR adjust
-        time.sleep_ms(SLEEP_TIME)
+        sleep_ms(SLEEP_TIME)
         off = self.ldr.read_u16();
 
         # calculate how the LED light affects the reading
-        diff = on - off
+        self.distance = self.distance_for(on - off)
+        return self.distance
 
+    @classmethod
+    def distance_for(cls, flux):
+        """Work out the distance from how much the LED changes the reading.
+        :param flux: the reading with the LED on minus the reading with it off
+        :return: the distance, or None if the LED made no difference (nothing
+        in range to reflect it)
+        """
         # I think since $SA = 4\pi{}r^2$ for a sphere, the diff will fall off
         # by that formula and we can use it to find the distance (though,
         # remember that the light has to go twice as far as the distance to the
@@ -217,14 +948,262 @@ class DistSensor(object):
         # (note that our distance will be half this because the light travels
         # both ways
 
-        # somehow measure this
-        flux = diff
-
         # I think because the luminosity and flux are both in ADC units, they
         # cancel out and give us meters
-        print(f'flux: {flux}')
-        lum_dist = math.sqrt(self.LED_LUMINOSITY / abs(4*math.pi*flux))
+        if flux <= 0:
+            return None
+        return math.sqrt(cls.LED_LUMINOSITY / (4*math.pi*flux))
+
+
+class _PhasedSampler(object):
+    """The asyncio task shared by the distance samplers: every settle_ms it
+    takes a reading for the LEDs' current state (step), then they're toggled
+    to settle for the next one. It keeps count of how late each reading is.
+    """
+    def __init__(self, settle_ms: int):
+        self.settle_ms = settle_ms
+        # the number of readings taken (even ones have the LEDs on)
+        self.count = 0
+        self.running = False
+        # how late each reading was (and so how many the task has taken)
+        self.late_us = TimingStats()
+
+    def reset_stats(self):
+        """Clear the timing counters"""
+        self.late_us.reset()
+
+    def stats(self):
+        """Get the sampler's counters
+        :return: a dict with the readings taken and last/max/mean time each
+        reading was later than planned in microseconds
+        """
+        late_us = self.late_us
+        return {
+            'readings': self.count,
+            'late_last_us': late_us.last,
+            'late_max_us': late_us.max,
+            'late_mean_us': late_us.mean(),
+        }
+
+    def step(self):
+        raise NotImplementedError
+
+    def _set_leds(self, on: bool):
+        raise NotImplementedError
+
+    async def run(self):
+        """Sample until stop is called (or the task is cancelled)."""
+        self.running = True
+        self._set_leds(not self.count & 1)
+        period_us = self.settle_ms * 1000
+        due = ticks_add(ticks_us(), period_us)
+        try:
+            while self.running:
+                wait = ticks_diff(due, ticks_us())
+                if wait > 0:
+                    await async_sleep_ms((wait + 999) // 1000)
+                self.step()
+
+                self.late_us.record(max(ticks_diff(ticks_us(), due), 0))
+
+                due = ticks_add(due, period_us)
+                if ticks_diff(due, ticks_us()) < 0:
+                    # fell behind, so wait a whole settle time from now (the
+                    # LEDs have only just been toggled)
+                    due = ticks_add(ticks_us(), period_us)
+        finally:
+            self._set_leds(False)
+            self.running = False
+
+    def stop(self):
+        """Stop sampling after the current reading"""
+        self.running = False
+
+
+class DistSampler(_PhasedSampler):
+    """Reads a DistSensor continuously without blocking, as an asyncio task.
+    The LED is toggled every settle_ms and the LDR read just before each
+    toggle, so the readings alternate LED on and LED off. Every reading is
+    paired with the one before it, so each one gives a new on minus off
+    difference (twice as many as reading the pairs separately). The raw
+    readings are kept in a small ring buffer and the differences filtered
+    before being turned into a distance.
+    """
+    FILTERS = ('mean', 'median', 'ema')
+
+    def __init__(self, sensor: DistSensor, settle_ms: int = 20,
+                 window: int = 8, filter: str = 'median',
+                 alpha: float = 0.3):
+        """Create a sampler (it doesn't start until run is called).
+        :param sensor: the sensor to read
+        :param settle_ms: how long to let the LED and LDR settle after each
+        toggle
+        :param window: how many of the latest differences the mean and median
+        filters use
+        :param filter: one of FILTERS
+        :param alpha: how much each new difference counts for the ema filter
+        (0 to 1)
+        """
+        if filter not in self.FILTERS:
+            raise ValueError('unknown filter')
+        super().__init__(settle_ms)
+        self.sensor = sensor
+        self.window = window
+        self.filter = filter
+        self.alpha = alpha
+        # the latest raw readings, oldest overwritten first
+        self.raw = array('H', bytes(2 * (window + 1)))
+        # space for the median filter to sort in
+        self._sorted = array('i', bytes(4 * window))
+        # the filtered on minus off difference, and the distance it gives
+        self.flux = None
+        self.distance = None
+
+    def stats(self):
+        """Get the sampler's counters (see _PhasedSampler.stats), and the
+        latest distance"""
+        stats = super().stats()
+        stats['distance'] = self.distance
+        return stats
+
+    def _set_leds(self, on: bool):
+        if on:
+            self.sensor.led.on()
+        else:
+            self.sensor.led.off()
+
+    def _difference(self, n: int) -> int:
+        # the on minus off difference between readings n and n - 1
+        raw = self.raw
+        size = len(raw)
+        later = raw[n % size]
+        earlier = raw[(n - 1) % size]
+        return earlier - later if n & 1 else later - earlier
+
+    def step(self):
+        """Take the reading for the LED's current state, then toggle it. The
+        sampler's task does this every settle_ms."""
+        n = self.count
+        self.raw[n % len(self.raw)] = self.sensor.ldr.read_u16()
+        self._set_leds(n & 1)
+        self.count = n + 1
+        if n:
+            self._update(n)
+
+    def _update(self, n: int):
+        if self.filter == 'ema':
+            difference = self._difference(n)
+            if self.flux is None:
+                self.flux = difference
+            else:
+                self.flux += self.alpha * (difference - self.flux)
+        else:
+            count = min(n, self.window)
+            if self.filter == 'mean':
+                total = 0
+                for i in range(count):
+                    total += self._difference(n - i)
+                self.flux = total / count
+            else:
+                # insertion sort into the spare array, so nothing's allocated
+                ordered = self._sorted
+                for i in range(count):
+                    value = self._difference(n - i)
+                    j = i
+                    while j > 0 and ordered[j - 1] > value:
+                        ordered[j] = ordered[j - 1]
+                        j -= 1
+                    ordered[j] = value
+                self.flux = ordered[count // 2]
+        self.distance = self.sensor.distance_for(self.flux)
+        self.sensor.distance = self.distance
+
+
+class SensorArray(_PhasedSampler):
+    """Reads several DistSensors in one scan, as an asyncio task. All the
+    LEDs are switched together and settle together, then every LDR is read
+    in a burst (oversample times each, into one preallocated buffer) and the
+    bursts averaged. Like DistSampler, each burst is paired with the one
+    before it, so every settle_ms gives a new distance for every sensor,
+    however many there are.
+    """
+    def __init__(self, sensors, settle_ms: int = 20, oversample: int = 4):
+        """Create a sensor array (it doesn't start until run is called).
+        :param sensors: the DistSensors to read (each on its own LDR pin,
+        pointing different ways so their LEDs don't light each other's LDR)
+        :param settle_ms: how long to let the LEDs and LDRs settle after each
+        toggle
+        :param oversample: how many times to read each LDR per burst
+        """
+        super().__init__(settle_ms)
+        self.sensors = sensors
+        self.oversample = oversample
+        # the reading functions, looked up once rather than every burst
+        self._reads = [sensor.ldr.read_u16 for sensor in sensors]
+        self._leds = [sensor.led for sensor in sensors]
+        # one burst, sensor by sensor
+        self.burst = array('H', bytes(2 * oversample * len(sensors)))
+        # each sensor's summed burst with the LEDs on and off
+        self.levels = array('I', bytes(8 * len(sensors)))
+        #: the latest distance for each sensor (None for nothing in range),
+        #: updated in place after every burst
+        self.distances = [None] * len(sensors)
+        self.burst_us = TimingStats()
+
+    def reset_stats(self):
+        """Clear the timing counters"""
+        super().reset_stats()
+        self.burst_us.reset()
+
+    def stats(self):
+        """Get the array's counters (see _PhasedSampler.stats), the time the
+        last and longest bursts took in microseconds, and the latest
+        distances"""
+        stats = super().stats()
+        stats['burst_us_last'] = self.burst_us.last
+        stats['burst_us_max'] = self.burst_us.max
+        stats['distances'] = self.distances
+        return stats
+
+    def _set_leds(self, on: bool):
+        for led in self._leds:
+            if on:
+                led.on()
+            else:
+                led.off()
+
+    def step(self):
+        """Read every LDR for the LEDs' current state, then toggle them. The
+        array's task does this every settle_ms."""
+        start = ticks_us()
+        n = self.count
+        burst = self.burst
+        oversample = self.oversample
+        i = 0
+        for read in self._reads:
+            for _ in range(oversample):
+                burst[i] = read()
+                i += 1
+        # start the LEDs settling before working anything out
+        self._set_leds(n & 1)
+        self.burst_us.record(ticks_diff(ticks_us(), start))
 
-        dist = lum_dist
+        levels = self.levels
+        slot = n & 1
+        i = 0
+        for sensor in range(len(self._reads)):
+            total = 0
+            for _ in range(oversample):
+                total += burst[i]
+                i += 1
+            levels[2*sensor + slot] = total
+        self.count = n + 1
+        if not n:
+            return
 
-        return dist
+        distances = self.distances
+        for sensor in range(len(distances)):
+            flux = (levels[2*sensor] - levels[2*sensor + 1]) / oversample
+            distance = DistSensor.distance_for(flux)
+            distances[sensor] = distance
+            self.sensors[sensor].distance = distance
@@ -1,14 +1,34 @@
-from hardware import Leg, Servo
-import machine
+from hardware import (DistSensor, Leg, SensorArray, Servo, load_calibrations,
+                      servo_output)
+import asyncio
+import backend
+import behaviour
+import gait
+import math
+import motion
+import struct
+import telemetry
 import time
-import _thread
 
-leg_fl = Leg(Servo(0), 4, Servo(1), 8, Leg.Side.Left)
-leg_bl = Leg(Servo(2), 4, Servo(3), 8, Leg.Side.Left)
-leg_fr = Leg(Servo(4), 4, Servo(5), 8, Leg.Side.Right)
-leg_br = Leg(Servo(6), 4, Servo(7), 8, Leg.Side.Right)
+# per-servo angle to duty calibrations, by pin (see calibration.json)
+calibrations = load_calibrations()
+
+def servo(pin):
+    return Servo(pin, calibration=calibrations.get(pin))
+
+leg_fl = Leg(servo(0), 4, servo(1), 8, Leg.Side.Left)
+leg_bl = Leg(servo(2), 4, servo(3), 8, Leg.Side.Left)
+leg_fr = Leg(servo(4), 4, servo(5), 8, Leg.Side.Right)
+leg_br = Leg(servo(6), 4, servo(7), 8, Leg.Side.Right)
 
 legs = (leg_br, leg_fr, leg_fl, leg_bl)
+# the legs solve their ik exactly: ik tables (Leg.use_ik_table) would take
+# about 38KB of heap for the two sides, and bench.ik_table hasn't yet shown
+# the lookup beating the solve on the pico by enough to pay for that
+
+# every servo, in pin order (motion plans refer to servos by this index)
+servos = (leg_fl.servo1, leg_fl.servo2, leg_bl.servo1, leg_bl.servo2,
+          leg_fr.servo1, leg_fr.servo2, leg_br.servo1, leg_br.servo2)
 
 target = (10.5,-1)
 #target = (12,0)
@@ -21,18 +41,18 @@ print(leg_fr.servo2.current_angle)
 print(leg_fl.servo2.current_angle)
 
 
-def motion2():
+def motion2(sleep=time.sleep):
     leg_bl.move_to_fast((9,0))
     leg_br.move_to_fast((9,0))
-    time.sleep(2)
+    sleep(2)
     leg_bl.move_to_fast(target)
     leg_br.move_to_fast(target)
 
-def motion1():
+def motion1(sleep=time.sleep):
     for leg in legs:
-        time.sleep(1)
+        sleep(1)
         leg.move_to_fast((9,0))
-        time.sleep(1)
+        sleep(1)
         leg.move_to_fast(target)
         
 def legs_goto(target):
@@ -45,11 +65,11 @@ def crouch():
 def stand():
     legs_goto(target)
         
-def jump():
+def jump(sleep=time.sleep):
     crouch()
-    time.sleep(1)
+    sleep(1)
     legs_goto((12,0))
-    time.sleep(1)
+    sleep(1)
     stand()
     
 raise_x = 8.5
@@ -63,84 +83,151 @@ STEP_POSITIONS = (
     target,
     )
 
-def step(leg):
+def step(leg, sleep=time.sleep):
     for i in range(len(STEP_POSITIONS)):
         leg.move_to_fast(STEP_POSITIONS[i])
-        #time.sleep(0.8)
-        time.sleep(0.2)
+        #sleep(0.8)
+        sleep(0.2)
         
-walking = False
-def walk():
-    while walking:
-        for leg in legs:
-            step(leg)
-            time.sleep(0.5)
-    _thread.exit()
-            
-def dance():
+def walk_cycle(sleep=time.sleep):
+    for leg in legs:
+        step(leg, sleep)
+        sleep(0.5)
+
+def dance(sleep=time.sleep):
     stand()
     
     for leg in (leg_fl, leg_fr):
         leg.move_to_fast((9,4))
 
-    time.sleep(1)
+    sleep(1)
     stand()
 
     
     for i in range(3):
         crouch()
-        time.sleep(1)
+        sleep(1)
         stand()
-        time.sleep(1)
+        sleep(1)
     
     for leg in (leg_fl, leg_fr, leg_bl, leg_br):
         leg.move_to_fast((7,5))
-        time.sleep(1)
+        sleep(1)
         leg.move_to_fast(target)
-        time.sleep(1)
+        sleep(1)
         
     for i in range(3):
         crouch()
-        time.sleep(1)
+        sleep(1)
         stand()
-        time.sleep(1)
+        sleep(1)
         
     for leg in (leg_fl, leg_fr):
         leg.move_to_fast((9,4))
     
-    time.sleep(1)
+    sleep(1)
     
     stand()
     
     return
     
     for leg in legs:
-        step(leg)
-        time.sleep(0.5)
+        step(leg, sleep)
+        sleep(0.5)
 
 #motion2()
 
-with open("index.html") as indx_file:
-    INDEX = indx_file.read()
+# compile the choreographies once (or load them from flash), so running them
+# is just replaying duty writes. They're compiled again by themselves when
+# calibration.json changes, but NOTE: delete the .plan files on the board after
+# changing a choreography, or the old one will keep being loaded
+PLANS = {
+    name: motion.load_or_compile(name + ".plan", choreography, servos)
+    for name, choreography in (
+        ("sit", motion2),
+        ("lift", motion1),
+        ("jump", jump),
+        ("dance", dance),
+        ("walk", walk_cycle),
+        ("stand", lambda sleep: stand()),
+    )
+}
+
+# plays the plans in the background so the web server keeps responding
+scheduler = motion.MotionScheduler(servos, servo_output)
+
+# the gait walking follows (adjustable over http, see /gait)
+walk_gait = gait.Gait("walk")
+gait_engine = gait.GaitEngine(legs, walk_gait)
+
+# walks and holds poses on the second core; plans only play on the scheduler
+# once it has stopped, and it only starts once the scheduler is cancelled, so
+# the two never drive the servos at the same time
+worker = motion.MotionWorker(gait_engine)
+
+# the distance sensors in the sensor holder, left to right, as (LDR ADC pin,
+# LED pin)
+SENSOR_PINS = ((26, 14), (27, 15))
+distance_sensors = [DistSensor(ldr, led) for ldr, led in SENSOR_PINS]
+# read all together in the background (only while avoiding obstacles, see
+# /avoid, so the LEDs aren't flashing for nothing)
+sensor_array = SensorArray(distance_sensors)
+
+# steers the walk away from whatever the sensors see
+avoider = behaviour.ObstacleAvoider(worker, distance_sensors)
+
+# live state for the page and scripts, streamed at /telemetry (everything here
+# is just read from what the motion code last did, so sampling is cheap)
+live = telemetry.Telemetry({
+    "angles": lambda: [round(servo.current_angle, 1) for servo in servos],
+    "walk": lambda: {"state": worker.state,
+                     "phase": round(gait_engine.phase, 3)},
+    "motion": lambda: scheduler.current.name if scheduler.current else None,
+    "distances": lambda: [sensor.distance for sensor in distance_sensors],
+    "avoid": lambda: avoider.state,
+    "loop": lambda: {"tick_us": gait_engine.tick_us.last,
+                     "tick_max_us": gait_engine.tick_us.max,
+                     "command_us": worker.latency_us.last},
+})
 
 # Webserver stuff
-import network
 import microdot
 
 app = microdot.Microdot()
+# the sync routes return straight away, so they don't need a thread (this only
+# matters off the Pico, MicroPython always runs them on the event loop)
+app.sync_handlers = "inline"
+# the pico only has a handful of sockets, so keep some free, and don't let a
+# stalled client hold one for long. An open page holds one for its telemetry
+# stream (two at most, see live), one for the joystick only while the sliders
+# are moving, and one for a couple of seconds after each button press, so two
+# phones fit with room to spare
+app.max_connections = 6
+app.backlog = 2
+app.head_timeout = 5
+app.body_timeout = 5
+app.keep_alive_timeout = 2
+# request counts and timings per route at /metrics, to find slow commands
+app.enable_metrics()
 
 def setup_network():
-    ap = network.WLAN(network.AP_IF)
+    ap = backend.network.WLAN(backend.network.AP_IF)
     ap.config(essid="jrit-dog-robot", security=4, key="bark&bark")
     ap.active(True)
-    while not ap.active:
-        time.sleep_ms(100)
+    while not ap.active():
+        time.sleep(0.1)
     tmp = ap.ifconfig()
     print("Dog IP address:", tmp[0])
 
+# the page is compressed and serialized once, and phones keep it for an hour
+# (the ETag changes with the page, so they get the new one after that)
+with open("index.html") as indx_file:
+    INDEX = microdot.StaticResponse(indx_file.read(), max_age=3600,
+                                    headers={"Content-Type": "text/html"})
+
 @app.route("/")
 def index_page(req):
-    return microdot.Response(body=INDEX, headers={"Content-type": "text/html"})
+    return INDEX
 
 def index_redirect():
     return microdot.Response(
@@ -151,54 +238,298 @@ def index_redirect():
         }
     )
 
+# the routes are async so they run on the event loop alongside the scheduler
+# (and return as soon as the motion is started, not when it's done)
+
+# the timed poses from the last binary /set-leg still to come
+pose_task = None
+
+def stop_poses():
+    # anything else that moves the servos stops these first, or they'd both
+    # be driving them
+    global pose_task
+    if pose_task is not None:
+        pose_task.cancel()
+        pose_task = None
+
+async def start_plan(name, queue=False):
+    # take the servos back from the worker first
+    stop_poses()
+    await worker.stop_async()
+    if queue:
+        return scheduler.queue(name, PLANS[name])
+    return scheduler.start(name, PLANS[name])
+
+def worker_command(command, *args):
+    # hand the servos over to the worker
+    scheduler.cancel()
+    stop_poses()
+    if not worker.submit(command, *args):
+        return "Too many commands", 503
+    return index_redirect()
+
 @app.route("/sit")
-def route_sit(req):
+async def route_sit(req):
     print("sit")
-    motion2()
+    await start_plan("sit")
     return index_redirect()
 
 @app.route("/lift")
-def route_lift(req):
+async def route_lift(req):
     print("lift")
-    motion1()
+    await start_plan("lift")
     return index_redirect()
 
 @app.route("/stand")
-def route_stand(req):
+async def route_stand(req):
     print("stand")
-    stand()
+    await start_plan("stand")
     return index_redirect()
         
 @app.route("/start-walking")
-def route_walk(req):
-    global walking
-    walking = True
-    _thread.start_new_thread(walk, ())
-
-    return index_redirect()
+async def route_walk(req):
+    return worker_command(motion.MotionWorker.WALK)
 
 @app.route("/stop-walking")
-def route_stop_walk(req):
-    global walking
-    walking = False
+async def route_stop_walk(req):
+    return worker_command(motion.MotionWorker.STOP)
 
-    return index_redirect()
+@app.route("/pause-walking")
+async def route_pause_walk(req):
+    return worker_command(motion.MotionWorker.PAUSE)
+
+@app.route("/resume-walking")
+async def route_resume_walk(req):
+    return worker_command(motion.MotionWorker.RESUME)
 
 @app.route("/dance")
-def route_dance(req):
+async def route_dance(req):
     print("dance")
-    dance()
+    await start_plan("dance")
     return index_redirect()
 
+def start_poses(batches):
+    global pose_task
+    # hand the servos over to the worker, and forget any older batch
+    scheduler.cancel()
+    stop_poses()
+    if batches[0][0] == 0:
+        worker.set_poses(batches.pop(0)[1])
+    if batches:
+        pose_task = asyncio.create_task(worker.play_poses(batches))
+
 @app.route("/set-leg", methods=["POST"])
-def position_leg(req):
+async def position_leg(req):
+    if req.content_type == "application/octet-stream":
+        # from scripts: any number of motion.POSE_RECORD records, and each
+        # group with the same time moves together
+        try:
+            batches = motion.unpack_poses(req.body, len(legs))
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+        count = len(batches)
+        start_poses(batches)
+        return {"batches": count}, 202
+
     print(req)
-    leg = int(req.form["leg"])
-    x = float(req.form["x"])
-    y = float(req.form["y"])
+    try:
+        leg = int(req.form["leg"])
+        x = float(req.form["x"])
+        y = float(req.form["y"])
+    except (KeyError, TypeError, ValueError):
+        return {"error": "need a leg, x and y"}, 400
+    # checked here like the binary and joystick targets, so a bad one never
+    # gets to the worker
+    if not 0 <= leg < len(legs):
+        return {"error": "no leg {}".format(leg)}, 400
+    if not (math.isfinite(x) and math.isfinite(y)):
+        return {"error": "x and y must be numbers"}, 400
     print(leg, x, y)
-    legs[leg].move_to_fast((x,y))
-    return index_redirect()
+    return worker_command(motion.MotionWorker.POSE, leg, (x,y))
+
+# the joystick on the page streams binary messages over a websocket, each one
+# or more records: b"L", the leg index, then x and y in hundredths (signed 16
+# bit, little endian), or b"W" then the walking speed in thousandths of full
+# speed (negative walks backwards, 0 pauses). Leg targets only keep the latest
+# per leg until the next control tick, so dragging never builds up a backlog
+JOYSTICK_LEG = ord("L")
+JOYSTICK_WALK = ord("W")
+# a joystick that's quiet this long (a phone gone to sleep) is disconnected,
+# to free up its socket
+JOYSTICK_TIMEOUT = 10
+
+def joystick_walk(speed):
+    # scales the gait's stride rather than replacing it, so it's still there
+    # once the joystick lets go
+    speed = max(-1, min(1, speed))
+    walk_gait.throttle = speed
+    if speed == 0:
+        if worker.state == motion.MotionWorker.WALKING:
+            worker.submit(motion.MotionWorker.PAUSE)
+    elif worker.state == motion.MotionWorker.PAUSED:
+        worker.submit(motion.MotionWorker.RESUME)
+    elif worker.state == motion.MotionWorker.IDLE:
+        worker.submit(motion.MotionWorker.WALK)
+
+def joystick_command(message):
+    # returns False (having applied any good records before it) if the
+    # message is malformed
+    i = 0
+    while i < len(message):
+        kind = message[i]
+        if kind == JOYSTICK_LEG and i + 6 <= len(message):
+            leg, x, y = struct.unpack_from("<Bhh", message, i + 1)
+            if leg >= len(legs):
+                return False
+            worker.set_pose(leg, (x / 100, y / 100))
+            i += 6
+        elif kind == JOYSTICK_WALK and i + 3 <= len(message):
+            joystick_walk(struct.unpack_from("<h", message, i + 1)[0] / 1000)
+            i += 3
+        else:
+            return False
+    return True
+
+@app.route("/joystick")
+@microdot.with_websocket
+async def route_joystick(req, ws):
+    try:
+        while True:
+            try:
+                message = await microdot.wait_for(ws.receive(),
+                                                  JOYSTICK_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            # hand the servos over to the worker
+            scheduler.cancel()
+            stop_poses()
+            if isinstance(message, str) or not joystick_command(message):
+                await ws.send("bad message")
+    finally:
+        # walk at the gait's own speed again
+        walk_gait.throttle = 1.0
+
+# JSON api for scripts, which get a job id back instead of a redirect
+
+@app.route("/motions/<name>", methods=["POST"])
+async def route_motion(req, name):
+    if name not in PLANS:
+        return {"error": "unknown motion"}, 404
+    job_id = await start_plan(name, queue="queue" in req.args)
+    return {"job": job_id}, 202
+
+@app.route("/walking")
+async def route_walking(req):
+    return worker.stats()
+
+@app.route("/server")
+async def route_server(req):
+    # connection counters, for sizing the limits above
+    return app.server_stats()
+
+@app.route("/telemetry")
+async def route_telemetry(req):
+    # server-sent events, as often as ?rate= asks (up to the sample rate)
+    try:
+        rate = float(req.args["rate"]) if "rate" in req.args else None
+        if rate is not None and not 0 < rate < float("inf"):
+            raise ValueError
+    except ValueError:
+        return {"error": "bad rate"}, 400
+    headers = {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        # one stream per connection, so it doesn't need chunking
+        "Connection": "close",
+    }
+    if req.method == "HEAD":
+        # no body is sent, so don't take up a listener
+        return "", 200, headers
+    stream = live.subscribe(rate)
+    if stream is None:
+        return "Too many listeners", 503
+    return microdot.Response(stream, headers=headers)
+
+@app.route("/telemetry/stats")
+async def route_telemetry_stats(req):
+    return live.stats()
+
+@app.route("/telemetry/stats", methods=["POST"])
+async def route_set_telemetry_rate(req):
+    params = req.json or req.form or {}
+    try:
+        live.set_rate(params.get("rate_hz", live.rate_hz))
+    except (ValueError, TypeError) as exc:
+        return {"error": str(exc)}, 400
+    return live.stats()
+
+# the sensor and avoider tasks, while avoiding obstacles
+avoid_tasks = []
+
+@app.route("/avoid")
+async def route_avoid(req):
+    return dict(avoider.stats(), enabled=bool(avoid_tasks),
+                sensors=sensor_array.stats())
+
+@app.route("/avoid", methods=["POST"])
+async def route_set_avoid(req):
+    # {"enabled": true} from scripts, or enabled=1 from a form
+    params = req.json or req.form or {}
+    enabled = params.get("enabled") in (True, 1, "1", "true", "on")
+    if enabled and not avoid_tasks:
+        avoid_tasks.append(asyncio.create_task(sensor_array.run()))
+        avoid_tasks.append(asyncio.create_task(avoider.run()))
+    elif not enabled:
+        # cancelling puts the gait back and turns the LEDs off
+        for task in avoid_tasks:
+            task.cancel()
+        del avoid_tasks[:]
+    return {"enabled": enabled}
+
+@app.route("/gait")
+async def route_gait(req):
+    return dict(walk_gait.to_dict(), stats=gait_engine.stats(),
+                min_period=gait_engine.min_period())
+
+@app.route("/gait", methods=["POST"])
+async def route_set_gait(req):
+    # json from scripts, or a form (all strings, but update converts them)
+    params = req.json or req.form or {}
+    try:
+        walk_gait.update(params)
+    except (ValueError, TypeError) as exc:
+        return {"error": str(exc)}, 400
+    return walk_gait.to_dict()
+
+@app.route("/jobs")
+async def route_jobs(req):
+    return scheduler.status()
+
+@app.route("/jobs", methods=["DELETE"])
+async def route_cancel_jobs(req):
+    return {"cancelled": scheduler.cancel()}
+
+@app.route("/jobs/<int:job_id>")
+async def route_job(req, job_id):
+    status = scheduler.status(job_id)
+    if status is None:
+        return {"error": "unknown job"}, 404
+    return status
+
+@app.route("/jobs/<int:job_id>", methods=["DELETE"])
+async def route_cancel_job(req, job_id):
+    return {"cancelled": scheduler.cancel(job_id)}
+
+# the sensor holder model, for printing a replacement (big files like this are
+# read through a small buffer, and can be fetched in pieces with Range)
+@app.route("/sensor-holder.FCStd")
+def sensor_holder(req):
+    return microdot.send_file("sensor-holder.FCStd",
+                              content_type="application/octet-stream")
 
-setup_network()
-app.run(port=80)
\ No newline at end of file
+# only serve when run as the program (so the benchmarks can import this)
+if __name__ == "__main__":
+    worker.start()
+    setup_network()
+    # port 80 needs root on a desktop, so use another when simulating
+    app.run(port=8080 if backend.SIMULATED else 80)
\ No newline at end of file
@@ -9,8 +9,20 @@ import asyncio
 import io
 import json
 import time
+from array import array
 
 try:
+    from time import ticks_us, ticks_diff
+except ImportError:  # pragma: no cover
+    # standard Python doesn't have the MicroPython tick functions
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
     from inspect import iscoroutinefunction, iscoroutine
     from functools import partial
 
@@ -26,6 +38,8 @@ try:
                 None, partial(handler, *args, **kwargs))
         return ret
 except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
     def iscoroutine(coro):
         return hasattr(coro, 'send') and hasattr(coro, 'throw')
 
@@ -56,6 +70,43 @@ MUTED_SOCKET_ERRORS = [
 ]
 
 
+def gzip_compress(data):
+    """Compress bytes in the gzip format, with the ``gzip`` module on
+    standard Python or the ``deflate`` module on MicroPython. Returns
+    ``None`` if neither can compress."""
+    try:
+        import gzip
+        return gzip.compress(data, mtime=0)
+    except ImportError:  # pragma: no cover
+        pass
+    try:  # pragma: no cover
+        import deflate
+        buf = io.BytesIO()
+        with deflate.DeflateIO(buf, deflate.GZIP) as f:
+            f.write(data)
+        return buf.getvalue()
+    except (ImportError, AttributeError, OSError):  # pragma: no cover
+        return None
+
+
+def etag_for(data):
+    """Return an entity tag for a body, as used in the ``ETag`` header."""
+    try:
+        from binascii import crc32
+        checksum = crc32(data)
+    except ImportError:  # pragma: no cover
+        checksum = hash(data)
+    return '"{:08x}-{:x}"'.format(checksum & 0xffffffff, len(data))
+
+
+async def wait_for(coro, timeout):
+    """Wait for a coroutine with a timeout in seconds, or forever if the
+    timeout is ``None``."""
+    if timeout is None:
+        return await coro
+    return await asyncio.wait_for(coro, timeout)
+
+
 def urldecode_str(s):
     s = s.replace('+', ' ')
     parts = s.split('%')
@@ -294,6 +345,239 @@ class AsyncBytesIO:
         pass
 
 
+class ConnectionReader:
+    """A reader for a client connection that reads request heads into a
+    preallocated buffer, so that parsing them does not need a new string for
+    every line. The buffer is kept for every request on the connection, and
+    handed on to a later connection with :meth:`release`. Anything read past
+    the end of a head (a request body, or the next request) stays in the
+    buffer and is returned by the read methods first.
+
+    :param stream: The client's input stream.
+    """
+    #: The number of released buffers kept for later connections.
+    pool_size = 4
+
+    _pool = []
+
+    def __init__(self, stream):
+        self.stream = stream
+        size = Request.max_head_length
+        buf = None
+        while ConnectionReader._pool and buf is None:
+            buf = ConnectionReader._pool.pop()
+            if len(buf) != size:
+                buf = None
+        self.buf = buf or bytearray(size)
+        self.mv = memoryview(self.buf)
+        # the unread data is buf[start:end]
+        self.start = 0
+        self.end = 0
+        #: Whether no part of a request is waiting to be read (so the client
+        #: isn't in the middle of sending one).
+        self.idle = True
+        #: When the first bytes of the latest request were seen, in
+        #: microseconds (see ``time.ticks_us``).
+        self.started_us = 0
+
+    def release(self):
+        """Hand the buffer back to the pool, once the connection is done."""
+        if self.buf is not None and \
+                len(ConnectionReader._pool) < self.pool_size:
+            ConnectionReader._pool.append(self.buf)
+        self.buf = None
+        self.mv = None
+
+    async def _fill(self):
+        # move what's left to the start of the buffer, then read more after
+        # it
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start:
+            n = self.end - self.start
+            self.buf[:n] = self.mv[self.start:self.end]
+            self.start = 0
+            self.end = n
+        if self.end == len(self.buf):
+            raise ValueError('request head too large')
+        if hasattr(self.stream, 'readinto'):
+            n = await self.stream.readinto(self.mv[self.end:])
+        else:
+            data = await self.stream.read(len(self.buf) - self.end)
+            n = len(data)
+            self.buf[self.end:self.end + n] = data
+        self.end += n
+        return n
+
+    async def head(self):
+        """Read the next request head.
+
+        Returns a tuple with the bytes read and the position of the blank
+        line that ends the head in them, or ``None`` if the connection closed
+        first. This method is a coroutine.
+        """
+        while True:
+            # skip empty lines between requests
+            buf = self.buf
+            while self.end > self.start:
+                if buf[self.start] == 10:
+                    self.start += 1
+                elif buf[self.start] == 13 and \
+                        self.end - self.start >= 2 and \
+                        buf[self.start + 1] == 10:
+                    self.start += 2
+                else:
+                    break
+            if self.end > self.start and self.idle:
+                self.idle = False
+                self.started_us = ticks_us()
+            if self.end - self.start >= 2:
+                head = self._split_head(bytes(self.mv[self.start:self.end]))
+                if head is not None:
+                    return head
+            if not await self._fill():
+                return None
+
+    def _split_head(self, data):
+        # the head ends at the first empty line, and lines may end with a
+        # bare LF as well as CRLF (RFC 9112, section 2.2)
+        i = data.find(b'\n\n')
+        j = data.find(b'\n\r\n')
+        if j >= 0 and (i < 0 or j < i):
+            i, skip = j, 3
+        elif i >= 0:
+            skip = 2
+        else:
+            return None
+        self.start += i + skip
+        if data[i - 1:i] == b'\r' and \
+                data.count(b'\n', 0, i) == data.count(b'\r\n', 0, i):
+            # all CRLF (the usual case), so it's parsed where it is
+            return data, i - 1
+        head = b'\r\n'.join(line.rstrip(b'\r')
+                            for line in data[:i].split(b'\n'))
+        return head + b'\r\n\r\n', len(head)
+
+    async def read(self, n=-1):
+        if self.start < self.end:
+            if n < 0 or n > self.end - self.start:
+                n = self.end - self.start
+            data = bytes(self.mv[self.start:self.start + n])
+            self.start += n
+            return data
+        return await self.stream.read(n)
+
+    async def readexactly(self, n):
+        data = b''
+        if self.start < self.end:
+            data = await self.read(n)
+        if len(data) < n:
+            data += await self.stream.readexactly(n - len(data))
+        return data
+
+    async def readline(self):
+        if self.start < self.end:
+            data = bytes(self.mv[self.start:self.end])
+            i = data.find(b'\n')
+            if i >= 0:
+                self.start += i + 1
+                return data[:i + 1]
+            self.start = self.end
+            return data + await self.stream.readline()
+        return await self.stream.readline()
+
+
+class RawHeaders:
+    """The headers of a request, kept as the bytes they arrived in and only
+    decoded when they are looked up. It can be used like a
+    :class:`NoCaseDict`; changing it or going through all of it decodes all
+    the headers once, into a real :class:`NoCaseDict`.
+
+    :param head: The request head, as bytes.
+    :param start: The position of the first header line in ``head``.
+    :param end: The position of the blank line that ends the head.
+    """
+    def __init__(self, head, start, end):
+        self.head = head
+        self.start = start
+        self.end = end
+        self._lower = None
+        self._values = {}
+        self._dict = None
+
+    def _find(self, key):
+        kl = key.lower()
+        if kl in self._values:
+            return self._values[kl]
+        if self._lower is None:
+            self._lower = self.head.lower()
+        name = b'\r\n' + kl.encode() + b':'
+        value = None
+        # the last one wins, like it would setting them in a dictionary
+        i = self._lower.rfind(name, self.start - 2, self.end)
+        if i >= 0:
+            i += len(name)
+            value = self.head[i:self.head.find(b'\r\n', i)].strip().decode()
+        self._values[kl] = value
+        return value
+
+    def to_dict(self):
+        """Decode all the headers into a :class:`NoCaseDict`."""
+        if self._dict is None:
+            self._dict = NoCaseDict()
+            if self.start < self.end:
+                for line in self.head[self.start:self.end].split(b'\r\n'):
+                    header, value = line.decode().split(':', 1)
+                    self._dict[header] = value.strip()
+        return self._dict
+
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+        value = self._find(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if self._dict is not None:
+            return key in self._dict
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        if self._dict is not None:
+            return self._dict.get(key, default)
+        value = self._find(key)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self.to_dict()[key] = value
+
+    def __delitem__(self, key):
+        del self.to_dict()[key]
+
+    def update(self, other_dict):
+        self.to_dict().update(other_dict)
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def values(self):
+        return self.to_dict().values()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __repr__(self):  # pragma: no cover
+        return repr(self.to_dict())
+
+
 class Request:
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -325,6 +609,16 @@ class Request:
     #:    Request.max_readline = 16 * 1024  # 16KB lines allowed
     max_readline = 2 * 1024
 
+    #: Specify the size of the buffer request heads (the request line and
+    #: all the headers) are read into by the server. Requests with larger
+    #: heads are rejected with a 400 status code. Applications can change
+    #: this maximum as necessary.
+    #:
+    #: Example::
+    #:
+    #:    Request.max_head_length = 4 * 1024  # 4KB heads allowed
+    max_head_length = 2 * 1024
+
     class G:
         pass
 
@@ -378,9 +672,13 @@ class Request:
         self._json = None
         self._form = None
         self.after_request_handlers = []
+        #: The index in the application's URL map of the route that handles
+        #: the request, or ``None`` if no route does.
+        self.route_index = None
 
     @staticmethod
-    async def create(app, client_reader, client_writer, client_addr):
+    async def create(app, client_reader, client_writer, client_addr,
+                     timeout=None):
         """Create a request object.
 
         :param app: The Microdot application instance.
@@ -389,39 +687,77 @@ class Request:
         :param client_writer: An output stream where the response data can be
                               written.
         :param client_addr: The address of the client, as a tuple.
+        :param timeout: The number of seconds to wait for the request head.
+                        If omitted, the application's ``head_timeout`` is
+                        used. The body is waited for for the application's
+                        ``body_timeout``.
 
         This method is a coroutine. It returns a newly created ``Request``
-        object.
+        object. It raises ``asyncio.TimeoutError`` if the head or the body
+        don't arrive in time.
+
+        If ``client_reader`` is a :class:`ConnectionReader`, the head is
+        parsed from its buffer and the headers are only decoded when they are
+        used. Otherwise it is read a line at a time.
         """
-        # request line
-        line = (await Request._safe_readline(client_reader)).strip().decode()
-        if not line:  # pragma: no cover
-            return None
-        method, url, http_version = line.split()
-        http_version = http_version.split('/', 1)[1]
+        if timeout is None:
+            timeout = getattr(app, 'head_timeout', None)
+        if isinstance(client_reader, ConnectionReader):
+            head = await wait_for(client_reader.head(), timeout)
+            if head is None:
+                return None
+            head, end = head
+
+            # request line
+            line_end = head.find(b'\r\n')
+            if line_end < 0 or line_end > end:
+                line_end = end
+            method_end = head.find(b' ', 0, line_end)
+            url_end = head.find(b' ', method_end + 1, line_end)
+            version_start = head.find(b'/', url_end + 1, line_end)
+            if method_end < 0 or url_end < 0 or version_start < 0:
+                raise ValueError('invalid request line')
+            method = head[:method_end].decode()
+            url = head[method_end + 1:url_end].decode()
+            http_version = head[version_start + 1:line_end].decode()
 
-        # headers
-        headers = NoCaseDict()
-        content_length = 0
-        while True:
-            line = (await Request._safe_readline(
-                client_reader)).strip().decode()
-            if line == '':
-                break
-            header, value = line.split(':', 1)
-            value = value.strip()
-            headers[header] = value
-            if header.lower() == 'content-length':
-                content_length = int(value)
+            # headers
+            headers = RawHeaders(head, line_end + 2, end)
+            content_length = int(headers.get('Content-Length', 0))
+        else:
+            # request line
+            line = (await wait_for(Request._safe_readline(client_reader),
+                                   timeout)).strip().decode()
+            if not line:  # pragma: no cover
+                return None
+            method, url, http_version = line.split()
+            http_version = http_version.split('/', 1)[1]
+
+            # headers
+            headers = NoCaseDict()
+            content_length = 0
+            while True:
+                line = (await wait_for(Request._safe_readline(client_reader),
+                                       timeout)).strip().decode()
+                if line == '':
+                    break
+                header, value = line.split(':', 1)
+                value = value.strip()
+                headers[header] = value
+                if header.lower() == 'content-length':
+                    content_length = int(value)
 
         # body
         body = b''
         if content_length and content_length <= Request.max_body_length:
-            body = await client_reader.readexactly(content_length)
+            body = await wait_for(client_reader.readexactly(content_length),
+                                  getattr(app, 'body_timeout', None))
             stream = None
         else:
             body = b''
             stream = client_reader
+        if isinstance(client_reader, ConnectionReader) and stream is None:
+            client_reader.idle = True
 
         return Request(app, client_addr, method, url, http_version, headers,
                        body=body, stream=stream,
@@ -542,6 +878,11 @@ class Response:
 
     send_file_buffer_size = 1024
 
+    #: The largest body, in bytes, that is sent in the same write as the
+    #: status line and headers. Larger bodies, and streamed ones, are written
+    #: after them separately.
+    max_single_write_body = 1024
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -554,6 +895,8 @@ class Response:
     #: written to the client. Used to exit WebSocket connections cleanly.
     already_handled = None
 
+    _file_buffer = None
+
     def __init__(self, body='', status_code=200, headers=None, reason=None):
         if body is None and status_code == 200:
             body = ''
@@ -570,6 +913,14 @@ class Response:
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        #: The HTTP version used in the status line. Set to ``'1.1'`` by the
+        #: server when the client speaks HTTP/1.1.
+        self.http_version = '1.0'
+        #: The size of the file sent by :meth:`send_file`, if it is known.
+        #: Only responses with a file size can answer range requests.
+        self.file_size = None
+        #: How many bytes of the file to send, or ``None`` for all of it.
+        self.file_length = None
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False,
@@ -637,23 +988,46 @@ class Response:
             # status code
             reason = self.reason if self.reason is not None else \
                 ('OK' if self.status_code == 200 else 'N/A')
-            await stream.awrite('HTTP/1.0 {status_code} {reason}\r\n'.format(
-                status_code=self.status_code, reason=reason).encode())
+            head = ['HTTP/{version} {status_code} {reason}\r\n'.format(
+                version=self.http_version, status_code=self.status_code,
+                reason=reason)]
 
             # headers
             for header, value in self.headers.items():
                 values = value if isinstance(value, list) else [value]
                 for value in values:
-                    await stream.awrite('{header}: {value}\r\n'.format(
-                        header=header, value=value).encode())
-            await stream.awrite(b'\r\n')
+                    head.append('{header}: {value}\r\n'.format(
+                        header=header, value=value))
+            head.append('\r\n')
+            head = ''.join(head).encode()
+
+            # the status line, headers and a small body go out in one write
+            if isinstance(self.body, bytes) and \
+                    len(self.body) <= self.max_single_write_body:
+                await stream.awrite(head if self.is_head
+                                    else head + self.body)
+                return
+            await stream.awrite(head)
 
             # body
-            if not self.is_head:
+            chunked = self.headers.get('Transfer-Encoding') == 'chunked'
+            if hasattr(self.body, 'readinto') and not chunked:
+                try:
+                    if not self.is_head:
+                        await self._write_file(stream)
+                finally:
+                    self.body.close()
+            elif not self.is_head:
                 iter = self.body_iter()
                 async for body in iter:
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
+                    if chunked:
+                        if not body:
+                            # an empty chunk would end the body early
+                            continue
+                        body = '{:x}\r\n'.format(len(body)).encode() + \
+                            body + b'\r\n'
                     try:
                         await stream.awrite(body)
                     except OSError as exc:  # pragma: no cover
@@ -664,6 +1038,8 @@ class Response:
                         raise
                 if hasattr(iter, 'aclose'):  # pragma: no branch
                     await iter.aclose()
+                if chunked:
+                    await stream.awrite(b'0\r\n\r\n')
 
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS or \
@@ -671,6 +1047,94 @@ class Response:
                 pass
             else:
                 raise
+        finally:
+            # an async body is closed however the write ends, including
+            # when it was never iterated (a HEAD request, or a failed head
+            # write), so whatever it holds is released
+            if hasattr(self.body, 'aclose'):
+                await self.body.aclose()
+
+    async def _write_file(self, stream):
+        remaining = self.file_length
+        if getattr(stream, 'transport', None) is not None and \
+                hasattr(self.body, 'fileno'):
+            # standard Python: let the OS copy the file to the socket (loop
+            # sendfile reads and writes it in chunks itself if it can't)
+            await stream.drain()
+            await asyncio.get_running_loop().sendfile(
+                stream.transport, self.body, self.body.tell(), remaining)
+            return
+
+        # read the file through one buffer, instead of allocating a new one
+        # for every read (writes copy the data before they wait, so the
+        # buffer can be shared by all responses)
+        if Response._file_buffer is None or \
+                len(Response._file_buffer) != self.send_file_buffer_size:
+            Response._file_buffer = bytearray(self.send_file_buffer_size)
+        buf = memoryview(Response._file_buffer)
+        while remaining is None or remaining > 0:
+            n = len(buf) if remaining is None else min(len(buf), remaining)
+            n = self.body.readinto(buf[:n])
+            if iscoroutine(n):  # pragma: no cover
+                n = await n
+            if not n:
+                break
+            await stream.awrite(buf[:n])
+            if remaining is not None:
+                remaining -= n
+
+    def set_range(self, range_header):
+        """Make a response from :meth:`send_file` send only the part of the
+        file a ``Range`` header asks for, with a ``206 Partial Content``
+        status, or a ``416 Range Not Satisfiable`` if that part starts past
+        the end of the file. Only single ``bytes`` ranges are supported; for
+        anything else, and for invalid ranges such as ``bytes=5-3``, the
+        whole file is sent, as the header allows.
+
+        :param range_header: The value of the request's ``Range`` header.
+        """
+        size = self.file_size
+        if size is None or self.status_code != 200 or \
+                not range_header.startswith('bytes=') or ',' in range_header:
+            return
+        try:
+            start, end = range_header[6:].strip().split('-', 1)
+            # at least one end, and only digits (int() would also take signs,
+            # as in bytes=--5, and spaces); anything else is ignored
+            if not (start or end) or (start and not start.isdigit()) or \
+                    (end and not end.isdigit()):
+                return
+            if start:
+                start = int(start)
+                if not end:
+                    end = size - 1
+                elif int(end) < start:
+                    # not a valid range, so it is ignored (RFC 9110, 14.2)
+                    return
+                else:
+                    end = int(end)
+            else:
+                # the last bytes of the file
+                start = max(size - int(end), 0)
+                end = size - 1 if int(end) else -1
+        except ValueError:
+            return
+        end = min(end, size - 1)
+        if start > end:
+            self.body.close()
+            self.body = b''
+            self.status_code = 416
+            self.reason = 'Range Not Satisfiable'
+            self.headers['Content-Range'] = 'bytes */{}'.format(size)
+            self.headers['Content-Length'] = '0'
+            return
+        self.body.seek(start)
+        self.status_code = 206
+        self.reason = 'Partial Content'
+        self.file_length = end - start + 1
+        self.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end,
+                                                                size)
+        self.headers['Content-Length'] = str(self.file_length)
 
     def body_iter(self):
         if hasattr(self.body, '__anext__'):
@@ -794,7 +1258,155 @@ class Response:
                 if isinstance(compressed, str) else 'gzip'
 
         f = stream or open(filename + file_extension, 'rb')
-        return cls(body=f, status_code=status_code, headers=headers)
+        res = cls(body=f, status_code=status_code, headers=headers)
+        try:
+            start = f.tell()
+            res.file_size = f.seek(0, 2) - start
+            f.seek(start)
+        except (AttributeError, OSError, TypeError):  # pragma: no cover
+            # not a seekable stream, so sent as it is read
+            pass
+        else:
+            res.headers['Content-Length'] = str(res.file_size)
+            res.headers['Accept-Ranges'] = 'bytes'
+        return res
+
+
+class StaticResponse:
+    """A response that never changes, such as a page of the application's
+    user interface. The body is compressed with gzip once, and the response
+    is serialized the first time each variant of it is sent, so serving it
+    again is a single write of ready made bytes. It carries an ``ETag``, so
+    clients that already have it get a ``304 Not Modified`` answer with no
+    body instead.
+
+    A route handler can return the same ``StaticResponse`` for every
+    request. Changing its headers (for example in an after request handler)
+    has no effect, since the serialized bytes are what is sent.
+
+    :param body: The body of the response, as a string or bytes.
+    :param status_code: The numeric HTTP status code of the response. The
+                        default is 200.
+    :param headers: A dictionary of headers to include in the response.
+    :param max_age: The ``Cache-Control`` header's ``max-age`` value in
+                    seconds. If omitted, clients are asked to check the
+                    ``ETag`` every time with ``no-cache``.
+    :param compress: Whether to send a gzip compressed body to clients that
+                     accept it. The body is only sent compressed if gzip
+                     support is available and compressing makes it smaller.
+
+    Example::
+
+        INDEX = StaticResponse(open('index.html').read(), max_age=3600,
+                               headers={'Content-Type': 'text/html'})
+
+        @app.route('/')
+        def index(request):
+            return INDEX
+    """
+    def __init__(self, body, status_code=200, headers=None, max_age=None,
+                 compress=True):
+        if isinstance(body, str):
+            body = body.encode()
+        self.body = body
+        self.status_code = status_code
+        self.gzipped = gzip_compress(body) if compress else None
+        if self.gzipped is not None and len(self.gzipped) >= len(body):
+            self.gzipped = None
+        self.etag = etag_for(body)
+
+        self.headers = NoCaseDict(headers or {})
+        if 'Content-Type' not in self.headers:
+            self.headers['Content-Type'] = \
+                Response.default_content_type + '; charset=UTF-8'
+        self.headers['ETag'] = self.etag
+        self.headers['Cache-Control'] = 'no-cache' if max_age is None \
+            else 'max-age={}'.format(max_age)
+        if self.gzipped is not None:
+            self.headers['Vary'] = 'Accept-Encoding'
+        # serialized responses, by (variant, http version, connection, head)
+        self._serialized = {}
+
+    def respond(self, req):
+        """Return the response to send for a request, which depends on the
+        ``If-None-Match`` and ``Accept-Encoding`` headers it has.
+
+        :param req: The request.
+        """
+        variant = 'identity'
+        if req is not None:
+            if req.method in ('GET', 'HEAD') and \
+                    self.etag in req.headers.get('If-None-Match', ''):
+                variant = 'not-modified'
+            elif self.gzipped is not None and \
+                    'gzip' in req.headers.get('Accept-Encoding', ''):
+                variant = 'gzip'
+        return CachedResponse(self, variant)
+
+    def serialized(self, variant, http_version, connection, is_head):
+        """Return the complete response, status line to body, as bytes.
+
+        :param variant: ``'identity'``, ``'gzip'`` or ``'not-modified'``.
+        :param http_version: The HTTP version for the status line.
+        :param connection: The value of the ``Connection`` header.
+        :param is_head: Whether to leave the body out, for a ``HEAD``
+                        request.
+        """
+        key = (variant, http_version, connection, is_head)
+        data = self._serialized.get(key)
+        if data is not None:
+            return data
+        if variant == 'not-modified':
+            status = '304 Not Modified'
+            headers = [(name, self.headers[name])
+                       for name in ('ETag', 'Cache-Control', 'Vary')
+                       if name in self.headers]
+            body = b''
+        else:
+            reason = 'OK' if self.status_code == 200 else 'N/A'
+            status = '{} {}'.format(self.status_code, reason)
+            headers = list(self.headers.items())
+            body = self.gzipped if variant == 'gzip' else self.body
+            if variant == 'gzip':
+                headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Content-Length', str(len(body))))
+        headers.append(('Connection', connection))
+        data = 'HTTP/{} {}\r\n'.format(http_version, status) + ''.join(
+            '{}: {}\r\n'.format(name, value) for name, value in headers) + \
+            '\r\n'
+        data = data.encode() + (b'' if is_head else body)
+        self._serialized[key] = data
+        return data
+
+
+class CachedResponse(Response):
+    """A response for one request made from a :class:`StaticResponse`.
+
+    :param static: The static response.
+    :param variant: Which of the static response's variants to send (see
+                    :meth:`StaticResponse.serialized`).
+    """
+    def __init__(self, static, variant):
+        if variant == 'not-modified':
+            super().__init__(b'', 304)
+        else:
+            super().__init__(static.gzipped if variant == 'gzip'
+                             else static.body, static.status_code)
+            self.headers['Content-Length'] = str(len(self.body))
+        self.static = static
+        self.variant = variant
+
+    async def write(self, stream):
+        try:
+            await stream.awrite(self.static.serialized(
+                self.variant, self.http_version,
+                self.headers.get('Connection', 'close'), self.is_head))
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS or \
+                    exc.args[0] == 'Connection lost':
+                pass
+            else:
+                raise
 
 
 class URLPattern():
@@ -892,6 +1504,114 @@ class URLPattern():
             return None, None
 
 
+class Router:
+    """An index of an application's routes, to find the ones that match a
+    path without trying every route in turn. Static paths are looked up in a
+    dictionary, patterns made of static, ``string`` and ``int`` segments are
+    walked as a tree of segments, and only patterns that need a regular
+    expression (``path`` and ``re:``) are matched one by one.
+
+    :param url_map: The application's list of
+                    ``(methods, URLPattern, handler)`` routes.
+    """
+    def __init__(self, url_map):
+        self.url_map = url_map
+        self.size = len(url_map)
+        # static path -> indexes of the routes for it
+        self.static = {}
+        # a node is (static children, children by segment type, routes
+        # ending at the node as (index, argument names))
+        self.tree = ({}, {}, [])
+        self.dynamic = False
+        self.regex = []
+        for index, (methods, pattern, handler) in enumerate(url_map):
+            if pattern.regex:
+                self.regex.append(index)
+            elif all('name' not in segment for segment in pattern.segments):
+                path = '/' + pattern.url_pattern.lstrip('/')
+                self.static.setdefault(path, []).append(index)
+            else:
+                self.dynamic = True
+                node = self.tree
+                names = []
+                for part, segment in zip(
+                        pattern.url_pattern.lstrip('/').split('/'),
+                        pattern.segments):
+                    if 'name' in segment:
+                        names.append(segment['name'])
+                        node = node[1].setdefault(segment['type'],
+                                                  ({}, {}, []))
+                    else:
+                        node = node[0].setdefault(part, ({}, {}, []))
+                node[2].append((index, names))
+
+        # the Allow header methods for every static path
+        self.allow = {}
+        for path in self.static:
+            self.allow[path] = self._allow(path)
+
+    def match(self, path):
+        """Find the routes that match a path.
+
+        :param path: The path portion of the request URL.
+
+        Returns a list of ``(index, args)`` tuples, in the order the routes
+        are in the URL map, where ``args`` are the route's path arguments.
+        """
+        found = [(index, {}) for index in self.static.get(path, ())]
+        if not self.dynamic and not self.regex:
+            return found
+        if self.dynamic and path[:1] == '/':
+            self._walk(self.tree, path[1:].split('/'), 0, [], found)
+        for index in self.regex:
+            args = self.url_map[index][1].match(path)
+            if args is not None:
+                found.append((index, args))
+        if len(found) > 1:
+            found.sort(key=lambda match: match[0])
+        return found
+
+    def allowed(self, path):
+        """Return the list of methods the routes matching a path accept.
+
+        :param path: The path portion of the request URL.
+        """
+        if path in self.allow:
+            return self.allow[path]
+        return self._allow(path)
+
+    def _allow(self, path):
+        allow = []
+        for index, args in self.match(path):
+            for method in self.url_map[index][0]:
+                if method not in allow:
+                    allow.append(method)
+        return allow
+
+    def _walk(self, node, parts, i, values, found):
+        if i == len(parts):
+            for index, names in node[2]:
+                found.append((index, dict(zip(names, values))))
+            return
+        part = parts[i]
+        child = node[0].get(part)
+        if child is not None:
+            self._walk(child, parts, i + 1, values, found)
+        for type_, child in node[1].items():
+            if type_ == 'int':
+                try:
+                    value = int(part)
+                except ValueError:
+                    continue
+            elif part:
+                value = part
+            else:
+                continue
+            values.append(value)
+            self._walk(child, parts, i + 1, values, found)
+            values.pop()
+
+
 class HTTPException(Exception):
     def __init__(self, status_code, reason=None):
         self.status_code = status_code
@@ -901,6 +1621,329 @@ class HTTPException(Exception):
         return 'HTTPException: {}'.format(self.status_code)
 
 
+class WebSocketError(Exception):
+    """Exception raised when a WebSocket connection fails or is closed."""
+    pass
+
+
+class WebSocket:
+    """A WebSocket connection, made by upgrading a request (see
+    :func:`with_websocket`). Messages are read straight from the request's
+    connection, so they need no more parsing than their frame header.
+
+    :param request: The request to upgrade.
+    """
+    CONT = 0
+    TEXT = 1
+    BINARY = 2
+    CLOSE = 8
+    PING = 9
+    PONG = 10
+
+    #: The maximum length of a received message, in bytes. The connection is
+    #: closed if a longer one arrives.
+    max_message_length = 4 * 1024
+
+    def __init__(self, request):
+        self.request = request
+        self.closed = False
+
+    async def handshake(self):
+        """Accept the upgrade, by sending the ``101 Switching Protocols``
+        response. This method is a coroutine.
+        """
+        accept = self._handshake_response()
+        await self.request.sock[1].awrite(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    async def receive(self):
+        """Receive the next message, as a string for text messages or bytes
+        for binary ones. Pings are answered while waiting. This method is a
+        coroutine. It raises :class:`WebSocketError` when the client closes
+        the connection.
+        """
+        while True:
+            opcode, payload = await self._read_frame()
+            if opcode == self.TEXT:
+                return payload.decode()
+            elif opcode == self.BINARY:
+                return payload
+            elif opcode == self.CLOSE:
+                raise WebSocketError('Websocket connection closed')
+            elif opcode == self.PING:
+                await self.send(payload, self.PONG)
+            elif opcode != self.PONG:
+                raise WebSocketError('Unsupported websocket frame')
+
+    async def send(self, data, opcode=None):
+        """Send a message.
+
+        :param data: The message, as a string for a text message or bytes for
+                     a binary one.
+        :param opcode: The frame's opcode, if not the one for the type of
+                       ``data``.
+
+        This method is a coroutine.
+        """
+        if opcode is None:
+            opcode = self.TEXT if isinstance(data, str) else self.BINARY
+        if isinstance(data, str):
+            data = data.encode()
+        await self.request.sock[1].awrite(self._encode_frame(opcode, data))
+
+    async def close(self):
+        """Close the connection, telling the client first. This method is a
+        coroutine.
+        """
+        if not self.closed:  # pragma: no cover
+            self.closed = True
+            await self.send(b'', self.CLOSE)
+
+    def _handshake_response(self):
+        connection = self.request.headers.get('Connection', '').lower()
+        upgrade = self.request.headers.get('Upgrade', '').lower()
+        key = self.request.headers.get('Sec-WebSocket-Key')
+        if 'upgrade' not in connection or upgrade != 'websocket' or not key:
+            raise HTTPException(400, 'Bad Request')
+        try:
+            from hashlib import sha1
+        except ImportError:  # pragma: no cover
+            from uhashlib import sha1
+        from binascii import b2a_base64
+        return b2a_base64(sha1(
+            key.encode() + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest(),
+        )[:-1]
+
+    async def _read_frame(self):
+        stream = self.request.sock[0]
+        header = await stream.readexactly(2)
+        if not header[0] & 0x80:
+            raise WebSocketError('Fragmented messages are not supported')
+        opcode = header[0] & 0x0f
+        length = header[1] & 0x7f
+        if length == 126:
+            length = int.from_bytes(await stream.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await stream.readexactly(8), 'big')
+        if length > self.max_message_length:
+            raise WebSocketError('Message too large')
+        if header[1] & 0x80:
+            # client frames are masked, so the payload has to be unmasked
+            data = await stream.readexactly(4 + length)
+            payload = bytearray(data[4:])
+            for i in range(length):
+                payload[i] ^= data[i & 3]
+        else:
+            payload = await stream.readexactly(length) if length else b''
+        return opcode, bytes(payload)
+
+    @staticmethod
+    def _encode_frame(opcode, payload):
+        # server frames aren't masked, and the header and payload go out in a
+        # single write
+        length = len(payload)
+        if length < 126:
+            header = bytes((0x80 | opcode, length))
+        elif length < 65536:
+            header = bytes((0x80 | opcode, 126)) + length.to_bytes(2, 'big')
+        else:
+            header = bytes((0x80 | opcode, 127)) + length.to_bytes(8, 'big')
+        return header + payload
+
+
+def with_websocket(f):
+    """Decorator to make a route a WebSocket endpoint. The handler is a
+    coroutine that is given the request and a :class:`WebSocket`, and the
+    connection is closed when it returns.
+
+    Example::
+
+        @app.route('/echo')
+        @with_websocket
+        async def echo(request, ws):
+            while True:
+                message = await ws.receive()
+                await ws.send(message)
+    """
+    async def wrapper(request, *args, **kwargs):
+        ws = WebSocket(request)
+        await ws.handshake()
+        try:
+            await invoke_handler(f, request, ws, *args, **kwargs)
+        except OSError as exc:
+            if exc.errno not in MUTED_SOCKET_ERRORS and \
+                    exc.args[0] != 'Connection lost':  # pragma: no cover
+                raise
+        except (WebSocketError, EOFError):
+            # the client closed the connection, or broke the protocol
+            pass
+        finally:
+            try:
+                await ws.close()
+            except Exception:  # pragma: no cover
+                pass
+        return Response.already_handled
+    return wrapper
+
+
+class Metrics:
+    """Request counts, response status counts and latency histograms for
+    every route of an application. Each request's time is split into three
+    phases: ``parse`` (from its first bytes arriving to it being parsed),
+    ``handler`` (routing, hooks and the handler) and ``write`` (sending the
+    response). The numbers are kept in arrays that are allocated up front,
+    so recording a request doesn't allocate anything.
+
+    Requests that didn't match a route (such as 404s) are counted together.
+
+    :param app: The application to record.
+    """
+    #: The upper bounds of the latency buckets, in microseconds. Slower
+    #: requests go in one more bucket after these.
+    BUCKETS = (250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000,
+               250000, 1000000)
+
+    PHASES = ('parse', 'handler', 'write')
+
+    def __init__(self, app):
+        self.app = app
+        self.slots = 0
+        self._allocate(len(app.url_map))
+
+    def _allocate(self, routes):
+        # slot 0 is for requests that didn't match a route, then one per
+        # route in the URL map
+        old = self.slots
+        self.slots = routes + 1
+        sizes = (
+            ('histograms',
+             self.slots * len(self.PHASES) * (len(self.BUCKETS) + 1)),
+            # the time spent in each phase, split in whole seconds and the
+            # microseconds left over so both stay small integers
+            ('seconds', self.slots * len(self.PHASES)),
+            ('micros', self.slots * len(self.PHASES)),
+            ('statuses', self.slots * 5),
+        )
+        for name, size in sizes:
+            values = array('I', (0 for _ in range(size)))
+            if old:
+                # routes were added, keep what was recorded so far
+                for i, value in enumerate(getattr(self, name)):
+                    values[i] = value
+            setattr(self, name, values)
+
+    def record(self, route_index, status_code, parse_us, handler_us,
+               write_us):
+        """Record a request.
+
+        :param route_index: The index of the request's route in the URL map,
+                            or ``None``.
+        :param status_code: The response's status code.
+        :param parse_us: The time spent parsing the request, in microseconds.
+        :param handler_us: The time spent handling it.
+        :param write_us: The time spent writing the response.
+        """
+        slot = 0 if route_index is None else route_index + 1
+        if slot >= self.slots:
+            self._allocate(len(self.app.url_map))
+        if 100 <= status_code < 600:
+            self.statuses[slot * 5 + status_code // 100 - 1] += 1
+        phase = slot * len(self.PHASES)
+        self._add(phase, parse_us)
+        self._add(phase + 1, handler_us)
+        self._add(phase + 2, write_us)
+
+    def _add(self, phase, us):
+        bucket = 0
+        for bound in self.BUCKETS:
+            if us <= bound:
+                break
+            bucket += 1
+        self.histograms[phase * (len(self.BUCKETS) + 1) + bucket] += 1
+        micros = self.micros[phase] + us
+        if micros >= 1000000:
+            self.seconds[phase] += micros // 1000000
+            micros %= 1000000
+        self.micros[phase] = micros
+
+    def reset(self):
+        """Forget everything recorded."""
+        for values in (self.histograms, self.seconds, self.micros,
+                       self.statuses):
+            for i in range(len(values)):
+                values[i] = 0
+
+    def _routes(self):
+        # (slot, route label, methods) for every slot that has requests
+        buckets = len(self.BUCKETS) + 1
+        per_slot = len(self.PHASES) * buckets
+        for slot in range(self.slots):
+            if not sum(self.histograms[slot * per_slot:
+                                       slot * per_slot + buckets]):
+                continue
+            if slot == 0:
+                yield slot, '(unmatched)', []
+            else:
+                methods, pattern, handler = self.app.url_map[slot - 1]
+                yield slot, pattern.url_pattern, methods
+
+    def _phase(self, slot, phase):
+        buckets = len(self.BUCKETS) + 1
+        i = (slot * len(self.PHASES) + phase) * buckets
+        phase = slot * len(self.PHASES) + phase
+        return (list(self.histograms[i:i + buckets]),
+                self.seconds[phase] * 1000000 + self.micros[phase])
+
+    def to_dict(self):
+        """Return the metrics as a dictionary, for sending as JSON."""
+        routes = []
+        for slot, route, methods in self._routes():
+            entry = {'route': route, 'methods': methods,
+                     'status': {}}
+            for i in range(5):
+                if self.statuses[slot * 5 + i]:
+                    entry['status']['{}xx'.format(i + 1)] = \
+                        self.statuses[slot * 5 + i]
+            for phase, name in enumerate(self.PHASES):
+                counts, total = self._phase(slot, phase)
+                entry[name] = {'buckets': counts, 'sum_us': total}
+            entry['requests'] = sum(entry['handler']['buckets'])
+            routes.append(entry)
+        return {'buckets_us': list(self.BUCKETS), 'routes': routes}
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = ['# TYPE microdot_request_duration_seconds histogram']
+        statuses = ['# TYPE microdot_responses_total counter']
+        for slot, route, methods in self._routes():
+            labels = 'route="{}",methods="{}"'.format(route,
+                                                      ','.join(methods))
+            for phase, name in enumerate(self.PHASES):
+                counts, total = self._phase(slot, phase)
+                phase_labels = labels + ',phase="{}"'.format(name)
+                count = 0
+                for bound, n in zip(self.BUCKETS + (None,), counts):
+                    count += n
+                    le = '+Inf' if bound is None else str(bound / 1000000)
+                    lines.append('microdot_request_duration_seconds_bucket'
+                                 '{{{},le="{}"}} {}'.format(phase_labels, le,
+                                                            count))
+                lines.append('microdot_request_duration_seconds_sum{{{}}} '
+                             '{}'.format(phase_labels, total / 1000000))
+                lines.append('microdot_request_duration_seconds_count{{{}}} '
+                             '{}'.format(phase_labels, count))
+            for i in range(5):
+                if self.statuses[slot * 5 + i]:
+                    statuses.append(
+                        'microdot_responses_total{{{},status="{}xx"}} '
+                        '{}'.format(labels, i + 1,
+                                    self.statuses[slot * 5 + i]))
+        return '\n'.join(lines + statuses) + '\n'
+
+
 class Microdot:
     """An HTTP application class.
 
@@ -914,6 +1957,51 @@ class Microdot:
 
         app = Microdot()
     """
+    #: How sync handlers are run on standard Python (MicroPython always runs
+    #: them on the event loop). ``'thread'`` runs them on the application's
+    #: thread pool, so a handler that blocks doesn't hold up other requests.
+    #: ``'inline'`` runs them on the event loop, which saves the hop to a
+    #: thread for handlers that return straight away. The ``blocking``
+    #: argument of :meth:`route` overrides this for a handler.
+    sync_handlers = 'thread'
+
+    #: The number of threads in the pool sync handlers run on.
+    max_threads = 4
+
+    #: The number of sync handlers that can be waiting for a thread. While
+    #: this many are waiting, requests for routes with threaded handlers get
+    #: a 503 response.
+    max_queued_handlers = 16
+
+    #: The maximum number of connections served at once. Connections over
+    #: the limit get a 503 response straight away. ``None`` means no limit.
+    max_connections = None
+
+    #: The most connections over ``max_connections`` answered with a 503 at
+    #: once. Any more are closed without an answer, so a flood of them can't
+    #: tie up sockets and tasks while being turned away.
+    max_rejections = 2
+
+    #: The number of connections the network stack queues before they are
+    #: accepted. ``None`` uses the platform's default.
+    backlog = None
+
+    #: The number of seconds a client has to send a request head (the
+    #: request line and headers) once it connects. ``None`` waits forever.
+    head_timeout = 10
+
+    #: The number of seconds a client has to send a request body once the
+    #: head has arrived. ``None`` waits forever.
+    body_timeout = 30
+
+    #: The number of seconds an idle keep-alive connection is held open
+    #: waiting for its next request. Each open connection ties up a socket,
+    #: which are scarce on microcontrollers.
+    keep_alive_timeout = 5
+
+    #: The maximum number of requests served over one connection before it
+    #: is closed. Set to 1 to disable keep-alive.
+    max_keep_alive_requests = 100
 
     def __init__(self):
         self.url_map = []
@@ -925,8 +2013,29 @@ class Microdot:
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
-
-    def route(self, url_pattern, methods=None):
+        self._router = None
+        # handlers registered with a blocking argument, and whether they
+        # block
+        self.blocking_handlers = {}
+        self._executor = None
+        #: The number of threaded handlers running or waiting for a thread.
+        self.handlers_pending = 0
+        #: The number of requests rejected because the thread pool was full.
+        self.handlers_rejected = 0
+        #: The application's :class:`Metrics`, if they have been enabled
+        #: with :meth:`enable_metrics`.
+        self.metrics = None
+        #: The number of connections being served.
+        self.connections_active = 0
+        #: The number of connections turned away by ``max_connections``.
+        self.connections_rejected = 0
+        #: The number of those being answered with a 503 right now.
+        self.rejections_active = 0
+        #: The number of connections closed because a request head or body
+        #: took too long to arrive.
+        self.connections_timed_out = 0
+
+    def route(self, url_pattern, methods=None, blocking=None):
         """Decorator that is used to register a function as a request handler
         for a given URL.
 
@@ -935,6 +2044,10 @@ class Microdot:
         :param methods: The list of HTTP methods to be handled by the
                         decorated function. If omitted, only ``GET`` requests
                         are handled.
+        :param blocking: For a sync handler, ``True`` if it can block, so it
+                         always runs on the thread pool, or ``False`` if it
+                         returns straight away, so it always runs on the event
+                         loop. If omitted, :attr:`sync_handlers` decides.
 
         The URL pattern can be a static path (for example, ``/users`` or
         ``/api/invoices/search``) or a path with dynamic components enclosed
@@ -960,6 +2073,9 @@ class Microdot:
             self.url_map.append(
                 ([m.upper() for m in (methods or ['GET'])],
                  URLPattern(url_pattern), f))
+            self._router = None
+            if blocking is not None:
+                self.blocking_handlers[f] = blocking
             return f
         return decorated
 
@@ -1137,6 +2253,8 @@ class Microdot:
             self.url_map.append(
                 (methods, URLPattern(url_prefix + pattern.url_pattern),
                  handler))
+        self._router = None
+        self.blocking_handlers.update(subapp.blocking_handlers)
         for handler in subapp.before_request_handlers:
             self.before_request_handlers.append(handler)
         for handler in subapp.after_request_handlers:
@@ -1224,17 +2342,30 @@ class Microdot:
                 writer.awrite = MethodType(awrite, writer)
                 writer.aclose = MethodType(aclose, writer)
 
-            await self.handle_request(reader, writer)
+            if self.max_connections is not None and \
+                    self.connections_active >= self.max_connections:
+                self.connections_rejected += 1
+                await self.reject_connection(reader, writer)
+                return
+            self.connections_active += 1
+            try:
+                await self.handle_request(reader, writer)
+            finally:
+                self.connections_active -= 1
 
         if self.debug:  # pragma: no cover
             print('Starting async server on {host}:{port}...'.format(
                 host=host, port=port))
 
+        kwargs = {}
+        if self.backlog is not None:
+            kwargs['backlog'] = self.backlog
         try:
             self.server = await asyncio.start_server(serve, host, port,
-                                                     ssl=ssl)
+                                                     ssl=ssl, **kwargs)
         except TypeError:  # pragma: no cover
-            self.server = await asyncio.start_server(serve, host, port)
+            self.server = await asyncio.start_server(serve, host, port,
+                                                     **kwargs)
 
         while True:
             try:
@@ -1299,6 +2430,102 @@ class Microdot:
         """
         self.server.close()
 
+    def enable_metrics(self, url='/metrics'):
+        """Start recording request counts and latencies for every route, in
+        a :class:`Metrics` object.
+
+        :param url: The URL to serve the metrics at, or ``None`` to not serve
+                    them. They are sent as JSON, or in the Prometheus text
+                    format if the request has ``?format=prometheus`` or only
+                    accepts ``text/plain``.
+        """
+        self.metrics = Metrics(self)
+        if url is not None:
+            @self.route(url)
+            async def metrics(req):
+                if req.args.get('format') == 'prometheus' or \
+                        req.headers.get('Accept', '').startswith(
+                            'text/plain'):
+                    return self.metrics.prometheus(), 200, {
+                        'Content-Type': 'text/plain; version=0.0.4'}
+                return self.metrics.to_dict()
+        return self.metrics
+
+    def server_stats(self):
+        """Return the connection and handler counters, as a dictionary."""
+        return {
+            'connections_active': self.connections_active,
+            'connections_rejected': self.connections_rejected,
+            'rejections_active': self.rejections_active,
+            'connections_timed_out': self.connections_timed_out,
+            'handlers_pending': self.handlers_pending,
+            'handlers_rejected': self.handlers_rejected,
+        }
+
+    async def reject_connection(self, reader, writer):
+        """Answer a connection over the ``max_connections`` limit with a 503
+        response and close it, without parsing its request. Once
+        ``max_rejections`` are being answered, the connection is just closed.
+
+        This method is a coroutine.
+        """
+        if self.rejections_active < self.max_rejections:
+            self.rejections_active += 1
+            try:
+                res = Response('Server busy', 503,
+                               {'Retry-After': '1', 'Connection': 'close'},
+                               reason='Service Unavailable')
+                await res.write(writer)
+                # take what the client has sent (briefly), so closing doesn't
+                # reset the connection before it reads the response
+                await wait_for(reader.read(Request.max_head_length), 0.2)
+            except Exception:
+                pass
+            finally:
+                self.rejections_active -= 1
+        try:
+            await writer.aclose()
+        except OSError:  # pragma: no cover
+            pass
+
+    def threaded(self, handler):
+        """Return whether a handler runs on the thread pool."""
+        if ThreadPoolExecutor is None or iscoroutinefunction(handler):
+            return False
+        return self.blocking_handlers.get(handler,
+                                          self.sync_handlers == 'thread')
+
+    def executor(self):
+        """Return the thread pool sync handlers run on."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        return self._executor
+
+    async def run_handler(self, handler, *args, **kwargs):
+        """Invoke a handler and return the result, on the thread pool or the
+        event loop as :meth:`threaded` says.
+
+        This method is a coroutine.
+        """
+        if not self.threaded(handler):
+            ret = handler(*args, **kwargs)
+            if iscoroutine(ret):
+                ret = await ret
+            return ret
+        self.handlers_pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor(), partial(handler, *args, **kwargs))
+        finally:
+            self.handlers_pending -= 1
+
+    def router(self):
+        """Return the :class:`Router` for the application's routes, building
+        it again if routes were added since it was last built."""
+        if self._router is None or self._router.size != len(self.url_map):
+            self._router = Router(self.url_map)
+        return self._router
+
     def find_route(self, req):
         method = req.method.upper()
         if method == 'OPTIONS' and self.options_handler:
@@ -1306,37 +2533,117 @@ class Microdot:
         if method == 'HEAD':
             method = 'GET'
         f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
-                if method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+        req.url_args = None
+        for index, args in self.router().match(req.path):
+            route_methods, route_pattern, route_handler = self.url_map[index]
+            req.url_args = args
+            if method in route_methods:
+                f = route_handler
+                req.route_index = index
+                break
+            else:
+                f = 405
         return f
 
     def default_options_handler(self, req):
-        allow = []
-        for route_methods, route_pattern, route_handler in self.url_map:
-            if route_pattern.match(req.path) is not None:
-                allow.extend(route_methods)
+        allow = list(self.router().allowed(req.path))
         if 'GET' in allow:
             allow.append('HEAD')
         allow.append('OPTIONS')
         return {'Allow': ', '.join(allow)}
 
+    def keep_alive(self, req, res, count):
+        """Decide whether a connection can be reused after a response, and
+        add the ``Connection`` header (and chunked framing, if needed) to the
+        response to match.
+
+        :param req: The request, or ``None`` if it could not be parsed.
+        :param res: The response about to be written.
+        :param count: The number of requests served on the connection so far,
+                      including this one.
+        """
+        keep = req is not None
+        if keep:
+            connection = req.headers.get('Connection', '').lower()
+            if req.http_version == '1.1':
+                # answer in the request's version, even when closing
+                res.http_version = '1.1'
+                keep = 'close' not in connection
+            else:
+                keep = 'keep-alive' in connection
+        if keep and count >= self.max_keep_alive_requests:
+            keep = False
+        if keep and req.content_length > Request.max_body_length:
+            # the body was left on the stream, and may not have been read
+            keep = False
+        if keep and 'Transfer-Encoding' in req.headers:
+            # a chunked body isn't read, so it is still on the stream and
+            # would be taken for the next request
+            keep = False
+        if keep and res.headers.get('Connection', '').lower() == 'close':
+            keep = False
+        if keep and not isinstance(res.body, bytes) and \
+                'Content-Length' not in res.headers:
+            # the client can only find the end of a body of unknown length
+            # by the connection closing, unless it is sent in chunks
+            if res.http_version == '1.1':
+                res.headers['Transfer-Encoding'] = 'chunked'
+            else:
+                keep = False
+        res.headers['Connection'] = 'keep-alive' if keep else 'close'
+        return keep
+
     async def handle_request(self, reader, writer):
-        req = None
-        try:
-            req = await Request.create(self, reader, writer,
-                                       writer.get_extra_info('peername'))
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
-
-        res = await self.dispatch_request(req)
-        if res != Response.already_handled:  # pragma: no branch
-            await res.write(writer)
+        client_addr = writer.get_extra_info('peername')
+        reader = ConnectionReader(reader)
+        count = 0
+        while True:
+            req = None
+            try:
+                # a kept alive connection waits for its next request for the
+                # keep-alive timeout, not the head timeout
+                req = await Request.create(
+                    self, reader, writer, client_addr,
+                    self.keep_alive_timeout if count else None)
+            except asyncio.TimeoutError:
+                if not reader.idle:
+                    # stopped part way through a request
+                    await Response('Request timeout', 408,
+                                   {'Connection': 'close'},
+                                   reason='Request Timeout').write(writer)
+                if not count or not reader.idle:
+                    self.connections_timed_out += 1
+                break
+            except OSError:
+                if count:
+                    break
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            if req is None and count:
+                # the client closed the connection
+                break
+            count += 1
+
+            parsed = ticks_us()
+            res = await self.dispatch_request(req)
+            handled = ticks_us()
+            keep = False
+            if res != Response.already_handled:  # pragma: no branch
+                keep = self.keep_alive(req, res, count)
+                await res.write(writer)
+            if self.metrics is not None and req is not None:
+                self.metrics.record(
+                    req.route_index, res.status_code,
+                    ticks_diff(parsed, reader.started_us),
+                    ticks_diff(handled, parsed),
+                    ticks_diff(ticks_us(), handled))
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            if not keep:
+                break
+        reader.release()
         try:
             await writer.aclose()
         except OSError as exc:  # pragma: no cover
@@ -1344,17 +2651,14 @@ class Microdot:
                 pass
             else:
                 raise
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
 
     async def dispatch_request(self, req):
         after_request_handled = False
         if req:
             if req.content_length > req.max_content_length:
                 if 413 in self.error_handlers:
-                    res = await invoke_handler(self.error_handlers[413], req)
+                    res = await self.run_handler(
+                        self.error_handlers[413], req)
                 else:
                     res = 'Payload too large', 413
             else:
@@ -1362,12 +2666,17 @@ class Microdot:
                 try:
                     res = None
                     if callable(f):
+                        if self.threaded(f) and self.handlers_pending >= \
+                                self.max_threads + self.max_queued_handlers:
+                            # the thread pool is full
+                            self.handlers_rejected += 1
+                            raise HTTPException(503, 'Server busy')
                         for handler in self.before_request_handlers:
-                            res = await invoke_handler(handler, req)
+                            res = await self.run_handler(handler, req)
                             if res:
                                 break
                         if res is None:
-                            res = await invoke_handler(
+                            res = await self.run_handler(
                                 f, req, **req.url_args)
                         if isinstance(res, int):
                             res = '', res
@@ -1383,19 +2692,22 @@ class Microdot:
                                 status_code = 200
                                 headers = res[1]
                             res = Response(body, status_code, headers)
+                        elif isinstance(res, StaticResponse):
+                            res = res.respond(req)
                         elif not isinstance(res, Response):
                             res = Response(res)
                         for handler in self.after_request_handlers:
-                            res = await invoke_handler(
+                            res = await self.run_handler(
                                 handler, req, res) or res
                         for handler in req.after_request_handlers:
-                            res = await invoke_handler(
+                            res = await self.run_handler(
                                 handler, req, res) or res
                         after_request_handled = True
                     elif isinstance(f, dict):
                         res = Response(headers=f)
                     elif f in self.error_handlers:
-                        res = await invoke_handler(self.error_handlers[f], req)
+                        res = await self.run_handler(
+                            self.error_handlers[f], req)
                     else:
                         res = 'Not found', f
                 except HTTPException as exc:
@@ -1416,19 +2728,19 @@ class Microdot:
                                 break
                     if exc_class:
                         try:
-                            res = await invoke_handler(
+                            res = await self.run_handler(
                                 self.error_handlers[exc_class], req, exc)
                         except Exception as exc2:  # pragma: no cover
                             print_exception(exc2)
                     if res is None:
                         if 500 in self.error_handlers:
-                            res = await invoke_handler(
+                            res = await self.run_handler(
                                 self.error_handlers[500], req)
                         else:
                             res = 'Internal server error', 500
         else:
             if 400 in self.error_handlers:
-                res = await invoke_handler(self.error_handlers[400], req)
+                res = await self.run_handler(self.error_handlers[400], req)
             else:
                 res = 'Bad request', 400
         if isinstance(res, tuple):
@@ -1437,8 +2749,11 @@ class Microdot:
             res = Response(res)
         if not after_request_handled:
             for handler in self.after_error_request_handlers:
-                res = await invoke_handler(
+                res = await self.run_handler(
                     handler, req, res) or res
+        if req and res.file_size is not None and \
+                req.method in ('GET', 'HEAD') and 'Range' in req.headers:
+            res.set_range(req.headers['Range'])
         res.is_head = (req and req.method == 'HEAD')
         return res
 
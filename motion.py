@@ -0,0 +1,711 @@
+"""Precompiled motions for the robot dog. A choreography (a function that moves
+legs and sleeps) is run once against recording PWMs to get a flat schedule of
+duty writes, which can then be replayed without doing any kinematics.
+"""
+
+import _thread
+import asyncio
+import binascii
+import struct
+from array import array
+
+from hardware import (TimingStats, ticks_ms, ticks_us, ticks_add, ticks_diff,
+                      sleep_ms, async_sleep_ms, next_due, print_exception)
+
+
+class MotionPlan(object):
+    """A timestamped schedule of servo duty writes. Entries are stored flat in
+    an array as (t_ms, servo_index, duty_ns) triples, in time order, with the
+    angle each write puts the servo at alongside in another array.
+    """
+    # identifies a saved plan file (and its layout version)
+    MAGIC = b'DOG3'
+    HEADER = '<4sIII'
+
+    def __init__(self, data=None, duration_ms: int = 0, angles=None,
+                 calibration: int = 0):
+        """Create a plan.
+        :param data: the flat entry array (see the class docstring)
+        :param duration_ms: how long the plan takes, including any waiting
+        after the last write
+        :param angles: the angle in degrees for each entry, so playing the plan
+        can keep the servos' current_angle up to date
+        :param calibration: the calibration_key of the servos the duties were
+        worked out for
+        """
+        self.data = data if data is not None else array('i')
+        self.duration_ms = duration_ms
+        self.angles = angles if angles is not None else array('f')
+        self.calibration = calibration
+
+    def __len__(self):
+        return len(self.data) // 3
+
+    def entries(self):
+        """Iterate over the (t_ms, servo_index, duty_ns) entries"""
+        data = self.data
+        for i in range(0, len(data), 3):
+            yield data[i], data[i+1], data[i+2]
+
+    def save(self, filename: str):
+        """Write the plan to a binary file so it doesn't have to be compiled
+        again at boot.
+        :param filename: the file to write to
+        """
+        with open(filename, 'wb') as f:
+            f.write(struct.pack(self.HEADER, self.MAGIC, len(self),
+                                self.duration_ms, self.calibration))
+            f.write(self.data)
+            f.write(self.angles)
+
+    @classmethod
+    def load(cls, filename: str):
+        """Read a plan written by save.
+        :param filename: the file to read from
+        :return: the loaded plan
+        """
+        with open(filename, 'rb') as f:
+            header = f.read(struct.calcsize(cls.HEADER))
+            magic, count, duration_ms, calibration = struct.unpack(
+                cls.HEADER, header)
+            if magic != cls.MAGIC:
+                raise ValueError('not a motion plan file')
+            data = array('i', bytes(12 * count))
+            angles = array('f', bytes(4 * count))
+            if f.readinto(data) != 12 * count or \
+                    f.readinto(angles) != 4 * count:
+                raise ValueError('truncated motion plan file')
+        return cls(data, duration_ms, angles, calibration)
+
+
+class _Recorder(object):
+    """Stands in for the clock while a choreography is compiled"""
+    def __init__(self):
+        self.data = array('i')
+        self.angles = array('f')
+        self.t_ms = 0
+
+    def sleep(self, seconds: float):
+        self.t_ms += int(seconds * 1000)
+
+
+class _RecordingPWM(object):
+    """Stands in for a servo's PWM while a choreography is compiled"""
+    def __init__(self, recorder: _Recorder, index: int, servo):
+        self.recorder = recorder
+        self.index = index
+        self.servo = servo
+
+    def duty_ns(self, duty: int):
+        data = self.recorder.data
+        data.append(self.recorder.t_ms)
+        data.append(self.index)
+        data.append(duty)
+        # the servo has already recorded the angle it's being sent to
+        self.recorder.angles.append(self.servo.current_angle)
+
+
+def calibration_key(servos) -> int:
+    """Get a checksum of the servos' calibrations (their compiled duty
+    tables), which a plan is saved with so it's compiled again once they
+    change.
+    :param servos: the servos, in the order plans refer to them
+    :return: the checksum
+    """
+    key = 0
+    for servo in servos:
+        calibration = servo.calibration
+        key = binascii.crc32(struct.pack('<i', calibration.first), key)
+        key = binascii.crc32(calibration.table, key)
+    return key
+
+
+def compile_plan(choreography, servos) -> MotionPlan:
+    """Compile a choreography into a plan. The choreography is called with a
+    `sleep` keyword argument that it must use instead of time.sleep, and the
+    servos' PWMs are swapped out while it runs, so nothing actually moves.
+    :param choreography: the function to compile
+    :param servos: every Servo the choreography might move; the plan refers to
+    them by their index in this sequence
+    :return: the compiled plan
+    """
+    recorder = _Recorder()
+    saved = [(servo.pwm, servo.current_angle) for servo in servos]
+    try:
+        for i, servo in enumerate(servos):
+            servo.pwm = _RecordingPWM(recorder, i, servo)
+        choreography(sleep=recorder.sleep)
+    finally:
+        for servo, (pwm, angle) in zip(servos, saved):
+            servo.pwm = pwm
+            servo.current_angle = angle
+
+    return MotionPlan(recorder.data, recorder.t_ms, recorder.angles,
+                      calibration_key(servos))
+
+
+def load_or_compile(filename: str, choreography, servos) -> MotionPlan:
+    """Load a saved plan, or compile (and save) it if there isn't a usable one
+    (including one compiled for a different calibration).
+    :param filename: where the plan is saved
+    :param choreography: the function to compile if needed
+    :param servos: the servos the plan refers to (see compile_plan)
+    :return: the plan
+    """
+    try:
+        plan = MotionPlan.load(filename)
+        if plan.calibration == calibration_key(servos):
+            return plan
+    except (OSError, ValueError):
+        pass
+
+    plan = compile_plan(choreography, servos)
+    try:
+        plan.save(filename)
+    except OSError:
+        # read-only filesystem or similar, just compile again next boot
+        pass
+    return plan
+
+
+def play(plan: MotionPlan, servos, repeat=None, output=None):
+    """Replay a plan, blocking until it is done.
+    :param plan: the plan to play
+    :param servos: the servos the plan was compiled against
+    :param repeat: if given, a function called at the end of each run; the plan
+    plays again for as long as it returns True
+    :param output: if given, the hardware.PWMOutput the servos write through,
+    so writes at the same time can be batched into one flush
+    """
+    pwms = [servo.pwm for servo in servos]
+    data = plan.data
+    angles = plan.angles
+    start = ticks_ms()
+    while True:
+        for i in range(0, len(data), 3):
+            wait = ticks_diff(ticks_add(start, data[i]), ticks_ms())
+            if wait > 0:
+                # everything due before now has been held, so send it
+                if output is not None:
+                    output.flush()
+                sleep_ms(wait)
+            if output is not None:
+                output.begin()
+            index = data[i+1]
+            pwms[index].duty_ns(data[i+2])
+            # so whatever moves the servos next starts from where they are
+            servos[index].current_angle = angles[i // 3]
+        if output is not None:
+            output.flush()
+
+        end = ticks_add(start, plan.duration_ms)
+        wait = ticks_diff(end, ticks_ms())
+        if wait > 0:
+            sleep_ms(wait)
+
+        if repeat is None or not repeat():
+            break
+        start = end
+
+
+async def play_async(plan: MotionPlan, servos, repeat=None, output=None):
+    """Replay a plan without blocking the event loop (see play).
+    :param plan: the plan to play
+    :param servos: the servos the plan was compiled against
+    :param repeat: if given, a function called at the end of each run; the plan
+    plays again for as long as it returns True
+    :param output: see play
+    """
+    pwms = [servo.pwm for servo in servos]
+    data = plan.data
+    angles = plan.angles
+    start = ticks_ms()
+    while True:
+        for i in range(0, len(data), 3):
+            wait = ticks_diff(ticks_add(start, data[i]), ticks_ms())
+            if wait > 0:
+                if output is not None:
+                    output.flush()
+                await async_sleep_ms(wait)
+            if output is not None:
+                output.begin()
+            # (angles are kept up to date write by write, so they're right
+            # even if the task is cancelled part way)
+            index = data[i+1]
+            pwms[index].duty_ns(data[i+2])
+            servos[index].current_angle = angles[i // 3]
+        if output is not None:
+            output.flush()
+
+        end = ticks_add(start, plan.duration_ms)
+        wait = ticks_diff(end, ticks_ms())
+        # always yield at least once per run, so an empty or instant plan that
+        # repeats can't starve the loop
+        await async_sleep_ms(max(wait, 0))
+
+        if repeat is None or not repeat():
+            break
+        start = end
+
+
+class Job(object):
+    """A motion that has been given to a MotionScheduler"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, job_id: int, name: str, motion, repeat):
+        self.id = job_id
+        self.name = name
+        self.motion = motion
+        self.repeat = repeat
+        self.state = Job.QUEUED
+        self.task = None
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'state': self.state}
+
+
+class MotionScheduler(object):
+    """Runs motions one at a time as asyncio tasks, so the web server (or
+    anything else on the event loop) keeps running while the dog moves. A
+    motion is either a MotionPlan or an async function that moves the dog
+    itself (such as gait.GaitEngine.run_async). Must be used from inside the
+    event loop.
+    """
+    # how many finished jobs to remember for status lookups
+    HISTORY = 8
+
+    def __init__(self, servos, output=None):
+        """Create a scheduler.
+        :param servos: the servos that plans will be played on
+        :param output: see play
+        """
+        self.servos = servos
+        self.output = output
+        self.current = None
+        self.pending = []
+        self.jobs = {}
+        self._next_id = 1
+
+    def _new_job(self, name: str, motion, repeat) -> Job:
+        job = Job(self._next_id, name, motion, repeat)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        # forget the oldest finished jobs
+        for job_id in sorted(self.jobs):
+            if len(self.jobs) <= self.HISTORY:
+                break
+            if self.jobs[job_id].state in (Job.DONE, Job.CANCELLED):
+                del self.jobs[job_id]
+        return job
+
+    def start(self, name: str, motion, repeat=None) -> int:
+        """Cancel whatever is running or queued and start a motion now.
+        :param name: a name for the job (for status reports)
+        :param motion: the plan to play or async function to run
+        :param repeat: see play_async (only used for plans)
+        :return: the job id
+        """
+        self.cancel()
+        return self.queue(name, motion, repeat)
+
+    def queue(self, name: str, motion, repeat=None) -> int:
+        """Run a motion once everything before it has finished.
+        :param name: a name for the job (for status reports)
+        :param motion: the plan to play or async function to run
+        :param repeat: see play_async (only used for plans)
+        :return: the job id
+        """
+        job = self._new_job(name, motion, repeat)
+        self.pending.append(job)
+        if self.current is None:
+            self._run_next()
+        return job.id
+
+    def cancel(self, job_id: int = None) -> bool:
+        """Cancel a job, or everything if no job is given.
+        :param job_id: the job to cancel
+        :return: whether anything was cancelled
+        """
+        cancelled = False
+        for job in list(self.pending):
+            if job_id is None or job.id == job_id:
+                self.pending.remove(job)
+                job.state = Job.CANCELLED
+                cancelled = True
+
+        job = self.current
+        if job is not None and (job_id is None or job.id == job_id):
+            job.state = Job.CANCELLED
+            job.task.cancel()
+            # the task only notices the cancel once it's scheduled again, so
+            # move on without it
+            self._run_next()
+            cancelled = True
+
+        return cancelled
+
+    def status(self, job_id: int = None):
+        """Get the status of a job, or of the scheduler if no job is given.
+        :param job_id: the job to get the status of
+        :return: a dict of status info, or None for an unknown job
+        """
+        if job_id is not None:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job is not None else None
+        return {
+            'current': self.current.to_dict() if self.current else None,
+            'queued': [job.to_dict() for job in self.pending],
+        }
+
+    def _run_next(self):
+        if not self.pending:
+            self.current = None
+            return
+        job = self.pending.pop(0)
+        self.current = job
+        job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: Job):
+        job.state = Job.RUNNING
+        try:
+            if isinstance(job.motion, MotionPlan):
+                await play_async(job.motion, self.servos, job.repeat,
+                                 self.output)
+            else:
+                await job.motion()
+            job.state = Job.DONE
+        except asyncio.CancelledError:
+            job.state = Job.CANCELLED
+        finally:
+            if self.current is job:
+                self._run_next()
+
+
+# a binary leg target: when to move (in ms after the batch arrives), the leg
+# index, a pad byte, then the x and y targets in hundredths
+POSE_RECORD = '<HBxhh'
+POSE_RECORD_SIZE = 8
+
+
+def unpack_poses(data, legs: int):
+    """Read a batch of binary leg targets (see POSE_RECORD), straight from the
+    bytes without decoding any text.
+    :param data: the records, back to back, in time order
+    :param legs: the number of legs (higher leg indexes are rejected)
+    :return: a list of (t_ms, [(leg, (x, y)), ...]), one for every distinct
+    time, to go to MotionWorker.set_poses
+    """
+    if not data or len(data) % POSE_RECORD_SIZE:
+        raise ValueError('need whole {} byte records'.format(POSE_RECORD_SIZE))
+    data = memoryview(data)
+    batches = []
+    targets = None
+    last_t = -1
+    for offset in range(0, len(data), POSE_RECORD_SIZE):
+        t_ms, leg, x, y = struct.unpack_from(POSE_RECORD, data, offset)
+        if leg >= legs:
+            raise ValueError('no leg {}'.format(leg))
+        if t_ms < last_t:
+            raise ValueError('records must be in time order')
+        if t_ms != last_t:
+            targets = []
+            batches.append((t_ms, targets))
+            last_t = t_ms
+        targets.append((leg, (x / 100, y / 100)))
+    return batches
+
+
+class MotionWorker(object):
+    """A single long-lived thread (the pico's second core) that owns
+    continuous motion: walking with a gait.GaitEngine and holding poses. Other
+    threads only talk to it through a small command queue, so repeated
+    requests can't start a second walker, and the walk's timing doesn't depend
+    on what the web server is doing.
+    """
+    IDLE = 'idle'
+    WALKING = 'walking'
+    PAUSED = 'paused'
+
+    # commands
+    WALK = 'walk'
+    STOP = 'stop'
+    PAUSE = 'pause'
+    RESUME = 'resume'
+    POSE = 'pose'
+
+    # how often to check for commands between ticks while walking (when
+    # not walking, the thread sleeps until something is submitted)
+    IDLE_POLL_MS = 2
+
+    def __init__(self, engine, queue_size: int = 8):
+        """Create a worker (it doesn't start until start is called).
+        :param engine: the gait.GaitEngine to walk with; its legs are the ones
+        poses refer to
+        :param queue_size: the most commands that can be waiting at once
+        """
+        self.engine = engine
+        self.queue_size = queue_size
+        self.state = MotionWorker.IDLE
+        self.running = False
+        self._commands = []
+        self._lock = _thread.allocate_lock()
+        # held while there's nothing new for the thread, which blocks on it
+        # when idle; submitting releases it (so it works as a semaphore, and
+        # needs no timeouts, which the pico's locks don't have)
+        self._wake = _thread.allocate_lock()
+        self._wake.acquire()
+        self._targets = None
+        # when the command waiting on its first PWM write was submitted
+        self._pending_since = None
+        # the latest (target, submitted) for each leg from set_pose, waiting
+        # for the next tick
+        self._poses = [None] * len(engine.legs)
+        self._poses_waiting = False
+        # set while the thread is handling commands or writing poses (which
+        # it has already taken, so they're no longer waiting)
+        self._busy = False
+        self._next_pose_tick = ticks_ms()
+
+        self.rejected = 0
+        self.coalesced = 0
+        # commands and ticks that raised (and were skipped)
+        self.failed = 0
+        self.latency_us = TimingStats()
+
+    def reset_stats(self):
+        """Clear the command latency counters"""
+        self.latency_us.reset()
+
+    def stats(self):
+        """Get the worker's state and counters
+        :return: a dict with the state, queue length, rejected, coalesced and
+        failed commands, and last/max/mean latency from a command to its first
+        PWM write in microseconds
+        """
+        latency_us = self.latency_us
+        return {
+            'state': self.state,
+            'queued': len(self._commands),
+            'rejected': self.rejected,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'latency_last_us': latency_us.last,
+            'latency_max_us': latency_us.max,
+            'latency_mean_us': latency_us.mean(),
+        }
+
+    def start(self):
+        """Start the worker thread (once)"""
+        if not self.running:
+            self.running = True
+            _thread.start_new_thread(self._loop, ())
+
+    def shutdown(self):
+        """Stop the worker thread after its current tick"""
+        self.running = False
+        self._wake_up()
+
+    def submit(self, command: str, *args) -> bool:
+        """Give the worker a command.
+        :param command: one of WALK, STOP, PAUSE, RESUME or POSE (which takes
+        a leg index and an (x, y) target)
+        :return: False if the queue was full and the command was dropped
+        (STOP is never dropped, and throws away anything queued before it)
+        """
+        entry = (command, args, ticks_us())
+        with self._lock:
+            if command == MotionWorker.STOP:
+                self._commands = [entry]
+            elif len(self._commands) >= self.queue_size:
+                self.rejected += 1
+                return False
+            else:
+                self._commands.append(entry)
+        self._wake_up()
+        return True
+
+    def set_pose(self, leg: int, target: tuple[float, float]):
+        """Move a leg to a target on the next control tick, replacing any
+        target for that leg that hasn't been reached yet, so a stream of
+        targets (from a joystick, say) never queues up. Like a POSE command,
+        this stops walking.
+        :param leg: the index of the leg in the engine's legs
+        :param target: the (x, y) target for the foot
+        """
+        self.set_poses(((leg, target),))
+
+    def set_poses(self, targets):
+        """Move several legs on the same control tick (see set_pose).
+        :param targets: (leg index, (x, y) target) pairs
+        """
+        submitted = ticks_us()
+        with self._lock:
+            for leg, target in targets:
+                if self._poses[leg] is not None:
+                    self.coalesced += 1
+                self._poses[leg] = (target, submitted)
+            self._poses_waiting = True
+        self._wake_up()
+
+    async def play_poses(self, batches):
+        """Move legs through timed batches of targets (from unpack_poses),
+        without blocking the event loop. Cancel the task to stop early.
+        :param batches: (t_ms, targets) pairs, in time order
+        """
+        start = ticks_ms()
+        for t_ms, targets in batches:
+            wait = ticks_diff(ticks_add(start, t_ms), ticks_ms())
+            if wait > 0:
+                await async_sleep_ms(wait)
+            self.set_poses(targets)
+
+    def is_idle(self) -> bool:
+        """Whether the worker has nothing to do and isn't moving anything"""
+        # in this order: the thread is busy before it takes anything waiting
+        return (not self._commands and not self._poses_waiting
+                and not self._busy and self.state == MotionWorker.IDLE)
+
+    async def stop_async(self):
+        """Stop the worker and wait (without blocking the event loop) until it
+        has, so something else can take over the servos."""
+        self.submit(MotionWorker.STOP)
+        while self.running and not self.is_idle():
+            await async_sleep_ms(self.IDLE_POLL_MS)
+
+    def _wake_up(self):
+        # releasing a lock nobody holds raises, which just means the thread
+        # already has a wake up waiting for it
+        try:
+            self._wake.release()
+        except RuntimeError:
+            pass
+
+    def _take(self):
+        with self._lock:
+            commands = self._commands
+            self._commands = []
+        return commands
+
+    def _handle(self, command: str, args, submitted: int):
+        if command == MotionWorker.WALK:
+            if self.state == MotionWorker.IDLE:
+                self._targets = self.engine.targets()
+            # already walking is fine, just don't start again
+            if self.state != MotionWorker.WALKING:
+                self.state = MotionWorker.WALKING
+                self._pending_since = submitted
+        elif command == MotionWorker.STOP:
+            self.state = MotionWorker.IDLE
+            self._targets = None
+        elif command == MotionWorker.PAUSE:
+            if self.state == MotionWorker.WALKING:
+                self.state = MotionWorker.PAUSED
+        elif command == MotionWorker.RESUME:
+            if self.state == MotionWorker.PAUSED:
+                self.state = MotionWorker.WALKING
+                self._pending_since = submitted
+        elif command == MotionWorker.POSE:
+            leg, target = args
+            self.engine.legs[leg].move_to_fast(target)
+            # a pose takes over from walking
+            self.state = MotionWorker.IDLE
+            self._targets = None
+            self._record_latency(submitted)
+
+    def _apply_poses(self):
+        with self._lock:
+            poses = self._poses
+            self._poses = [None] * len(poses)
+            self._poses_waiting = False
+
+        # every leg moves in the same tick
+        output = self.engine.output
+        output.begin()
+        for leg, pose in zip(self.engine.legs, poses):
+            if pose is not None:
+                leg.move_to_fast(pose[0])
+        output.flush()
+        # only idle (so the servos can be taken over) once the writes are done
+        self.state = MotionWorker.IDLE
+        self._targets = None
+        for pose in poses:
+            if pose is not None:
+                self._record_latency(pose[1])
+        self._next_pose_tick = ticks_add(ticks_ms(), self.engine.period_ms)
+
+    def _record_latency(self, submitted: int):
+        self.latency_us.record(ticks_diff(ticks_us(), submitted))
+
+    def _failed(self, exc: Exception):
+        # one bad command or tick mustn't take the whole thread down, or
+        # nothing could ever take the servos back from it
+        self.failed += 1
+        print_exception(exc)
+
+    def _loop(self):
+        try:
+            self._run()
+        finally:
+            # so start works again, and nothing waits on a dead thread
+            self.running = False
+            self.state = MotionWorker.IDLE
+            self._targets = None
+            self._busy = False
+
+    def _run(self):
+        engine = self.engine
+        next_tick = ticks_ms()
+        while self.running:
+            self._busy = True
+            for command, args, submitted in self._take():
+                try:
+                    self._handle(command, args, submitted)
+                except Exception as exc:
+                    self._failed(exc)
+            # poses go out at most once a tick (the servos can't follow any
+            # faster), but straight away if there hasn't been one for a tick
+            if self._poses_waiting and \
+                    ticks_diff(ticks_ms(), self._next_pose_tick) >= 0:
+                try:
+                    self._apply_poses()
+                except Exception as exc:
+                    self._failed(exc)
+            self._busy = False
+
+            if self.state != MotionWorker.WALKING:
+                wait = ticks_diff(self._next_pose_tick, ticks_ms())
+                if self._poses_waiting and wait > 0:
+                    # poses that came in too soon after the last ones
+                    sleep_ms(wait)
+                elif not self._commands and not self._poses_waiting:
+                    # nothing to do until something is submitted
+                    self._wake.acquire()
+                # walking starts straight away
+                next_tick = ticks_ms()
+                continue
+
+            # wait for the next tick in small pieces, so commands that come
+            # in meanwhile are handled promptly
+            wait = ticks_diff(next_tick, ticks_ms())
+            if wait > 0:
+                sleep_ms(min(wait, self.IDLE_POLL_MS))
+                continue
+
+            try:
+                phase, targets = next(self._targets)
+                engine.phase = phase
+                engine.tick(targets)
+            except Exception as exc:
+                # stop walking, or every tick after would fail the same way
+                self._failed(exc)
+                self.state = MotionWorker.IDLE
+                self._targets = None
+                continue
+            if self._pending_since is not None:
+                self._record_latency(self._pending_since)
+                self._pending_since = None
+
+            next_tick, _ = next_due(next_tick, engine.period_ms)
@@ -0,0 +1,166 @@
+"""A pretend version of the MicroPython `machine` and `network` modules, so the
+dog's code can run (and be timed) on a normal computer. Every PWM write is
+logged with a timestamp, ADC readings come from simulated distance sensors, and
+the WLAN always comes up straight away.
+"""
+
+import math
+import time
+
+try:
+    from time import ticks_us
+except ImportError:
+    # CPython doesn't have the MicroPython tick functions
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+# every duty write as a (t_us, pin, duty_ns) tuple, oldest first
+duty_log = []
+# whether duty writes are logged at all (the counts are always kept)
+logging = True
+# the log is trimmed by half once it gets this long
+LOG_LIMIT = 20000
+
+# the number of duty writes per pin
+write_counts = {}
+
+# the state of every output pin that has been set, by pin number
+pin_states = {}
+
+# simulated sensors by ADC pin number (see set_obstacle)
+sensors = {}
+# the LED luminosity the simulated sensors use (matches DistSensor's)
+LED_LUMINOSITY = 45000
+
+
+def reset():
+    """Forget all logged writes and counts"""
+    del duty_log[:]
+    write_counts.clear()
+
+
+def writes(pin: int = None):
+    """Get the logged writes.
+    :param pin: only get writes for this pin
+    :return: a list of (t_us, pin, duty_ns) tuples
+    """
+    if pin is None:
+        return list(duty_log)
+    return [entry for entry in duty_log if entry[1] == pin]
+
+
+def set_obstacle(adc_pin: int, led_pin: int, distance: float,
+                 ambient: int = 20000, noise: int = 0):
+    """Put a simulated obstacle in front of a distance sensor. The LDR reads
+    the ambient light, plus the LED's light bounced off the obstacle when the
+    LED is on (falling off the way hardware.DistSensor assumes it does).
+    :param adc_pin: the ADC pin the sensor's LDR is on
+    :param led_pin: the pin the sensor's LED is on
+    :param distance: the distance to the obstacle in DistSensor units, or None
+    for nothing in range
+    :param ambient: the reading with the LED off
+    :param noise: the size of random noise to add to each reading
+    """
+    sensors[adc_pin] = (led_pin, distance, ambient, noise)
+
+
+_noise_seed = 1
+
+
+def _noise(size: int) -> int:
+    # a tiny LCG so this doesn't need the random module
+    global _noise_seed
+    _noise_seed = (_noise_seed * 1103515245 + 12345) & 0x7fffffff
+    return _noise_seed % (2*size + 1) - size
+
+
+class Pin(object):
+    IN = 0
+    OUT = 1
+
+    def __init__(self, pin, mode=-1, *args, **kwargs):
+        self.id = pin
+        self.mode = mode
+        pin_states.setdefault(pin, 0)
+
+    def value(self, value=None):
+        if value is None:
+            return pin_states[self.id]
+        pin_states[self.id] = 1 if value else 0
+
+    def on(self):
+        pin_states[self.id] = 1
+
+    def off(self):
+        pin_states[self.id] = 0
+
+
+class PWM(object):
+    def __init__(self, pin: Pin, *args, **kwargs):
+        self.pin = pin.id
+        self._freq = 0
+        self._duty = 0
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_ns(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        write_counts[self.pin] = write_counts.get(self.pin, 0) + 1
+        if logging:
+            duty_log.append((ticks_us(), self.pin, value))
+            if len(duty_log) > LOG_LIMIT:
+                del duty_log[:LOG_LIMIT // 2]
+
+    def deinit(self):
+        pass
+
+
+class ADC(object):
+    def __init__(self, pin, *args, **kwargs):
+        self.pin = pin.id if isinstance(pin, Pin) else pin
+
+    def read_u16(self) -> int:
+        if self.pin not in sensors:
+            return 0
+        led_pin, distance, ambient, noise = sensors[self.pin]
+        reading = ambient
+        if pin_states.get(led_pin) and distance is not None:
+            # invert the sensor's sqrt(luminosity / (4*pi*flux)) model
+            reading += LED_LUMINOSITY / (4*math.pi*distance*distance)
+        if noise:
+            reading += _noise(noise)
+        return max(0, min(65535, int(reading)))
+
+
+# network
+
+AP_IF = 1
+STA_IF = 0
+
+
+class WLAN(object):
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self.settings = {}
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self.settings.get(args[0])
+        self.settings.update(kwargs)
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value)
+
+    def isconnected(self) -> bool:
+        return self._active
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
@@ -0,0 +1,197 @@
+"""Live telemetry for the robot dog. A Telemetry broadcaster samples the dog's
+state (servo angles, gait phase, distance sensors, control loop timing) at a
+fixed rate on the event loop, and streams each sample to every listening
+client as a Server-Sent Event. A sample is taken and serialized once however
+many clients there are, and a client that falls behind skips to the newest
+sample rather than having them pile up.
+"""
+
+import asyncio
+import json
+
+from hardware import (TimingStats, ticks_ms, ticks_us, ticks_add, ticks_diff,
+                      async_sleep_ms, next_due)
+
+
+class TelemetryStream(object):
+    """One client's view of a Telemetry broadcaster: an async iterator of
+    encoded events, which microdot can send as a streamed response body.
+    """
+    def __init__(self, telemetry, rate_hz: float = None):
+        """Don't create these directly, use Telemetry.subscribe.
+        :param telemetry: the broadcaster to follow
+        :param rate_hz: the most events per second to send (every sample if
+        not given)
+        """
+        self.telemetry = telemetry
+        self.interval_ms = int(1000 / rate_hz) if rate_hz else 0
+        # the number of the last sample sent
+        self.seq = 0
+        self.sent_at = None
+        self.started = False
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        telemetry = self.telemetry
+        if not self.started:
+            # tell the browser how soon to reconnect if the stream drops
+            self.started = True
+            return b'retry: 2000\n\n'
+
+        if self.interval_ms and self.sent_at is not None:
+            wait = ticks_diff(ticks_add(self.sent_at, self.interval_ms),
+                              ticks_ms())
+            if wait > 0:
+                await async_sleep_ms(wait)
+        while self.seq == telemetry.seq and not self.closed:
+            await telemetry.updated.wait()
+        if self.closed:
+            raise StopAsyncIteration
+
+        if self.seq:
+            telemetry.skipped += telemetry.seq - self.seq - 1
+        self.seq = telemetry.seq
+        self.sent_at = ticks_ms()
+        return telemetry.event
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.telemetry.unsubscribe(self)
+
+
+class Telemetry(object):
+    """Samples the dog's state for any number of streaming clients. Sampling
+    runs as an asyncio task only while someone is listening, and only reads
+    values other code has already worked out (it never talks to hardware), so
+    it doesn't hold up the motion loop. Must be used from inside the event
+    loop.
+    """
+    def __init__(self, sources: dict, rate_hz: float = 5,
+                 max_rate_hz: float = 20, max_clients: int = 2):
+        """Create a telemetry broadcaster.
+        :param sources: the values to sample, as a dict of name to a function
+        returning something that can be turned into json
+        :param rate_hz: the number of samples per second
+        :param max_rate_hz: the highest rate set_rate allows
+        :param max_clients: the most clients that can listen at once (each one
+        holds a connection open, and the pico only has a few)
+        """
+        self.sources = sources
+        self.max_rate_hz = max_rate_hz
+        self.max_clients = max_clients
+        self.set_rate(rate_hz)
+
+        self.clients = []
+        # the latest sample, encoded as an event, and its number
+        self.event = None
+        self.seq = 0
+        # set (and replaced) every time there's a new sample
+        self.updated = asyncio.Event()
+        self._task = None
+        # the time to take and encode each sample
+        self.sample_us = TimingStats()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Clear the sampling counters"""
+        self.skipped = 0
+        self.rejected = 0
+        self.sample_us.reset()
+
+    def stats(self):
+        """Get the sampling counters
+        :return: a dict with the sample rate, number of clients, samples
+        taken, samples clients skipped, clients turned away, and last/max/mean
+        time to take and encode a sample in microseconds
+        """
+        sample_us = self.sample_us
+        return {
+            'rate_hz': self.rate_hz,
+            'clients': len(self.clients),
+            'samples': sample_us.count,
+            'skipped': self.skipped,
+            'rejected': self.rejected,
+            'sample_us_last': sample_us.last,
+            'sample_us_max': sample_us.max,
+            'sample_us_mean': sample_us.mean(),
+        }
+
+    def set_rate(self, rate_hz: float):
+        """Change how often samples are taken (from the next one on).
+        :param rate_hz: the number of samples per second
+        """
+        rate_hz = float(rate_hz)
+        if not 0 < rate_hz <= self.max_rate_hz:
+            raise ValueError('rate must be between 0 and {}'.format(
+                self.max_rate_hz))
+        self.rate_hz = rate_hz
+        self.period_ms = int(1000 / rate_hz)
+
+    def sample(self) -> dict:
+        """Read every source now.
+        :return: a dict of the source names to their values, plus the time in
+        milliseconds
+        """
+        sample = {'t_ms': ticks_ms()}
+        for name, source in self.sources.items():
+            sample[name] = source()
+        return sample
+
+    def publish(self):
+        """Take a sample and send it to every client"""
+        start = ticks_us()
+        self.seq += 1
+        self.event = 'id: {}\ndata: {}\n\n'.format(
+            self.seq, json.dumps(self.sample())).encode()
+        self.sample_us.record(ticks_diff(ticks_us(), start))
+
+        # wake up everyone waiting on this sample, and give the next one a
+        # fresh event to wait on
+        updated = self.updated
+        self.updated = asyncio.Event()
+        updated.set()
+
+    def subscribe(self, rate_hz: float = None):
+        """Start listening, starting the sampling if nobody else was.
+        :param rate_hz: the most events per second this client wants (every
+        sample if not given)
+        :return: a TelemetryStream to send as a response body, or None if
+        there are already max_clients listening
+        """
+        # nan fails both comparisons
+        if rate_hz is not None and not 0 < rate_hz < float('inf'):
+            raise ValueError('rate must be a finite number above 0')
+        if len(self.clients) >= self.max_clients:
+            self.rejected += 1
+            return None
+        stream = TelemetryStream(self, rate_hz)
+        self.clients.append(stream)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return stream
+
+    def unsubscribe(self, stream: TelemetryStream):
+        """Stop sending samples to a client (once it has gone away)"""
+        if stream in self.clients:
+            self.clients.remove(stream)
+
+    def stop(self):
+        """End every client's stream"""
+        for stream in self.clients:
+            stream.closed = True
+        self.clients = []
+        self.updated.set()
+
+    async def _run(self):
+        try:
+            next_sample = ticks_ms()
+            while self.clients:
+                self.publish()
+                next_sample, wait = next_due(next_sample, self.period_ms)
+                await async_sleep_ms(wait)
+        finally:
+            self._task = None